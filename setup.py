@@ -100,7 +100,8 @@ setup(
         "PyGObject",
     ],
     extras_require={
-        'test': ['mock']
+        'test': ['mock'],
+        'markov': ['numpy']
     },
     entry_points={
         'console_scripts': [
@@ -22,45 +22,103 @@ import collections
 __metaclass__ = type
 
 
+CHUNK_SIZE = 1 << 16
+EMPTY = re.compile(r"^\s*$")
+CONFIG_LINE = re.compile(r"^(\w+)\s*=\s*(.*)$")
+
+
+def iter_lines(fileobj, size=CHUNK_SIZE):
+    """
+    Iterate over the lines of a text stream, without the line terminator.
+    The stream is read in chunks of the given size and it is never seeked,
+    so it can be a pipe.
+    """
+
+    tail = ""
+    while True:
+        chunk = fileobj.read(size)
+        if not chunk:
+            break
+        lines = (tail + chunk).split("\n")
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def is_blank(line):
+    return line.startswith("#") or EMPTY.match(line) is not None
+
+
 class Section:
+    """
+    A section of a project file. The lines are all the lines that follow the
+    header up to the next header or link, iterating over a section yields
+    the (name, value) pairs up to the first line that is not an option.
+    """
 
-    EMPTY = re.compile(r"^\s*$")
-    CONFIG_LINE = re.compile(r"^(\w+)\s*=\s*(.*)$")
+    EMPTY = EMPTY
+    CONFIG_LINE = CONFIG_LINE
 
-    def __init__(self, type, name, fileobj):
+    def __init__(self, type, name, lines=()):
         self.type = type
         self.name = name
-        self.fileobj = fileobj
+        self.lines = list(lines)
 
     def __iter__(self):
-        curpos = self.fileobj.tell()
-        line = self.fileobj.readline()
-        while line:
-            if line.startswith("#") or self.EMPTY.match(line):
-                curpos = self.fileobj.tell()
-                line = self.fileobj.readline()
-                continue
-            match = self.CONFIG_LINE.match(line)
+        for line, match in zip(self.lines, map(CONFIG_LINE.match, self.lines)):
             if match:
-                name, value = match.groups()
-                if value is None:
-                    # value is None when the parameter is not set
-                    value = ""
-                yield name, value
-                curpos = self.fileobj.tell()
-                line = self.fileobj.readline()
-            else:
-                self.fileobj.seek(curpos)
+                yield match.groups()
+            elif not is_blank(line):
                 return
 
 
+    def split(self):
+        """
+        Return the options and the lines that follow them.
+
+        :rtype: Tuple[List[Tuple[str, str]], List[str]]
+        """
+
+        options = []
+        for i, line in enumerate(self.lines):
+            match = CONFIG_LINE.match(line)
+            if match:
+                options.append(match.groups())
+            elif not is_blank(line):
+                return options, self.lines[i:]
+        return options, []
+
+
+class ParsedSection(Section):
+    """
+    A section whose options are already parsed, ex. when it is loaded from
+    a JSON project.
+    """
+
+    def __init__(self, type, name, options, rest=()):
+        self.type = type
+        self.name = name
+        self.options = options
+        self.rest = list(rest)
+
+    @property
+    def lines(self):
+        lines = ["{0}={1}".format(name, value) for name, value in self.options]
+        lines.extend(self.rest)
+        return lines
+
+    def __iter__(self):
+        return iter(self.options)
+
+
 Link = collections.namedtuple("Link", ["type", "owner", "sockname", "model",
                                        "mac"])
 
 
 class Parser:
 
-    EMPTY = re.compile(r"^\s*$")
+    EMPTY = EMPTY
     SECTION_HEADER = re.compile(r"^\[([a-zA-Z0-9_]+):(.+)\]$")
     LINK = re.compile(r"^(?P<type>link|sock)\|"
                       r"(?P<owner>[a-zA-Z][\w.-]*)\|"
@@ -75,18 +133,34 @@ class Parser:
         """Iter through sections. There are two kinds of sections: bricks,
         events and images are one kind of section and links and socks are the
         second kind of section.
+
+        The file is read in a single pass, a section is yielded when the next
+        header or link is found.
         """
 
-        line = self.fileobj.readline()
-        while line:
-            if line.startswith('#') or self.EMPTY.match(line):
-                line = self.fileobj.readline()
-                continue
-            match = self.SECTION_HEADER.match(line)
-            if match:
-                yield Section(match.group(1), match.group(2), self.fileobj)
-            else:
-                match = self.LINK.match(line)
+        header = self.SECTION_HEADER.match
+        link = self.LINK.match
+        section = None
+        append = None
+        for line in iter_lines(self.fileobj):
+            first = line[:1]
+            if first == "[":
+                match = header(line)
+                if match:
+                    if section is not None:
+                        yield section
+                    section = Section(match.group(1), match.group(2))
+                    append = section.lines.append
+                    continue
+            elif first in ("l", "s") and line.startswith(("link|", "sock|")):
+                match = link(line)
                 if match:
+                    if section is not None:
+                        yield section
+                        section = append = None
                     yield Link._make(match.groups())
-            line = self.fileobj.readline()
+                    continue
+            if append is not None:
+                append(line)
+        if section is not None:
+            yield section
@@ -54,6 +54,24 @@ DEFAULT_CONF = {
     "show_missing": True,
     "qemupath": "/usr/bin",
     "vdepath": "/usr/bin",
+    # "timer" saves the project every 3 minutes, "change" a few seconds after
+    # every change, "journal" appends every change to a journal
+    "autosave": "timer",
+    # "text" or "json", the format of the saved projects
+    "project_format": "text",
+    # build the bricks of a project only when they are used
+    "lazy_restore": False,
+    # sync the project file to the disk after every save
+    "fsync": False,
+    # re-serialize only the bricks changed since the last save, every change
+    # must be notified or it is lost
+    "incremental_save": False,
+    # management commands sent before waiting for a reply and seconds to wait
+    # for it
+    "pipeline_size": 8,
+    "command_timeout": 30,
+    # seconds between two polls of the switch port statistics, 0 to disable
+    "stats_interval": 0,
 }
 
 
@@ -78,7 +96,8 @@ class SettingsMeta(type):
 class Settings(metaclass=SettingsMeta):
 
     __boolean_values__ = ('kvm', 'ksm', 'python', 'femaleplugs',
-                          'erroronloop', 'systray', 'show_missing')
+                          'erroronloop', 'systray', 'show_missing',
+                          'lazy_restore', 'fsync', 'incremental_save')
     DEFAULT_SECTION = "Main"
     DEFAULT_PROJECT = DEFAULT_PROJECT
     VIRTUALBRICKS_HOME = VIRTUALBRICKS_HOME
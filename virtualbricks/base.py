@@ -16,9 +16,13 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import abc
+import collections.abc
+import copy
+import itertools
 import re
 
-from twisted.python import reflect
+from twisted.internet import defer
 
 from virtualbricks import log, observable
 
@@ -34,39 +38,155 @@ attribute_set = log.Event("Attribute {attr} set in {brick} with value "
 param_not_found = log.Event("Parameter {param} in {brick} not found. "
                             "(val: {value})")
 
+# shared by all the configurations, a generation is never reused
+_generations = itertools.count(1)
 
-class Config(dict):
+
+class _Schema:
+    """The merged parameters of a configuration class.
+
+    A schema is computed once per class and shared by all its instances:
+    it maps every parameter name to a position in the per instance list of
+    values.
+    """
+
+    __slots__ = ("parameters", "names", "index", "defaults")
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self.names = tuple(sorted(parameters))
+        self.index = dict((n, i) for i, n in enumerate(self.names))
+        self.defaults = tuple(parameters[n].default for n in self.names)
+
+
+class _Parameters:
+    """
+    Give access to the parameters declared in the class body when accessed
+    from the class and to all the parameters, inherited ones included, when
+    accessed from an instance.
+    """
+
+    def __init__(self, declared):
+        self.declared = declared
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.declared
+        return owner._schema.parameters
+
+    def __set__(self, instance, value):
+        raise AttributeError("parameters are read-only")
+
+
+class ConfigType(abc.ABCMeta):
+    """
+    Precompile the schema of every configuration class and give its
+    instances a fixed layout.
+    """
+
+    def __new__(mcs, name, bases, dct):
+        dct.setdefault("__slots__", ())
+        dct["parameters"] = _Parameters(dct.get("parameters", {}))
+        return super().__new__(mcs, name, bases, dct)
+
+    def __init__(cls, name, bases, dct):
+        super().__init__(name, bases, dct)
+        parameters = {}
+        for klass in reversed(cls.__mro__):
+            declared = klass.__dict__.get("parameters")
+            if isinstance(declared, _Parameters):
+                parameters.update(declared.declared)
+        cls._schema = _Schema(parameters)
+
+
+class Config(collections.abc.MutableMapping, metaclass=ConfigType):
 
     CONFIG_LINE = re.compile(r"^(\w+?)=(.*)$")
     parameters = {}
+    __slots__ = ("_values", "_generation")
 
     def __init__(self):
-        parameters = {}
-        reflect.accumulateClassDict(self.__class__, "parameters", parameters)
-        self.parameters = parameters
-        super().__init__((n, v.default) for n, v in self.parameters.items())
+        self._values = list(self._schema.defaults)
+        self._generation = next(_generations)
+
+    @property
+    def generation(self):
+        """
+        A number that changes every time a parameter is set to a new value.
+        Values changed in place, like the items of a list, are not seen.
+
+        :rtype: int
+        """
+
+        return self._generation
 
     # dict interface
 
+    def __getitem__(self, name):
+        return self._values[self._schema.index[name]]
+
     def __setitem__(self, name, value):
-        if name not in self.parameters:
+        try:
+            i = self._schema.index[name]
+        except KeyError:
             raise ValueError(_("Parameter %s not found") % name)
-        super(Config, self).__setitem__(name, value)
+        old = self._values[i]
+        self._values[i] = value
+        if old is not value and (type(old) is not type(value) or
+                                 old != value):
+            self._generation = next(_generations)
+
+    def __delitem__(self, name):
+        raise TypeError(_("Parameter %s cannot be removed") % name)
+
+    def __contains__(self, name):
+        return name in self._schema.index
+
+    def __iter__(self):
+        return iter(self._schema.names)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __eq__(self, other):
+        if isinstance(other, Config) and other._schema is self._schema:
+            return self._values == other._values
+        return super().__eq__(other)
+
+    def __repr__(self):
+        return repr(dict(zip(self._schema.names, self._values)))
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        new._values = list(self._values)
+        new._generation = next(_generations)
+        return new
+
+    def __deepcopy__(self, memo):
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        new._values = copy.deepcopy(self._values, memo)
+        new._generation = next(_generations)
+        return new
+
+    def items(self):
+        return list(zip(self._schema.names, self._values))
 
     # NOTE: old interface, values are always strings
     def get(self, name, default=None):
         try:
-            val = dict.__getitem__(self, name)
-            return self.parameters[name].to_string(val)
+            i = self._schema.index[name]
         except KeyError:
             return default
+        return self._schema.parameters[name].to_string(self._values[i])
 
     # XXX: check this interface
     def __getattr__(self, name):
         # return always a string
-        if name not in self.parameters:
+        schema = self._schema
+        if name not in schema.index:
             raise AttributeError(name)
-        return self.parameters[name].to_string(self[name])
+        return schema.parameters[name].to_string(self[name])
 
     def dump(self, write):
         for key, value in sorted(self.items()):
@@ -90,6 +210,13 @@ class Parameter:
     def to_string(self, in_object):
         pass
 
+    def validate(self, value):
+        """
+        Check if value is valid for this parameter.
+
+        :raises ValueError: if the value is not valid.
+        """
+
 
 class Integer(Parameter):
 
@@ -133,6 +260,9 @@ class SpinMixin:
         self.assert_in_range(in_object)
         return super(SpinMixin, self).to_string(in_object)
 
+    def validate(self, value):
+        self.assert_in_range(value)
+
 
 class SpinInt(SpinMixin, Integer):
     pass
@@ -213,14 +343,59 @@ class Base(object):
         return False
 
     def set(self, attrs):
+        self._apply(attrs, {})
+        self.notify_changed()
+
+    def _validate(self, attrs):
+        parameters = self.config.parameters
+        for name, value in attrs.items():
+            try:
+                parameter = parameters[name]
+            except KeyError:
+                raise ValueError(_("Parameter %s not found") % name)
+            parameter.validate(value)
+
+    def _apply(self, attrs, previous):
+        """
+        Set the attributes and call the live-management callbacks.
+
+        :param Dict[str, Any] previous: filled with the previous values of
+            the attributes changed.
+        """
+
         for name, value in attrs.items():
             if value != self.config[name]:
                 logger.info(attribute_set, attr=name, brick=self, value=value)
+                previous.setdefault(name, self.config[name])
                 self.config[name] = value
                 setter = getattr(self, "cbset_" + name, None)
                 if setter:
                     setter(value)
+
+    def _rollback(self, previous):
+        for name, value in previous.items():
+            self.config[name] = value
+
+    def batch_set(self, attrs):
+        """
+        Set all the attributes in one transaction. All the values are
+        validated before any of them is set and a single change notification
+        is fired.
+
+        :raises ValueError: if one of the values is not valid, nothing is
+            set in this case.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        self._validate(attrs)
+        previous = {}
+        try:
+            self._apply(attrs, previous)
+        except:
+            self._rollback(previous)
+            raise
         self.notify_changed()
+        return defer.succeed(None)
 
     def get(self, name):
         try:
@@ -16,6 +16,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+from dataclasses import dataclass
 import os
 import errno
 import sys
@@ -23,6 +24,8 @@ import termios
 import tty
 import re
 import copy
+import functools
+from typing import Any, Optional
 
 from twisted.application import app
 from twisted.internet import defer, task, stdio, error
@@ -32,8 +35,9 @@ from twisted.conch.insults import insults
 from twisted.conch import manhole
 
 from virtualbricks import errors, settings, configfile, console, project, log
-from virtualbricks import link, router, switches, tunnels, tuntaps
+from virtualbricks import link, router, stats, switches, tunnels, tuntaps
 from virtualbricks import virtualmachines, wires
+from virtualbricks.bricks import LazyBrick, is_lazy
 from virtualbricks.errors import NameAlreadyInUseError
 from virtualbricks.events import Event, is_event
 from virtualbricks.observable import Event as Signal, Observable
@@ -53,11 +57,15 @@ create_image = log.Event("Creating new disk image at '{path}'")
 remove_socks = log.Event("Removing socks: {socks}")
 disconnect_plug = log.Event("Disconnecting plug to {sock}")
 remove_brick = log.Event("Removing brick {brick}")
+build_lazy_brick = log.Event("Building brick {brick}")
 endpoint_not_found = log.Event("Endpoint {nick} not found.")
 shut_down = log.Event("Server Shut Down.")
 new_event_ok = log.Event("New event {name} OK")
 uncaught_exception = log.Event("Uncaught exception: {error()}")
 brick_stop = log.Event("Error on brick poweroff")
+poweroff_timeout = log.Event("{brick} did not stop after {step}, escalating")
+dependency_failed = log.Event("Not starting {brick}: {dependency} failed to "
+                              "start")
 
 
 def install_brick_types(registry=None):
@@ -116,6 +124,139 @@ def normalize_brick_name(name):
     return normalized_name
 
 
+def _dependencies(bricks):
+    """
+    Return, for each brick, the set of bricks it is plugged into. Only the
+    bricks in the given sequence are considered.
+
+    :type bricks: List[virtualbricks.bricks.Brick]
+    :rtype: Dict[virtualbricks.bricks.Brick, Set[virtualbricks.bricks.Brick]]
+    """
+
+    members = set(bricks)
+    dependencies = {}
+    for brick in bricks:
+        dependencies[brick] = deps = set()
+        for plug in brick.plugs:
+            if plug.sock is not None:
+                owner = plug.sock.brick
+                if owner is not brick and owner in members:
+                    deps.add(owner)
+    return dependencies
+
+
+def dependency_levels(bricks):
+    """
+    Group the bricks in levels so that every brick depends only on bricks of
+    the previous levels (switches before wires and virtual machines).
+
+    Bricks that are part of a loop cannot be ordered and are all put in the
+    last level.
+
+    :type bricks: Iterable[virtualbricks.bricks.Brick]
+    :rtype: List[List[virtualbricks.bricks.Brick]]
+    """
+
+    bricks = list(bricks)
+    dependencies = _dependencies(bricks)
+    dependents = dict((brick, []) for brick in bricks)
+    pending = {}
+    for brick in bricks:
+        pending[brick] = len(dependencies[brick])
+        for dependency in dependencies[brick]:
+            dependents[dependency].append(brick)
+    levels = []
+    level = [brick for brick in bricks if pending[brick] == 0]
+    while level:
+        levels.append(level)
+        next_level = []
+        for brick in level:
+            for dependent in dependents[brick]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    next_level.append(dependent)
+        level = next_level
+    loop = [brick for brick in bricks if pending[brick] > 0]
+    if loop:
+        levels.append(loop)
+    return levels
+
+
+@dataclass
+class PoweroffResult:
+    """
+    The outcome of the shutdown of one brick.
+
+    ``step`` is the name of the last poweroff step tried (see
+    ``Brick.poweroff_steps``), None if the brick was not running. ``status``
+    is the exit status of the process or the failure if the brick could not be
+    stopped.
+    """
+
+    brick: Any
+    stopped: bool
+    step: Optional[str]
+    elapsed: float
+    status: Any = None
+
+
+class _BrickPoweroff:
+    """Stop one brick, escalating through its poweroff steps."""
+
+    def __init__(self, brick, timeout, clock):
+        self.brick = brick
+        self.timeout = timeout
+        self.clock = clock
+        self.steps = iter(brick.poweroff_steps)
+        self.step = None
+        self.delayed = None
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.started = self.clock.seconds()
+        if not is_running(self.brick):
+            self.brick.cancel_restart()
+            self._done(True, self.brick._last_status)
+        else:
+            self._next_step()
+        return self.deferred
+
+    def _next_step(self, last_failure=None):
+        try:
+            self.step, kwds = next(self.steps)
+        except StopIteration:
+            if last_failure is None:
+                msg = _("Cannot stop '%s'") % self.brick.name
+                last_failure = failure.Failure(errors.BrickRunningError(msg))
+            self._done(False, last_failure)
+            return
+        step = self.step
+        self.delayed = self.clock.callLater(self.timeout, self._timeout, step)
+        deferred = defer.maybeDeferred(self.brick.poweroff, **kwds)
+        deferred.addCallbacks(self._stopped, self._failed, (step, ), None,
+                              (step, ), None)
+
+    def _stopped(self, result, step):
+        if step == self.step and not self.deferred.called:
+            self.delayed.cancel()
+            self._done(True, result[1])
+        return result
+
+    def _failed(self, fail, step):
+        if step == self.step and not self.deferred.called:
+            self.delayed.cancel()
+            self._next_step(fail)
+
+    def _timeout(self, step):
+        logger.warn(poweroff_timeout, brick=self.brick.name, step=step)
+        self._next_step()
+
+    def _done(self, stopped, status):
+        elapsed = self.clock.seconds() - self.started
+        self.deferred.callback(PoweroffResult(self.brick, stopped, self.step,
+                                              elapsed, status))
+
+
 class BrickFactory(object):
     """This is the main class for the core engine.
 
@@ -130,9 +271,19 @@ class BrickFactory(object):
     def __init__(self, quit):
         self.quit_d = quit
         self._bricks = []
+        self._bricks_by_name = {}
+        # the lazy bricks not built yet, by name
+        self._lazy = {}
         self._events = {}
         self.socks = []
+        self._socks_by_name = {}
         self._disk_images = {}
+        self._images_by_path = {}
+        self._image_paths = {}
+        self.graph = link.ConnectionGraph(self.touch)
+        self.generation = 0
+        self._saved_generation = 0
+        self._changed_at = {}
         self.__factories = install_brick_types()
         self.__observable = observable = Observable('quit')
         self.changed = Signal(observable, 'brick-changed')
@@ -146,6 +297,9 @@ class BrickFactory(object):
         self.image_added = Signal(observable, 'image-added')
         self.image_removed = Signal(observable, 'image-removed')
         self.image_changed = Signal(observable, 'image-changed')
+        self.project_changed = Signal(observable, 'project-changed')
+        self.object_changed = Signal(observable, 'object-changed')
+        self.project_saved = Signal(observable, 'project-saved')
 
     def quit(self):
         if any(is_running(brick) for brick in self._bricks):
@@ -171,6 +325,7 @@ class BrickFactory(object):
             self.del_event(e)
 
         del self.socks[:]
+        self._socks_by_name.clear()
         for image in list(self._disk_images.values()):
             self.remove_disk_image(image)
 
@@ -192,9 +347,80 @@ class BrickFactory(object):
     def disconnect(self, name, callback, *args, **kwds):
         self.__observable.remove_observer(name, callback, args, kwds)
 
+    def coalesce_changes(self, coalesce=True):
+        """
+        Deliver the brick-changed, event-changed and image-changed
+        notifications once per reactor turn and per emitter instead of once
+        per attribute change.
+        """
+
+        for name in "brick-changed", "event-changed", "image-changed":
+            self.__observable.set_coalesce(name, coalesce)
+
+    def batch(self):
+        """
+        Return a context manager that holds back the factory's notifications
+        until the end of the block. Use it for bulk edits.
+        """
+
+        return self.__observable.batch()
+
+    def flush_notifications(self):
+        self.__observable.flush()
+
     def set_restore(self, restore):
         pass
 
+    def touch(self, changed=None):
+        """
+        Record a change of the project. Every change of the bricks, events,
+        images and links increments the generation counter.
+
+        :param changed: the brick, event or image that changed, if any.
+        """
+
+        self.generation += 1
+        if changed is not None:
+            self._changed_at[changed] = self.generation
+            self.object_changed.notify(changed)
+        self.project_changed.notify(self)
+
+    def last_changed(self, obj):
+        """
+        Return the generation of the last change of a brick, event or image.
+
+        :rtype: int
+        """
+
+        return self._changed_at.get(obj, 0)
+
+    def is_dirty(self):
+        """
+        Return True if the project changed after it was last saved or
+        restored.
+
+        :rtype: bool
+        """
+
+        return self.generation != self._saved_generation
+
+    def mark_clean(self, generation=None):
+        """
+        Record that the project was saved or restored at the given
+        generation, by default the current one.
+
+        :type generation: Optional[int]
+        """
+
+        if generation is None:
+            generation = self.generation
+        self._saved_generation = generation
+        self.project_saved.notify(self)
+
+    @property
+    def saved_generation(self):
+        return self._saved_generation
+
     # Disk Images
 
     def new_disk_image(self, name, path, description=''):
@@ -209,15 +435,39 @@ class BrickFactory(object):
             raise errors.ImageAlreadyInUseError(path)
         disk_image = virtualmachines.Image(new_name, path, description)
         self._disk_images[new_name] = disk_image
+        self._index_image_path(disk_image)
+        disk_image.changed.connect(self._reindex_image_path)
         disk_image.changed.connect(self.image_changed.notify)
+        disk_image.changed.connect(self.touch)
+        self.touch(disk_image)
         self.image_added.notify(disk_image)
         return disk_image
 
     def remove_disk_image(self, disk_image):
+        disk_image.changed.disconnect(self.touch)
         disk_image.changed.disconnect(self.image_changed.notify)
+        disk_image.changed.disconnect(self._reindex_image_path)
+        self._unindex_image_path(disk_image)
         del self._disk_images[disk_image.get_name()]
+        self._changed_at.pop(disk_image, None)
+        self.touch()
         self.image_removed.notify(disk_image)
 
+    def _index_image_path(self, disk_image):
+        path = disk_image.get_path()
+        self._images_by_path[path] = disk_image
+        self._image_paths[disk_image] = path
+
+    def _unindex_image_path(self, disk_image):
+        path = self._image_paths.pop(disk_image)
+        if self._images_by_path.get(path) is disk_image:
+            del self._images_by_path[path]
+
+    def _reindex_image_path(self, disk_image):
+        if self._image_paths[disk_image] != disk_image.get_path():
+            self._unindex_image_path(disk_image)
+            self._index_image_path(disk_image)
+
     def get_image_by_name(self, name):
         """
         Return a disk image given its name.
@@ -236,9 +486,7 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.virtualmachines.Image]
         """
 
-        for disk_image in self._disk_images.values():
-            if disk_image.get_path() == path:
-                return disk_image
+        return self._images_by_path.get(path)
 
     def iter_disk_images(self):
         """
@@ -271,10 +519,74 @@ class BrickFactory(object):
             raise NameAlreadyInUseError(name)
         brick = BrickClass(self, name)
         self._bricks.append(brick)
+        self._bricks_by_name[name] = brick
+        self.graph.add_brick(brick)
         brick.changed.connect(self.brick_changed.notify)
+        brick.changed.connect(self.touch)
+        self.touch(brick)
         self.brick_added.notify(brick)
         return brick
 
+    def new_lazy_brick(self, type, name, loader):
+        """
+        Add a brick that is built only when it is needed, see
+        :class:`virtualbricks.bricks.LazyBrick`.
+
+        :type type: str
+        :type name: str
+        :rtype: virtualbricks.bricks.LazyBrick
+        :raises: InvalidNameError, InvalidTypeError
+        """
+
+        if type.lower() not in self.__factories:
+            raise errors.InvalidTypeError(_('Invalid brick type %s') % type)
+        name = normalize_brick_name(name)
+        if self.get_brick_by_name(name) is not None:
+            raise NameAlreadyInUseError(name)
+        brick = LazyBrick(self, type, name, loader)
+        self._bricks.append(brick)
+        self._bricks_by_name[name] = brick
+        self._lazy[name] = brick
+        self.touch(brick)
+        self.brick_added.notify(brick)
+        return brick
+
+    def materialize(self, brick):
+        """
+        Return the brick itself or, if it is a lazy brick, the real brick,
+        building it if it is not built yet.
+        """
+
+        if isinstance(brick, LazyBrick):
+            return brick.materialize()
+        return brick
+
+    def build_brick(self, lazy):
+        """
+        Build a lazy brick and put it in the place of the lazy brick. This
+        does not change the project, so a clean project stays clean.
+
+        :type lazy: virtualbricks.bricks.LazyBrick
+        :rtype: virtualbricks.bricks.Brick
+        """
+
+        name = lazy.get_name()
+        index = self._bricks.index(lazy)
+        del self._bricks[index]
+        del self._bricks_by_name[name]
+        del self._lazy[name]
+        self._changed_at.pop(lazy, None)
+        clean = not self.is_dirty()
+        self.brick_removed.notify(lazy)
+        logger.debug(build_lazy_brick, brick=name)
+        brick = lazy.loader.load(self)
+        # new_brick() appended the brick, move it where the lazy brick was
+        self._bricks.remove(brick)
+        self._bricks.insert(index, brick)
+        if clean:
+            self.mark_clean()
+        return brick
+
     def dup_brick(self, brick):
         name = self.next_name("copy_of_" + brick.name)
         new_brick = self.new_brick(brick.get_type(), name)
@@ -288,32 +600,45 @@ class BrickFactory(object):
         return new_brick
 
     def del_brick(self, brick):
+        if is_lazy(brick):
+            self._del_lazy_brick(brick)
+            return
+        brick = self.materialize(brick)
         if is_running(brick):
             msg = "Cannot delete brick {0:n}: brick is running".format(brick)
             raise errors.BrickRunningError(msg)
         logger.info(remove_brick, brick=brick.name)
-        socks = set(brick.socks)
-        if socks:
+        if brick.socks:
             logger.info(remove_socks,
-                        socks=", ".join(s.nickname for s in socks))
-            for _brick in self._bricks:
-                for plug in _brick.plugs:
-                    if plug.configured() and plug.sock in socks:
-                        logger.info(disconnect_plug, sock=plug.sock.nickname)
-                        plug.disconnect()
-            for sock in [s for s in self.socks if s.brick is brick]:
-                self.socks.remove(sock)
+                        socks=", ".join(s.nickname for s in brick.socks))
+            # only the plugs connected to the brick's socks are touched, the
+            # rest of the project is not scanned
+            for sock in brick.socks:
+                for plug in list(sock.plugs):
+                    logger.info(disconnect_plug, sock=sock.nickname)
+                    plug.disconnect()
+                self._remove_sock(getattr(sock, "original", sock))
         for plug in brick.plugs:
             if plug.configured():
                 plug.disconnect()
+        self.graph.remove_brick(brick)
+        brick.changed.disconnect(self.touch)
         brick.changed.disconnect(self.brick_changed.notify)
         self._bricks.remove(brick)
+        if self._bricks_by_name.get(brick.get_name()) is brick:
+            del self._bricks_by_name[brick.get_name()]
+        self._changed_at.pop(brick, None)
+        self.touch()
         self.brick_removed.notify(brick)
 
-    def _get_element_by_name(self, name, sequence):
-        for item in sequence:
-            if item.get_name() == name:
-                return item
+    def _del_lazy_brick(self, brick):
+        logger.info(remove_brick, brick=brick.name)
+        self._bricks.remove(brick)
+        del self._bricks_by_name[brick.name]
+        del self._lazy[brick.name]
+        self._changed_at.pop(brick, None)
+        self.touch()
+        self.brick_removed.notify(brick)
 
     def get_brick_by_name(self, name):
         """
@@ -323,11 +648,21 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.bricks.Brick]
         """
 
-        return self._get_element_by_name(name, self.iter_bricks())
+        return self._bricks_by_name.get(name)
 
     def iter_bricks(self):
         return iter(self._bricks)
 
+    def settings_changed(self):
+        """
+        The settings changed, the bricks must build their command lines
+        again. The lazy bricks have not built them yet.
+        """
+
+        for brick in self._bricks:
+            if not is_lazy(brick):
+                brick.invalidate_args()
+
     # Events
 
     def new_event(self, name):
@@ -346,6 +681,8 @@ class BrickFactory(object):
         logger.debug(new_event_ok, name=norm_name)
         self._events[norm_name] = event
         event.changed.connect(self.event_changed.notify)
+        event.changed.connect(self.touch)
+        self.touch(event)
         self.event_added.notify(event)
         return event
 
@@ -357,8 +694,11 @@ class BrickFactory(object):
 
     def del_event(self, event):
         event.poweroff()
+        event.changed.disconnect(self.touch)
         event.changed.disconnect(self.event_changed.notify)
         del self._events[event.get_name()]
+        self._changed_at.pop(event, None)
+        self.touch()
         self.event_removed.notify(event)
 
     def get_event_by_name(self, name):
@@ -369,7 +709,7 @@ class BrickFactory(object):
         :rtype: Optional[virtualbricks.events.Event]
         """
 
-        return self._disk_images.get(name)
+        return self._events.get(name)
 
     def iter_events(self):
         return iter(self._events.values())
@@ -379,6 +719,7 @@ class BrickFactory(object):
         orig_name = name
         while self.is_in_use(name):
             name = f'{orig_name}.{c}'
+            c += 1
         return name
 
     def is_in_use(self, name):
@@ -403,6 +744,7 @@ class BrickFactory(object):
         return None
 
     def rename(self, brick, name):
+        brick = self.materialize(brick)
         prev_name = brick.get_name()
         new_name = self.normalize_name(name)
         # Update indexes
@@ -412,9 +754,40 @@ class BrickFactory(object):
         elif is_disk_image(brick):
             self._disk_images[new_name] = brick
             del self._disk_images[prev_name]
+        else:
+            self._bricks_by_name[new_name] = brick
+            del self._bricks_by_name[prev_name]
+        socks = [(sock, sock.nickname) for sock in getattr(brick, "socks", ())]
         brick.set_name(new_name)
+        # not every set_name() reports the change
+        self.touch(brick)
+        if brick in self.graph:
+            # their links refer to the socks of the brick by name
+            for dependent in self.graph.dependents(brick):
+                self.touch(dependent)
+        renamed = dict((nickname, sock.nickname) for sock, nickname in socks
+                       if sock.nickname != nickname)
+        if renamed:
+            self._rename_lazy_links(renamed)
         return prev_name
 
+    def _rename_lazy_links(self, renamed):
+        """
+        Update the links of the lazy bricks, still stored as read, to the
+        new names of the socks.
+
+        :param Dict[str, str] renamed: the new nickname of every sock renamed.
+        """
+
+        for lazy in self._lazy.values():
+            links = lazy.loader.links
+            if any(link.sockname in renamed for link in links):
+                lazy.loader.links = [
+                    link._replace(sockname=renamed.get(link.sockname,
+                                                       link.sockname))
+                    for link in links]
+                self.touch(lazy)
+
     def normalize_name(self, name):
         """
         Return the new normalized name or raise InvalidNameError.
@@ -430,28 +803,198 @@ class BrickFactory(object):
             raise errors.NameAlreadyInUseError(normalized_name)
         return normalized_name
 
+    def poweron_all(self, bricks=None, max_concurrency=None):
+        """
+        Start the bricks level by level, following the topology: a brick is
+        started only when all the bricks it is plugged into are running. The
+        bricks of the same level are started concurrently, the bricks of a
+        loop one at a time.
+
+        The bricks plugged into are started even if they are not in
+        ``bricks``, as Brick.poweron() would do.
+
+        :param bricks: the bricks to start, all the bricks if None.
+        :type bricks: Optional[Iterable[virtualbricks.bricks.Brick]]
+        :param max_concurrency: the maximum number of bricks starting at the
+            same time, unlimited if None.
+        :type max_concurrency: Optional[int]
+        :return: a list of (success, result) tuples, one for each brick in the
+            same order of ``bricks``, as returned by DeferredList.
+        :rtype: twisted.internet.defer.Deferred[List[Tuple[bool, Any]]]
+        """
+
+        if bricks is None:
+            bricks = self._bricks
+        bricks = [self.materialize(brick) for brick in list(bricks)]
+        # every brick starts the bricks it is plugged into (see
+        # Plug.connected()), they must be running before the bricks of the
+        # same level ask for them concurrently
+        members = self._with_dependencies(bricks)
+        dependencies = _dependencies(members)
+        results = {}
+        if max_concurrency is None:
+            start = defer.maybeDeferred
+        else:
+            start = defer.DeferredSemaphore(max_concurrency).run
+
+        def collect(level_results, level):
+            for brick, result in zip(level, level_results):
+                results[brick] = result
+
+        def start_brick(brick):
+            for dependency in dependencies[brick]:
+                if dependency in results and not results[dependency][0]:
+                    logger.warn(dependency_failed, brick=brick.name,
+                                dependency=dependency.name)
+                    msg = _("Cannot start '%s': '%s' is not running") % (
+                        brick.name, dependency.name)
+                    return defer.fail(errors.NotConnectedError(msg))
+            return start(brick.poweron)
+
+        def start_bricks(ignore, level):
+            deferred = defer.DeferredList([start_brick(b) for b in level],
+                                          consumeErrors=True)
+            return deferred.addCallback(collect, level)
+
+        def start_level(ignore, level):
+            loop = set(level)
+            if any(dependencies[brick] & loop for brick in level):
+                # the bricks of a loop start each other, start them one at
+                # a time or the same brick could be started twice
+                deferred = defer.succeed(None)
+                for brick in level:
+                    deferred.addCallback(start_bricks, [brick])
+                return deferred
+            return start_bricks(None, level)
+
+        deferred = defer.succeed(None)
+        for level in dependency_levels(members):
+            deferred.addCallback(start_level, level)
+        deferred.addCallback(lambda ignore: [results[b] for b in bricks])
+        return deferred
+
+    def _with_dependencies(self, bricks):
+        """
+        Return the bricks followed by the bricks they are plugged into,
+        directly or not, that are not in the list.
+
+        :rtype: List[virtualbricks.bricks.Brick]
+        """
+
+        members = dict.fromkeys(bricks)
+        queue = list(bricks)
+        while queue:
+            for dependency in self.graph.dependencies(queue.pop()):
+                if dependency not in members:
+                    members[dependency] = None
+                    queue.append(dependency)
+        return list(members)
+
+    def poweroff_all(self, bricks=None, timeout=30, max_concurrency=None,
+                     clock=None):
+        """
+        Stop the bricks in the reverse order of poweron_all(): the bricks
+        plugged into a brick are stopped before it. The bricks of the same
+        level are stopped concurrently.
+
+        Every brick is given ``timeout`` seconds for each of its poweroff
+        steps (for example powerdown, TERM and KILL) before escalating to the
+        next one.
+
+        :param bricks: the bricks to stop, all the bricks if None.
+        :type bricks: Optional[Iterable[virtualbricks.bricks.Brick]]
+        :param float timeout: the deadline of every poweroff step.
+        :param max_concurrency: the maximum number of bricks stopping at the
+            same time, unlimited if None.
+        :type max_concurrency: Optional[int]
+        :param clock: the clock used to schedule the deadlines.
+        :type clock: Optional[twisted.internet.interfaces.IReactorTime]
+        :return: a result for each brick in the same order of ``bricks``.
+        :rtype: twisted.internet.defer.Deferred[List[PoweroffResult]]
+        """
+
+        if bricks is None:
+            bricks = self._bricks
+        if clock is None:
+            from twisted.internet import reactor as clock
+        bricks = list(bricks)
+        results = {}
+
+        def stop(brick):
+            return _BrickPoweroff(brick, timeout, clock).start()
+
+        if max_concurrency is not None:
+            stop = functools.partial(
+                defer.DeferredSemaphore(max_concurrency).run, stop)
+
+        def collect(level_results, level):
+            for brick, result in zip(level, level_results):
+                results[brick] = result
+
+        def stop_level(ignore, level):
+            deferred = defer.gatherResults([stop(brick) for brick in level])
+            return deferred.addCallback(collect, level)
+
+        for brick in bricks:
+            if is_lazy(brick):
+                # a brick never built was never started
+                results[brick] = PoweroffResult(brick, True, None, 0.0)
+        levels = dependency_levels(b for b in bricks if b not in results)
+        deferred = defer.succeed(None)
+        for level in reversed(levels):
+            deferred.addCallback(stop_level, level)
+        deferred.addCallback(lambda ignore: [results[b] for b in bricks])
+        return deferred
+
     def new_plug(self, brick):
-        return link.Plug(brick)
+        return link.Plug(brick, self.graph)
 
     def new_sock(self, brick, name=""):
         sock = link.Sock(brick, name)
         self.socks.append(sock)
+        self._socks_by_name.setdefault(name, sock)
+        return sock
+
+    def _remove_sock(self, sock):
+        self.socks.remove(sock)
+        if self._socks_by_name.get(sock.nickname) is sock:
+            del self._socks_by_name[sock.nickname]
+
+    def rename_sock(self, sock, nickname):
+        """Change the nickname of a sock and keep the lookup index updated.
+
+        :type sock: virtualbricks.link.Sock
+        :type nickname: str
+        """
+
+        if self._socks_by_name.get(sock.nickname) is sock:
+            del self._socks_by_name[sock.nickname]
+        sock.nickname = nickname
+        self._socks_by_name.setdefault(nickname, sock)
+
+    def _find_sock(self, name):
+        sock = self._socks_by_name.get(name)
+        if sock is None and self._lazy:
+            # the nickname of a sock starts with the name of its brick, build
+            # the lazy brick that owns it
+            i = name.find("_")
+            while i > 0:
+                owner = self._lazy.get(name[:i])
+                if owner is not None:
+                    owner.materialize()
+                    return self._socks_by_name.get(name)
+                i = name.find("_", i + 1)
         return sock
 
     def get_sock_by_name(self, name):
         if name == "_hostonly":
             return virtualmachines.hostonly_sock
-        for sock in self.socks:
-            if sock.nickname == name:
-                return sock
+        return self._find_sock(name)
 
     def connect_to(self, brick, nick):
-        endpoint = None
         if not nick:
             return None
-        for n in self.socks:
-            if n.nickname == nick:
-                endpoint = n
+        endpoint = self._find_sock(nick)
         if endpoint is not None:
             return brick.connect(endpoint)
         else:
@@ -541,12 +1084,66 @@ class Console(basic.LineOnlyReceiver):
             stdio.StandardIO(self)
 
 
+def autosave(factory):
+    """
+    Save the project, in a thread, only if it changed after the last save.
+
+    :rtype: Optional[twisted.internet.defer.Deferred]
+    """
+
+    if factory.is_dirty():
+        return configfile.safe_save_async(factory)
+    return None
+
+
 def AutosaveTimer(factory, interval=180):
-    l = task.LoopingCall(configfile.safe_save, factory)
+    l = task.LoopingCall(autosave, factory)
     l.start(interval, now=False)
     return l
 
 
+class SaveOnChange:
+    """
+    Save the project a few seconds after it changes. Every change postpones
+    the save by ``delay`` seconds but the save is never postponed more than
+    ``max_delay`` seconds after the first unsaved change.
+    """
+
+    delayed = None
+
+    def __init__(self, factory, delay=5, max_delay=60, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.factory = factory
+        self.delay = delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self._deadline = None
+
+    def start(self):
+        self.factory.project_changed.connect(self.changed)
+        return self
+
+    def stop(self):
+        self.factory.project_changed.disconnect(self.changed)
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+
+    def changed(self, factory):
+        now = self.clock.seconds()
+        if self.delayed is None or not self.delayed.active():
+            self._deadline = now + self.max_delay
+            self.delayed = self.clock.callLater(
+                min(self.delay, self.max_delay), self.save)
+        else:
+            self.delayed.reset(max(0, min(self.delay, self._deadline - now)))
+
+    def save(self):
+        self.delayed = None
+        return autosave(self.factory)
+
+
 class AppLogger(app.AppLogger):
 
     observer = None
@@ -673,7 +1270,15 @@ class Application:
         reactor.addSystemEventTrigger("before", "shutdown",
                                       project.manager.save_current, factory)
         reactor.addSystemEventTrigger("before", "shutdown", self.logger.stop)
-        AutosaveTimer(factory)
+        autosave_mode = settings.get("autosave")
+        if autosave_mode == "change":
+            SaveOnChange(factory).start()
+        elif autosave_mode == "journal":
+            configfile.Journal(factory).start()
+        else:
+            AutosaveTimer(factory)
+        if float(settings.get("stats_interval")) > 0:
+            stats.collector(factory).start()
         if not self.config["noterm"] and not self.config["daemon"]:
             namespace = self.get_namespace()
             namespace["factory"] = factory
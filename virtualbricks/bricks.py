@@ -18,18 +18,18 @@
 
 
 import os
-import collections
 import functools
 import locale
-import re
 
 from twisted.internet import protocol, reactor, error, defer
 from zope.interface import implementer
 
-from virtualbricks import base, errors, settings, log, interfaces
+from virtualbricks import (base, errors, settings, log, interfaces, mgmt,
+                           supervisor)
 from virtualbricks.base import (Config as _Config, Parameter, String, Integer,
                                 SpinInt, Float, SpinFloat, Boolean, Object,
                                 ListOf)
+from virtualbricks.mgmt import ManagementClient
 from virtualbricks.spawn import abspath_vde
 
 
@@ -54,7 +54,13 @@ open_console = log.Event("Opening console for {name}\n%{args}\n")
 console_done = log.Event("Console terminated\n{status}")
 console_terminated = log.Event("Console terminated\n{status}\nProcess stdout:"
                                "\n{out}\nProcess stderr:\n{err}\n")
-invalid_ack = log.Event("ACK received but no command sent.")
+batch_rolled_back = log.Event("Configuration of {brick} rolled back: "
+                              "{error}")
+send_failed = log.Event("Cannot send a command to {brick}")
+socket_unreachable = log.Event("Management socket {path} of {brick} does "
+                               "not accept connections: {error}")
+invalid_restart_policy = log.Event("Invalid restart policy {policy} for "
+                                   "{brick}, the brick is not supervised")
 
 
 class ProcessLogger(object):
@@ -86,8 +92,8 @@ class Process(protocol.ProcessProtocol):
 
     def processEnded(self, status):
         if status.check(error.ProcessTerminated):
-            status = " ".join(status.value.args)
-            self.logger.error(process_terminated, status=status)
+            self.logger.error(process_terminated,
+                              status=" ".join(status.value.args))
         else:
             assert status.check(error.ProcessDone)
             self.logger.info(process_terminated, status="Done")
@@ -111,6 +117,14 @@ class Process(protocol.ProcessProtocol):
     def write(self, data):
         self.transport.write(data)
 
+    def write_batch(self, commands):
+        self.transport.writeSequence(commands)
+        return defer.succeed(None)
+
+    def send_command(self, cmd):
+        self.write(cmd)
+        return defer.succeed(None)
+
 
 @implementer(interfaces.IProcess)
 class FakeProcess:
@@ -126,64 +140,28 @@ class FakeProcess:
     def write(self, data):
         pass
 
+    def write_batch(self, commands):
+        return defer.succeed(None)
 
-class VDEProcessProtocol(Process):
-    """
-    Handle the VDE management console.
+    def send_command(self, cmd):
+        return defer.succeed(None)
 
-    Commands are serialized, until an ACK is received, the next command is not
-    sent.
 
-    @cvar delimiter: The line-ending delimiter to use.
+class VDEProcessProtocol(ManagementClient, Process):
+    """
+    Handle the VDE management console attached to the stdin of a brick.
     """
 
-    _buffer = b""
-    delimiter = b"\n"
-    prompt = re.compile(rb"^vde(?:\[[^]]*\]:|\$) ", re.MULTILINE)
-    PIPELINE_SIZE = 1
-
-    def __init__(self, brick):
+    def __init__(self, brick, pipeline_size=None, timeout=None):
         Process.__init__(self, brick)
-        self.queue = collections.deque()
-
-
-    def _data_received(self, data):
-        """
-        Translates bytes into lines, and calls _ack_received.
-        """
-
-        assert isinstance(data, bytes)
-        acks = self.prompt.split(self._buffer + data)
-        self._buffer = acks.pop(-1)
-        for ack in acks:
-            self._ack_received(ack)
-
-    def _ack_received(self, ack):
-        self.logger.info(ack)
-        try:
-            self.queue.popleft()
-        except IndexError:
-            self.logger.warn(invalid_ack)
-            self.transport.loseConnection()
-        else:
-            if len(self.queue):
-                self._send_command()
-
-    def _send_command(self):
-        cmd = self.queue[0]
-        self.logger.info(cmd)
-        if cmd.endswith(self.delimiter):
-            return self.transport.write(cmd)
-        else:
-            return self.transport.writeSequence((cmd, self.delimiter))
+        ManagementClient.__init__(self, pipeline_size, timeout)
 
     def outReceived(self, data):
-        self._data_received(data)
+        self.data_received(data)
 
-    def write(self, cmd):
-        self.queue.append(cmd)
-        if 0 < len(self.queue) <= self.PIPELINE_SIZE:
-            self._send_command()
+    def processEnded(self, status):
+        self.fail_pending(status)
+        Process.processEnded(self, status)
 
 
 class TermProtocol(protocol.ProcessProtocol):
@@ -219,7 +197,11 @@ class Config(_Config):
 
     parameters = {
         "pon_vbevent": String(""),
-        "poff_vbevent": String("")
+        "poff_vbevent": String(""),
+        "restart_policy": String("never"),
+        "restart_max": Integer(5),
+        "restart_window": Float(60.0),
+        "restart_dependents": Boolean(False)
     }
 
 
@@ -231,8 +213,15 @@ class Brick(base.Base):
     _started_d = None
     _exited_d = None
     _last_status = None
+    _poweroff_requested = False
+    # the process was started by this instance of virtualbricks
+    _spawned = False
+    supervisor = None
     process_protocol = VDEProcessProtocol
     config_factory = Config
+    # The steps of a forced shutdown, from the most graceful to the most
+    # brutal: a name and the keyword arguments for poweroff().
+    poweroff_steps = (("term", {}), ("kill", {"kill": True}))
 
     @property
     def pid(self):
@@ -240,12 +229,81 @@ class Brick(base.Base):
             return -1
         return self.proc.pid
 
+    _batch = None
+
     def __init__(self, factory, name):
         base.Base.__init__(self, factory, name)
         self.plugs = []
         self.socks = []
         self.config_socks = []
 
+    def _apply(self, attrs, previous):
+        base.Base._apply(self, attrs, previous)
+        if any(name.startswith("restart_") for name in previous):
+            self._supervise()
+
+    def _rollback(self, previous):
+        base.Base._rollback(self, previous)
+        if any(name.startswith("restart_") for name in previous):
+            self._supervise()
+
+    def _supervise(self):
+        """Install the supervisor described by the configuration."""
+
+        try:
+            policy = supervisor.policy_by_name(self.config["restart_policy"])
+        except ValueError:
+            logger.error(invalid_restart_policy, brick=self,
+                         policy=self.config["restart_policy"])
+            policy = supervisor.RestartPolicy.NEVER
+        supervisor.supervise(
+            self, policy, max_restarts=self.config["restart_max"],
+            window=self.config["restart_window"],
+            restart_dependents=self.config["restart_dependents"])
+
+    def batch_set(self, attrs):
+        """
+        Set all the attributes in one transaction. All the values are
+        validated before any of them is set, the live-management commands are
+        sent to the running process in one burst and a single change
+        notification is fired when the process acknowledged all of them.
+
+        If the process rejects a command, the configuration is rolled back to
+        the previous values and the Deferred fails with
+        :class:`virtualbricks.errors.CommandRejectedError`.
+
+        :raises ValueError: if one of the values is not valid, nothing is
+            set in this case.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        self._validate(attrs)
+        previous = {}
+        self._batch = commands = []
+        try:
+            self._apply(attrs, previous)
+        except:
+            self._rollback(previous)
+            raise
+        finally:
+            self._batch = None
+        if not commands or not self._is_managed():
+            self.notify_changed()
+            return defer.succeed(None)
+
+        def rollback(fail):
+            if fail.check(errors.BrickNotRunningError):
+                # the socket was a leftover, the brick is not running
+                self.notify_changed()
+                return None
+            self._rollback(previous)
+            logger.warn(batch_rolled_back, brick=self, error=fail.value)
+            return fail
+
+        deferred = self._write_batch(commands)
+        deferred.addCallbacks(lambda ignore: self.notify_changed(), rollback)
+        return deferred
+
     # IBrick interface
 
     def poweron(self):
@@ -259,6 +317,7 @@ class Brick(base.Base):
             return defer.fail(errors.NotConnectedError(
                 _("Cannot start '%s': not connected") % self.name))
 
+        self._poweroff_requested = False
         self._started_d = started = defer.Deferred()
         self._exited_d = defer.Deferred()
         d = self._check_links()
@@ -282,9 +341,11 @@ class Brick(base.Base):
         return started
 
     def poweroff(self, kill=False):
+        self.cancel_restart()
         if self.proc is None:
             return defer.succeed((self, self._last_status))
         logger.info(shutdown_brick, name=self.name, pid=self.proc.pid)
+        self._poweroff_requested = True
         try:
             self.proc.signal_process("KILL" if kill else "TERM")
         except OSError as e:
@@ -293,6 +354,15 @@ class Brick(base.Base):
             pass
         return self._exited_d
 
+    def cancel_restart(self):
+        """
+        Cancel the restart scheduled by the supervisor, a brick stopped by
+        the user must not come back after the delay.
+        """
+
+        if self.supervisor is not None:
+            self.supervisor.stop()
+
     def get_parameters(self):
         raise NotImplementedError("Bricks.get_parameters() not implemented")
 
@@ -322,6 +392,28 @@ class Brick(base.Base):
         exited, self._exited_d = self._exited_d, None
         exited.callback((self, status))
         self.notify_changed()
+        if self.supervisor is not None:
+            self.supervisor.process_ended(status, self._poweroff_requested)
+
+    def restart(self):
+        """
+        Stop the brick, if it is running, and start it again.
+
+        :rtype: twisted.internet.defer.Deferred[Brick]
+        """
+
+        deferred = self.poweroff()
+        deferred.addCallback(lambda ignore: self.poweron())
+        return deferred
+
+    def dependents(self):
+        """
+        Return the bricks plugged into the socks of this brick.
+
+        :rtype: List[Brick]
+        """
+
+        return self.factory.graph.dependents(self)
 
     # Interal interface
 
@@ -341,6 +433,9 @@ class Brick(base.Base):
     def prog(self):
         raise NotImplementedError(_("Brick.prog() not implemented."))
 
+    def invalidate_args(self):
+        """Forget the command line built, if it is cached."""
+
     def build_cmd_line(self):
         # TODO: documents the behavior of all cases (#, *, etc.)
         res = []
@@ -362,6 +457,16 @@ class Brick(base.Base):
         #print(res)
         return res
 
+    def plan(self):
+        """
+        Return the command line of the brick, without starting it or
+        changing anything on disk.
+
+        :rtype: twisted.internet.defer.Deferred[List[str]]
+        """
+
+        return defer.maybeDeferred(self.args)
+
     def _poweron(self, ignore):
 
         def start_process(value):
@@ -372,6 +477,7 @@ class Brick(base.Base):
                 prog = settings.get("sudo")
                 args = [settings.get("sudo"), "--"] + args
             self.proc = self.process_protocol(self)
+            self._spawned = True
             reactor.spawnProcess(self.proc, prog, args, os.environ)
 
         l = [defer.maybeDeferred(self.prog), defer.maybeDeferred(self.args)]
@@ -426,10 +532,94 @@ class Brick(base.Base):
         logger.info(open_console, name=self.name, args=" ".join(args))
         reactor.spawnProcess(TermProtocol(), term, args, os.environ)
 
+    def send_command(self, cmd):
+        """
+        Send a management command to the running process. If the process was
+        not started by this instance of virtualbricks, the command is sent
+        through the management socket.
+
+        :type cmd: bytes
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.proc is not None:
+            return self.proc.send_command(cmd)
+        return self._connect_management().addCallback(
+            lambda proto: proto.send_command(cmd))
+
     def send(self, data):
         assert isinstance(data, bytes)
-        if self.proc:
+        if self._batch is not None:
+            self._batch.append(data)
+        elif self.proc:
             self.proc.write(data)
+        elif self._management_path() is not None:
+            deferred = self._connect_management()
+            deferred.addCallbacks(
+                lambda proto: proto.send_command(data),
+                lambda fail: fail.trap(errors.BrickNotRunningError))
+            deferred.addErrback(logger.failure_eb, send_failed,
+                                brick=self.name)
+
+    def _management_path(self):
+        """
+        Return the management socket of a process not started by this
+        instance of virtualbricks, None if there is none. The socket can be
+        a leftover of a process that died, see _connect_management().
+
+        :rtype: Optional[str]
+        """
+
+        if (not self._spawned and
+                issubclass(self.process_protocol, VDEProcessProtocol) and
+                os.path.exists(self.console())):
+            return self.console()
+        return None
+
+    def _connect_management(self):
+        """
+        Connect to the management socket of a process not started by this
+        instance of virtualbricks.
+
+        :return: a Deferred fired with the connection or failed with
+            BrickNotRunningError if there is no socket or if it does not
+            accept connections.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        path = self._management_path()
+        if path is None:
+            return defer.fail(errors.BrickNotRunningError(self.name))
+
+        def unreachable(fail):
+            logger.info(socket_unreachable, brick=self.name, path=path,
+                        error=fail.getErrorMessage())
+            raise errors.BrickNotRunningError(self.name)
+
+        return mgmt.pool.connect(path, retries=0).addErrback(unreachable)
+
+    def _is_managed(self):
+        """
+        Return True if the commands can reach the process, started by this
+        instance or through its management socket.
+
+        :rtype: bool
+        """
+
+        return self.proc is not None or self._management_path() is not None
+
+    def _write_batch(self, commands):
+        """
+        Send the commands in one burst to the process, through the
+        management socket if it was not started by this instance.
+
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if self.proc is not None:
+            return self.proc.write_batch(commands)
+        return self._connect_management().addCallback(
+            lambda proto: proto.write_batch(commands))
 
     def get_state(self):
         """return state of the brick"""
@@ -453,3 +643,85 @@ class Brick(base.Base):
 
     def __repr__(self):
         return "<{0.type} {0.name}>".format(self)
+
+
+class LazyBrick:
+    """
+    A brick of a project restored lazily. Only the type and the name of the
+    brick are known, the brick is built by the factory the first time
+    anything else is needed; from then on every access is forwarded to the
+    brick.
+
+    :param loader: an object with a ``load(factory)`` method, that builds the
+        brick, a ``save_to(fileobj)`` method, that saves the brick as it was
+        read, and the ``socks`` and ``links`` lists of the brick, as
+        :class:`virtualbricks._configparser.Link`.
+    """
+
+    def __init__(self, factory, type, name, loader):
+        attrs = self.__dict__
+        attrs["factory"] = factory
+        attrs["type"] = type
+        attrs["_name"] = name
+        attrs["loader"] = loader
+        attrs["brick"] = None
+
+    def get_type(self):
+        return self.type
+
+    def get_name(self):
+        if self.brick is not None:
+            return self.brick.name
+        return self._name
+
+    name = property(get_name)
+
+    @property
+    def proc(self):
+        if self.brick is not None:
+            return self.brick.proc
+        return None
+
+    def get_state(self):
+        if self.brick is not None:
+            return self.brick.get_state()
+        # a brick not built yet cannot be running
+        return _("off")
+
+    def materialize(self):
+        """
+        Build the brick, if it is not already built, and return it.
+
+        :rtype: Brick
+        """
+
+        if self.brick is None:
+            self.__dict__["brick"] = self.factory.build_brick(self)
+        return self.brick
+
+    def save_to(self, fileobj):
+        if self.brick is not None:
+            self.brick.save_to(fileobj)
+        else:
+            self.loader.save_to(fileobj)
+
+    def __isrunning__(self):
+        return self.proc is not None
+
+    def __getattr__(self, name):
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialize(), name, value)
+
+    def __format__(self, format_string):
+        return format(self.materialize(), format_string)
+
+    def __repr__(self):
+        return "<lazy {0} {1}>".format(self.type, self.get_name())
+
+
+def is_lazy(brick):
+    """Return True if the brick is a LazyBrick not yet built."""
+
+    return isinstance(brick, LazyBrick) and brick.brick is None
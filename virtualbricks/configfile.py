@@ -16,15 +16,19 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+import json
 import os
 import os.path
 import errno
 import traceback
 import contextlib
-from twisted.python import filepath
+from twisted.internet import defer, threads
+from twisted.python import failure, filepath
 from zope.interface import implementer
 
-from virtualbricks import interfaces, settings, _configparser, log
+from virtualbricks import errors, interfaces, settings, _configparser, log
+from virtualbricks.bricks import is_lazy
 
 
 if False:  # pyflakes
@@ -32,8 +36,9 @@ if False:  # pyflakes
 
 
 __all__ = ["BrickBuilder", "ConfigFile", "EventBuilder", "ImageBuilder",
-           "LinkBuilder", "SockBuilder", "log_events", "restore", "safe_save",
-           "save"]
+           "JSON", "Journal", "LinkBuilder", "SockBuilder", "TEXT",
+           "log_events", "replay_journal", "restore", "safe_save",
+           "safe_save_async", "save", "save_async"]
 
 
 logger = log.Logger()
@@ -54,7 +59,13 @@ skip_image = log.Event("Skipping disk image, name '{name}' already in use")
 skip_image_noa = log.Event("Cannot access image file, skipping")
 config_dump = log.Event("CONFIG DUMP on {path}")
 open_project = log.Event("Open project at {path}")
+json_project_loaded = log.Event("Loaded {sections} sections and {links} "
+                                "links from a JSON project")
 config_save_error = log.Event("Error while saving configuration file")
+journal_replayed = log.Event("Replayed {changes} changes from the journal "
+                             "of {filename}")
+journal_truncated = log.Event("The journal {filename} is truncated at line "
+                              "{line}")
 
 log_events = [link_type_error,
               brick_not_found,
@@ -69,7 +80,10 @@ log_events = [link_type_error,
               skip_image_noa,
               config_dump,
               open_project,
-              config_save_error]
+              config_save_error,
+              json_project_loaded,
+              journal_replayed,
+              journal_truncated]
 
 
 @contextlib.contextmanager
@@ -113,6 +127,7 @@ def restore_backup(filename, fbackup):
         logger.warn(backup_restored, hide_to_user=True)
     if created:
         filename_back.remove()
+    replay_journal(filename)
 
 
 @contextlib.contextmanager
@@ -131,7 +146,7 @@ class SockBuilder:
         brick = factory.get_brick_by_name(sock.owner)
         if brick:
             brick.add_sock(sock.mac, sock.model)
-            logger.info(link_added, type=sock.type, brick=sock.owner)
+            logger.debug(link_added, type=sock.type, brick=sock.owner)
         else:
             logger.warn(brick_not_found, brick=sock.owner, line="|".join(sock))
 
@@ -145,7 +160,7 @@ class LinkBuilder:
             sock = factory.get_sock_by_name(link.sockname)
             if sock:
                 brick.connect(sock, link.mac, link.model)
-                logger.info(link_added, type=link.type, brick=link.owner)
+                logger.debug(link_added, type=link.type, brick=link.owner)
             else:
                 logger.warn(sock_not_found, sockname=link.sockname,
                             line="|".join(link))
@@ -207,6 +222,7 @@ class BrickBuilder:
         brick = factory.new_brick(self.type, self.name)
         with freeze_notify(brick):
             brick.load_from(section)
+        return brick
 
 
 @implementer(interfaces.IBuilder)
@@ -295,7 +311,158 @@ interfaces.registerAdapter(compatible_brick_builder_factory,
                            _configparser.Section, interfaces.IBuilder)
 
 
+class _LazySection:
+    """
+    The section, the socks and the links of a brick restored lazily, see
+    :class:`virtualbricks.bricks.LazyBrick`.
+    """
+
+    def __init__(self, builder, section):
+        self.builder = builder
+        self.section = section
+        self.socks = []
+        self.links = []
+
+    def load(self, factory):
+        brick = self.builder.load_from(factory, self.section)
+        for sock in self.socks:
+            SockBuilder().load_from(factory, sock)
+        for link in self.links:
+            LinkBuilder().load_from(factory, link)
+        return brick
+
+    def save_to(self, fileobj):
+        fileobj.write(_section_text(self.section))
+
+
+def _section_text(section):
+    """Return a parsed section as it is written in a project file."""
+
+    lines = list(section.lines)
+    while lines and not lines[-1].strip():
+        lines.pop()
+    lines.append("")
+    return "[{0}:{1}]\n{2}\n".format(section.type, section.name,
+                                     "\n".join(lines))
+
+
+def _write_link(fileobj, link):
+    fileobj.write("|".join(link) + "\n")
+
+
+def _brick_links(brick):
+    """Return the sock lines and the link lines of a brick."""
+
+    if is_lazy(brick):
+        # the links of the lazy bricks are saved as they were read
+        return ("".join("|".join(sock) + "\n" for sock in brick.loader.socks),
+                "".join("|".join(link) + "\n" for link in brick.loader.links))
+    socks = ""
+    if brick.get_type() == "Qemu":
+        t = "sock|{s.brick.name}|{s.nickname}|{s.model}|{s.mac}\n"
+        socks = "".join(t.format(s=sock) for sock in brick.socks)
+    buf = io.StringIO()
+    for plug in brick.plugs:
+        plug.save_to(buf)
+    return socks, buf.getvalue()
+
+
+def _write_links(bricks, fileobj):
+    """Write the socks of the bricks and then their links."""
+
+    links = [_brick_links(brick) for brick in bricks]
+    fileobj.writelines(socks for socks, plugs in links)
+    fileobj.writelines(plugs for socks, plugs in links)
+
+
+TEXT = "text"
+JSON = "json"
+JSON_SCHEMA_VERSION = 1
+
+
+def _sections(factory):
+    """Return the objects saved as sections, in the order they are saved."""
+
+    sections = list(factory.iter_disk_images())
+    sections.extend(factory.iter_events())
+    sections.extend(factory.bricks)
+    return sections
+
+
+class _PrefixedReader:
+    """A stream that returns the given text and then the rest of fileobj."""
+
+    def __init__(self, head, fileobj):
+        self._head = head
+        self._fileobj = fileobj
+
+    def read(self, size=-1):
+        if self._head:
+            head, self._head = self._head, ""
+            return head
+        return self._fileobj.read(size)
+
+
+def _write_file(fp, chunks, fsync):
+    """
+    Replace the file with the given strings. This runs in a worker thread.
+    """
+
+    with backup(fp, fp.sibling(fp.basename() + "~")):
+        tmpfile = fp.sibling("." + fp.basename() + ".asav")
+        with open(tmpfile.path, "wb") as fd:
+            fd.write("".join(chunks).encode("utf-8"))
+            if fsync:
+                fd.flush()
+                os.fsync(fd.fileno())
+        tmpfile.moveTo(fp)
+        if fsync:
+            dirfd = os.open(fp.dirname(), os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+
+
+class _AsyncSave:
+    """A save running in a thread and the requests arrived meanwhile."""
+
+    def __init__(self):
+        self.waiting = []
+        self.factory = None
+        self.fsync = False
+
+
 class ConfigFile:
+    """
+    :param Optional[bool] incremental: if True, a save re-serializes only
+        the sections of the objects that changed after the previous save and
+        reuses the text of the others, see :meth:`snapshot`. Only the text
+        format supports it. If None the "incremental_save" setting is used.
+    :param Optional[str] format: the format used to save the projects,
+        TEXT or JSON. If None the "project_format" setting is used. The
+        format of a project is detected on restore.
+    """
+
+    deferToThread = staticmethod(threads.deferToThread)
+
+    def __init__(self, incremental=None, format=None):
+        self.incremental = incremental
+        self.format = format
+        self._saving = {}
+        # the sections serialized by the last snapshot: the generation of
+        # the snapshot, the disk images and the text of every object
+        self._snapshot = (0, [], {})
+
+    def get_format(self):
+        if self.format is None:
+            return settings.get("project_format")
+        return self.format
+
+    def get_incremental(self):
+        if self.incremental is None:
+            return settings.get("incremental_save")
+        return self.incremental
 
     def save(self, factory, str_or_obj):
         """Save the current project.
@@ -312,37 +479,183 @@ class ConfigFile:
             else:
                 fp = str_or_obj
             logger.debug(config_dump, path=fp.path)
+            generation = factory.generation
             with backup(fp, fp.sibling(fp.basename() + "~")):
                 tmpfile = fp.sibling("." + fp.basename() + ".sav")
                 with open(tmpfile.path, "wt") as fd:
-                    self.save_to(factory, fd)
+                    if self.get_incremental():
+                        fd.writelines(self.snapshot(factory))
+                    else:
+                        self.save_to(factory, fd)
                 tmpfile.moveTo(fp)
+            factory.mark_clean(generation)
         else:
             self.save_to(factory, str_or_obj)
 
-    def save_to(self, factory, fileobj):
-        for img in factory.iter_disk_images():
-            img.save_to(fileobj)
+    def save_async(self, factory, str_or_obj, fsync=False):
+        """
+        Save the project in a thread. The project is serialized immediately,
+        only the write of the file happens in the thread, so the changes
+        made after the call are not saved.
 
-        for event in factory.iter_events():
-            event.save_to(fileobj)
+        While a save of the same file is running, the new requests are
+        coalesced in a single save that starts when the running one ends.
 
-        socks = []
-        plugs = []
-        for brick in iter(factory.bricks):
-            brick.save_to(fileobj)
-            if brick.get_type() == "Qemu":
-                socks.extend(brick.socks)
-            plugs.extend(brick.plugs)
+        :param bool fsync: if True, the file and its directory are synced
+            to the disk before the Deferred fires.
+        :return: a Deferred that fires when the file is written.
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
 
-        for sock in socks:
-            t = "sock|{s.brick.name}|{s.nickname}|{s.model}|{s.mac}\n"
-            fileobj.write(t.format(s=sock))
+        if isinstance(str_or_obj, str):
+            fp = filepath.FilePath(str_or_obj)
+        else:
+            fp = str_or_obj
+        deferred = defer.Deferred()
+        saving = self._saving.get(fp.path)
+        if saving is not None:
+            saving.waiting.append(deferred)
+            saving.factory = factory
+            saving.fsync = saving.fsync or fsync
+        else:
+            self._saving[fp.path] = saving = _AsyncSave()
+            self._save_in_thread(factory, fp, fsync, [deferred], saving)
+        return deferred
+
+    def _save_in_thread(self, factory, fp, fsync, deferreds, saving):
+        logger.debug(config_dump, path=fp.path)
+        generation = factory.generation
+        try:
+            chunks = self.snapshot(factory)
+        except Exception:
+            deferred = defer.fail()
+        else:
+            deferred = self.deferToThread(_write_file, fp, chunks, fsync)
+        deferred.addBoth(self._saved, factory, fp, generation, deferreds,
+                         saving)
+
+    def _saved(self, result, factory, fp, generation, deferreds, saving):
+        if not isinstance(result, failure.Failure):
+            # do not go back if a newer project was restored meanwhile
+            if generation > factory.saved_generation:
+                factory.mark_clean(generation)
+        for deferred in deferreds:
+            if isinstance(result, failure.Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(None)
+        if saving.waiting:
+            waiting, saving.waiting = saving.waiting, []
+            fsync, saving.fsync = saving.fsync, False
+            self._save_in_thread(saving.factory, fp, fsync, waiting, saving)
+        else:
+            del self._saving[fp.path]
+
+    def snapshot(self, factory):
+        """
+        Serialize the project and return it as a list of strings. If the
+        save is incremental, only the objects that changed after the
+        previous snapshot are serialized again, unless the disk images
+        changed: the virtual machines refer to them by name. The links are
+        always serialized again, a plug can change without its brick.
+
+        :rtype: List[str]
+        """
+
+        if self.get_format() == JSON:
+            buf = io.StringIO()
+            self._save_json(factory, buf)
+            return [buf.getvalue()]
+        last_generation, last_images, texts = self._snapshot
+        images = list(factory.iter_disk_images())
+        if not self.get_incremental() or images != last_images or any(
+                factory.last_changed(image) > last_generation
+                for image in images):
+            texts = {}
+        generation = factory.generation
+        new_texts = {}
+        chunks = []
+        buf = io.StringIO()
+        for obj in _sections(factory):
+            text = texts.get(obj)
+            if text is None or factory.last_changed(obj) > last_generation:
+                buf.seek(0)
+                buf.truncate()
+                obj.save_to(buf)
+                text = buf.getvalue()
+            new_texts[obj] = text
+            chunks.append(text)
+        links = [_brick_links(brick) for brick in factory.bricks]
+        chunks.extend(socks for socks, plugs in links)
+        chunks.extend(plugs for socks, plugs in links)
+        self._snapshot = (generation, images, new_texts)
+        return chunks
 
-        for plug in plugs:
-            plug.save_to(fileobj)
+    def save_to(self, factory, fileobj):
+        if self.get_format() == JSON:
+            self._save_json(factory, fileobj)
+            return
+        for obj in _sections(factory):
+            obj.save_to(fileobj)
+        self._save_links(factory, fileobj)
+
+    def _save_json(self, factory, fileobj):
+        """
+        Save the project as a compact JSON document. The sections keep the
+        options as they are written in the text format, so the two formats
+        can be converted without loss; the socks and links are saved as
+        tables.
+        """
+
+        sections = []
+        buf = io.StringIO()
+        for obj in _sections(factory):
+            buf.seek(0)
+            buf.truncate()
+            obj.save_to(buf)
+            buf.seek(0)
+            for section in _configparser.Parser(buf):
+                options, rest = section.split()
+                entry = [section.type, section.name, options]
+                if rest:
+                    entry.append(rest)
+                sections.append(entry)
+        socks = []
+        links = []
+        for brick in factory.bricks:
+            if is_lazy(brick):
+                socks.extend(list(sock[1:]) for sock in brick.loader.socks)
+                links.extend(list(link[1:]) for link in brick.loader.links)
+            elif brick.get_type() == "Qemu":
+                for sock in brick.socks:
+                    socks.append([brick.name, sock.nickname, sock.model,
+                                  sock.mac])
+            if is_lazy(brick):
+                continue
+            for plug in brick.plugs:
+                if plug.configured():
+                    links.append([brick.name, plug.sock.nickname, plug.model,
+                                  plug.mac])
+        document = {
+            "format": "virtualbricks",
+            "version": JSON_SCHEMA_VERSION,
+            "sections": sections,
+            "socks": socks,
+            "links": links
+        }
+        json.dump(document, fileobj, separators=(",", ":"))
+
+    def _save_links(self, factory, fileobj):
+        _write_links(factory.bricks, fileobj)
+
+    def restore(self, factory, str_or_obj, lazy=False):
+        """
+        Restore a project.
+
+        :param bool lazy: if True the bricks are not built, the factory gets
+            lazy bricks that are built only when they are needed.
+        """
 
-    def restore(self, factory, str_or_obj):
         if isinstance(str_or_obj, (str, filepath.FilePath)):
             if isinstance(str_or_obj, str):
                 fp = filepath.FilePath(str_or_obj)
@@ -351,24 +664,86 @@ class ConfigFile:
             restore_backup(fp, fp.sibling(fp.basename() + "~"))
             logger.info(open_project, path=fp.path)
             with open(fp.path,"rt") as fd:
-                self.restore_from(factory, fd)
+                self.restore_from(factory, fd, lazy)
+            factory.mark_clean()
         else:
-            self.restore_from(factory, str_or_obj)
+            self.restore_from(factory, str_or_obj, lazy)
 
-    def restore_from(self, factory, fileobj):
+    def restore_from(self, factory, fileobj, lazy=False):
+        items = self.iter_items(fileobj)
         with freeze_notify(factory):
-            for item in _configparser.Parser(fileobj):
-                interfaces.IBuilder(item).load_from(factory, item)
+            if lazy:
+                self._restore_lazy(factory, items)
+            else:
+                for item in items:
+                    interfaces.IBuilder(item).load_from(factory, item)
+
+    def iter_items(self, fileobj):
+        """
+        Iterate over the sections and the links of a project, in any format.
+        """
+
+        head = fileobj.read(_configparser.CHUNK_SIZE)
+        if head.lstrip().startswith("{"):
+            return self._iter_json(json.loads(head + fileobj.read()))
+        return _configparser.Parser(_PrefixedReader(head, fileobj))
+
+    def _restore_lazy(self, factory, items):
+        """
+        Add a lazy brick for every brick section and keep the socks and the
+        links of the brick in it. Images and events are always built.
+        """
+
+        loaders = {}
+        for item in items:
+            builder = interfaces.IBuilder(item)
+            if isinstance(builder, (BrickBuilder, CompatibleBuilder)):
+                loader = _LazySection(builder, item)
+                brick = factory.new_lazy_brick(builder.type, item.name,
+                                               loader)
+                loaders[brick.name] = loader
+            elif (isinstance(item, _configparser.Link) and
+                    item.owner in loaders):
+                loader = loaders[item.owner]
+                if item.type == "sock":
+                    loader.socks.append(item)
+                else:
+                    loader.links.append(item)
+            else:
+                builder.load_from(factory, item)
+
+    def _iter_json(self, document):
+        if document.get("format") != "virtualbricks":
+            raise errors.BadConfigError(_("Not a virtualbricks project"))
+        version = document.get("version")
+        if not isinstance(version, int) or version > JSON_SCHEMA_VERSION:
+            raise errors.BadConfigError(
+                _("Unsupported project version %s") % version)
+        sections = document.get("sections", [])
+        links = document.get("links", [])
+        logger.debug(json_project_loaded, sections=len(sections),
+                     links=len(links))
+        for entry in sections:
+            yield _configparser.ParsedSection(*entry)
+        Link = _configparser.Link
+        for row in document.get("socks", []):
+            yield Link("sock", *row)
+        for row in links:
+            yield Link("link", *row)
 
 
 _config = ConfigFile()
 
 
+def _project_filename():
+    workspace = settings.get("workspace")
+    project = settings.get("current_project")
+    return os.path.join(workspace, project, ".project")
+
+
 def save(factory, filename=None):
     if filename is None:
-        workspace = settings.get("workspace")
-        project = settings.get("current_project")
-        filename = os.path.join(workspace, project, ".project")
+        filename = _project_filename()
     _config.save(factory, filename)
 
 
@@ -379,9 +754,291 @@ def safe_save(factory, filename=None):
         logger.exception(config_save_error)
 
 
-def restore(factory, filename=None):
+def save_async(factory, filename=None):
+    """
+    Save the project in a thread, see ConfigFile.save_async().
+
+    :rtype: twisted.internet.defer.Deferred[None]
+    """
+
     if filename is None:
-        workspace = settings.get("workspace")
-        project = settings.get("current_project")
-        filename = os.path.join(workspace, project, ".project")
-    _config.restore(factory, filename)
+        filename = _project_filename()
+    return _config.save_async(factory, filename, settings.get("fsync"))
+
+
+def safe_save_async(factory, filename=None):
+    deferred = save_async(factory, filename)
+    return deferred.addErrback(logger.failure_eb, config_save_error)
+
+
+def restore(factory, filename=None, lazy=None):
+    if filename is None:
+        filename = _project_filename()
+    if lazy is None:
+        lazy = settings.get("lazy_restore")
+    _config.restore(factory, filename, lazy)
+
+
+def journal_path(fp):
+    """
+    Return the journal of a project file.
+
+    :type fp: twisted.python.filepath.FilePath
+    :rtype: twisted.python.filepath.FilePath
+    """
+
+    return fp.sibling(fp.basename() + ".journal")
+
+
+def _section_kind(type):
+    # the images must come before the virtual machines that use them
+    if type in ("Image", "DiskImage", "Project"):
+        return 0
+    elif type == "Event":
+        return 1
+    return 2
+
+
+def _read_journal(fp):
+    records = []
+    with open(fp.path, "rt") as fd:
+        for i, line in enumerate(fd):
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # the last record was not completely written
+                logger.warn(journal_truncated, filename=fp.path, line=i + 1)
+                break
+    return records
+
+
+def replay_journal(filename, until=None):
+    """
+    Fold the journal of a project into the project file and remove the
+    journal. A journal is left behind when virtualbricks does not save the
+    project before it ends, ex. after a crash.
+
+    :type filename: Union[str, twisted.python.filepath.FilePath]
+    :param until: replay only the changes made before this time, in
+        seconds since the epoch, to recover the project as it was then.
+    :type until: Optional[float]
+    :return: the number of changes replayed.
+    :rtype: int
+    """
+
+    if isinstance(filename, str):
+        filename = filepath.FilePath(filename)
+    fp = journal_path(filename)
+    try:
+        records = _read_journal(fp)
+    except FileNotFoundError:
+        return 0
+    if until is not None:
+        records = [record for record in records if record["time"] <= until]
+    if records:
+        # name -> (kind, text, links)
+        sections = {}
+        links = {}
+        try:
+            fd = open(filename.path, "rt")
+        except FileNotFoundError:
+            pass
+        else:
+            with fd:
+                for item in _config.iter_items(fd):
+                    if isinstance(item, _configparser.Link):
+                        links.setdefault(item.owner, []).append(
+                            "|".join(item))
+                    else:
+                        sections[item.name] = (_section_kind(item.type),
+                                               _section_text(item))
+        for record in records:
+            name = record["name"]
+            sections.pop(name, None)
+            links.pop(name, None)
+            if record["op"] == "put":
+                sections[name] = (record["kind"], record["section"])
+                links[name] = record["links"]
+        tmpfile = filename.sibling("." + filename.basename() + ".sav")
+        with open(tmpfile.path, "wt") as fd:
+            for kind in range(3):
+                for k, text in sections.values():
+                    if k == kind:
+                        fd.write(text)
+            lines = [line for owner in links.values() for line in owner]
+            for line in lines:
+                if line.startswith("sock|"):
+                    fd.write(line + "\n")
+            for line in lines:
+                if not line.startswith("sock|"):
+                    fd.write(line + "\n")
+        tmpfile.moveTo(filename)
+        logger.warn(journal_replayed, changes=len(records),
+                    filename=filename.path)
+    fp.remove()
+    return len(records)
+
+
+class Journal:
+    """
+    Append every change of the project to the journal next to the project
+    file, so that a change costs a write of the changed object and not of
+    the whole project. Every record holds the section and the links of a
+    brick, event or image as they are saved, or the deletion of one of
+    them; the changes of a reactor iteration are written together.
+
+    When the journal holds ``max_records`` records, it is compacted: the
+    project is saved and the journal emptied. Every save or restore of the
+    project empties the journal too.
+
+    :param filename: the project file, the current project if None.
+    :param bool fsync: if True every write is synced to the disk.
+    """
+
+    delayed = None
+
+    def __init__(self, factory, filename=None, max_records=1000, fsync=False,
+                 clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.factory = factory
+        self.filename = filename
+        self.max_records = max_records
+        self.fsync = fsync
+        self.clock = clock
+        self.records = 0
+        # name -> generation and time of the change not yet written
+        self._pending = {}
+        # object -> the name it had when it was last seen
+        self._names = {}
+        self._written = 0
+
+    def get_path(self):
+        if self.filename is None:
+            return journal_path(filepath.FilePath(_project_filename()))
+        return journal_path(filepath.FilePath(self.filename))
+
+    def start(self):
+        factory = self.factory
+        for obj in _sections(factory):
+            self._names[obj] = obj.get_name()
+        factory.object_changed.connect(self.changed)
+        factory.brick_removed.connect(self.removed)
+        factory.event_removed.connect(self.removed)
+        factory.image_removed.connect(self.removed)
+        factory.project_saved.connect(self.saved)
+        return self
+
+    def stop(self):
+        factory = self.factory
+        factory.object_changed.disconnect(self.changed)
+        factory.brick_removed.disconnect(self.removed)
+        factory.event_removed.disconnect(self.removed)
+        factory.image_removed.disconnect(self.removed)
+        factory.project_saved.disconnect(self.saved)
+        if self.delayed is not None and self.delayed.active():
+            self.delayed.cancel()
+        self.delayed = None
+        self.flush()
+
+    def _schedule(self, name):
+        self._pending[name] = (self.factory.generation, self.clock.seconds())
+        if self.delayed is None:
+            self.delayed = self.clock.callLater(0, self.flush)
+
+    def changed(self, obj):
+        name = obj.get_name()
+        old = self._names.get(obj)
+        self._names[obj] = name
+        if old is not None and old != name:
+            self._schedule(old)
+            # their links refer to the socks of the brick by name
+            if obj in self.factory.graph:
+                for dependent in self.factory.graph.dependents(obj):
+                    self._schedule(dependent.get_name())
+        self._schedule(name)
+
+    def removed(self, obj):
+        self._schedule(self._names.pop(obj, None) or obj.get_name())
+
+    def saved(self, factory):
+        """The project was saved or restored, forget the older changes."""
+
+        generation = factory.saved_generation
+        for name, (changed, ignore) in list(self._pending.items()):
+            if changed <= generation:
+                del self._pending[name]
+        fp = self.get_path()
+        records = []
+        if self._written > generation:
+            try:
+                records = [record for record in _read_journal(fp)
+                           if record["generation"] > generation]
+            except FileNotFoundError:
+                pass
+        self.records = len(records)
+        if records:
+            with open(fp.path, "wt") as fd:
+                for record in records:
+                    fd.write(json.dumps(record, separators=(",", ":")) + "\n")
+        elif fp.exists():
+            fp.remove()
+
+    def _lookup(self, name):
+        factory = self.factory
+        for get in (factory.get_brick_by_name, factory.get_event_by_name,
+                    factory.get_image_by_name):
+            obj = get(name)
+            if obj is not None:
+                return obj
+        return None
+
+    def _record(self, name, generation, time):
+        record = {
+            "generation": generation,
+            "time": time,
+            "name": name,
+        }
+        obj = self._lookup(name)
+        if obj is None:
+            record["op"] = "del"
+            return record
+        buf = io.StringIO()
+        obj.save_to(buf)
+        record["op"] = "put"
+        record["kind"] = _section_kind(obj.get_type())
+        record["section"] = buf.getvalue()
+        buf = io.StringIO()
+        if self.factory.get_brick_by_name(name) is obj:
+            _write_links([obj], buf)
+        record["links"] = buf.getvalue().splitlines()
+        return record
+
+    def flush(self):
+        """Write the pending changes to the journal."""
+
+        self.delayed = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        lines = []
+        for name, (generation, time) in pending.items():
+            record = self._record(name, generation, time)
+            lines.append(json.dumps(record, separators=(",", ":")) + "\n")
+        fp = self.get_path()
+        with open(fp.path, "at") as fd:
+            fd.writelines(lines)
+            fd.flush()
+            if self.fsync:
+                os.fsync(fd.fileno())
+        self._written = max(self._written,
+                            max(generation for generation, t in
+                                pending.values()))
+        self.records += len(lines)
+        if self.records >= self.max_records:
+            self.compact()
+
+    def compact(self):
+        """Save the project, the journal is emptied."""
+
+        return safe_save_async(self.factory, self.filename)
@@ -18,12 +18,14 @@
 
 import locale
 import os
+import shlex
 import textwrap
 
 from twisted.internet import interfaces, utils
 from twisted.protocols import basic
 from zope.interface import implementer
 from virtualbricks import __version__, bricks, errors, log, settings
+from virtualbricks import netsim, stats, supervisor
 
 logger = log.Logger()
 socket_error = log.Event("Error on socket")
@@ -134,6 +136,18 @@ class VBProtocol(Protocol):
     quit                    Stop virtualbricks
     event *args             TODO
     brick *args             TODO
+    stats                   Show if the switch statistics are collected
+    stats start [SECONDS]   Poll the switches every SECONDS
+    stats stop              Stop polling the switches
+    stats SWITCH            Throughput of the ports of SWITCH
+    stats top [N]           The N ports with the highest throughput
+    stats export FILE       Save all the samples to FILE as CSV
+    plan [BRICK...]         Show the command line of every brick, or of
+                            the BRICKs, without starting them. The bricks
+                            not loaded yet are shown only if named
+    simulate NETEMU [SECONDS] [RATE]
+                            Simulate offline the channel of NETEMU with
+                            RATE bytes per second for SECONDS
 
     Brick configuration command ---------------------------------------
     BRICK_NAME show         List parameters of BRICK_NAME brick
@@ -143,7 +157,15 @@ class VBProtocol(Protocol):
     BRICK_NAME config PARM=VALUE    Configure a parameter of BRICK_NAME
     BRICK_NAME connect NICK Connect BRICK_NAME to a Sock
     BRICK_NAME disconnect   Disconnect BRICK_NAME to a sock
+    BRICK_NAME supervise POLICY [dependents]
+                            Restart BRICK_NAME when its process
+                            dies (never, on-failure, always), with
+                            dependents the bricks plugged into it
+                            are restarted too
     BRICK_NAME help         Help about parameters of BRICK_NAME
+    NETEMU play TRACE [loop]        Replay the delay, loss and bandwidth
+                            of TRACE (CSV or binary) on NETEMU
+    NETEMU play stop        Stop replaying the trace
     """
 
     # _is_first = False
@@ -189,7 +211,7 @@ class VBProtocol(Protocol):
         elif cmd[0] == "remove":
             if obj.get_type() == "Event":
                 self.factory.del_event(obj)
-            elif isinstance(obj, bricks.Brick):
+            elif isinstance(obj, (bricks.Brick, bricks.LazyBrick)):
                 self.factory.del_brick(obj)
             else:
                 raise errors.UnmanagedTypeError("Unknown type %s",
@@ -205,6 +227,25 @@ class VBProtocol(Protocol):
                 logger.info(conn_failed)
         elif cmd[0] == "disconnect":
             obj.disconnect()
+        elif cmd[0] == "supervise" and len(cmd) >= 2:
+            try:
+                supervisor.policy_by_name(cmd[1])
+            except ValueError as e:
+                self.sendLine(str(e))
+            else:
+                obj.set({"restart_policy": cmd[1],
+                         "restart_dependents": "dependents" in cmd[2:]})
+        elif (cmd[0] == "play" and len(cmd) >= 2 and
+                obj.get_type() == "Netemu"):
+            if cmd[1] == "stop":
+                obj.stop_playback()
+            elif obj.proc is None:
+                self.sendLine("%s is not running" % obj.name)
+            else:
+                try:
+                    obj.play(cmd[1], loop="loop" in cmd[2:])
+                except (ValueError, OSError) as e:
+                    self.sendLine("Cannot play %s: %s" % (cmd[1], e))
 
     def default(self, line):
         # line = line.strip()
@@ -246,10 +287,15 @@ class VBProtocol(Protocol):
         if not procs:
             self.sendLine("No process running")
         else:
-            self.sendLine("PID\tType\tName")
-            self.sendLine("-" * 24)
+            self.sendLine("PID\tType\tName\tRestarts")
+            self.sendLine("-" * 32)
             for b in procs:
-                self.sendLine("%d\t%s\t%s" % (b.pid, b.get_type(), b.name))
+                if b.supervisor is not None:
+                    restarts = str(b.supervisor.restarts)
+                else:
+                    restarts = "-"
+                self.sendLine("%d\t%s\t%s\t%s" % (b.pid, b.get_type(), b.name,
+                                                 restarts))
 
     def do_reset(self):
         self.factory.reset()
@@ -298,6 +344,9 @@ class VBProtocol(Protocol):
         """List of connections for each brick"""
         for b in iter(self.factory.bricks):
             self.sendLine("Connections from %s brick:" % b.name)
+            if bricks.is_lazy(b):
+                self._lazy_connections(b)
+                continue
             for sk in b.socks:
                 if b.get_type() == "Qemu":
                     s = "\tsock connected to %s with an %s (%s) card"
@@ -313,6 +362,104 @@ class VBProtocol(Protocol):
                 elif (pl.sock is not None):
                     self.sendLine("\tlink: %s " % pl.sock.nickname)
 
+    def _lazy_connections(self, brick):
+        # the links saved in the project, without building the brick
+        if brick.get_type() == "Qemu":
+            for sk in brick.loader.socks:
+                s = "\tsock connected to %s with an %s (%s) card"
+                self.sendLine(s % (sk.sockname, sk.model, sk.mac))
+        for pl in brick.loader.links:
+            if brick.get_type() == "Qemu":
+                s = "\tlink connected to %s with a %s (%s) card"
+                self.sendLine(s % (pl.sockname, pl.model, pl.mac))
+            else:
+                self.sendLine("\tlink: %s " % pl.sockname)
+
+    def do_stats(self, cmd=None, arg=None):
+        """Switch port statistics"""
+
+        collector = stats.collector(self.factory)
+        if cmd is None:
+            if collector.running:
+                self.sendLine("Polling every %g seconds, %d switches" % (
+                    collector.interval, len(collector.series)))
+            else:
+                self.sendLine("Not polling")
+        elif cmd == "start":
+            collector.stop()
+            collector.start(float(arg) if arg else None)
+        elif cmd == "stop":
+            collector.stop()
+        elif cmd == "top":
+            for name, port, tin, tout in collector.top(int(arg or 10)):
+                self.sendLine("%s\t%d\t%.1f B/s in\t%.1f B/s out" % (
+                    name, port, tin, tout))
+        elif cmd == "export" and arg:
+            with open(arg, "w", newline="") as fp:
+                collector.export(fp)
+        elif cmd in collector.series:
+            self.sendLine("Port\tIn (B/s)\tOut (B/s)\tFSTP")
+            ports = collector.series[cmd]
+            for port, (tin, tout) in sorted(collector.throughput(cmd).items()):
+                self.sendLine("%d\t%.1f\t%.1f\t%s" % (
+                    port, tin, tout, ports[port].fstp or "-"))
+        else:
+            self.sendLine("No statistics for '%s'" % cmd)
+
+    def do_plan(self, *names):
+        """Command line of every brick"""
+
+        if names:
+            plan = []
+            for name in names:
+                brick = self.factory.get_brick_by_name(name)
+                if brick is None:
+                    self.sendLine("No brick '%s'" % name)
+                else:
+                    plan.append(brick)
+        else:
+            plan = self.factory.bricks
+        for brick in plan:
+            if not names and bricks.is_lazy(brick):
+                # the command line of a brick restored lazily is known only
+                # once the brick is built
+                self.sendLine("%s: not loaded" % brick.name)
+                continue
+            deferred = brick.plan()
+            deferred.addCallback(self._plan_done, brick)
+            deferred.addErrback(self._plan_failed, brick)
+
+    def _plan_done(self, args, brick):
+        self.sendLine("%s: %s" % (brick.name,
+                                  " ".join(shlex.quote(a) for a in args)))
+
+    def _plan_failed(self, fail, brick):
+        self.sendLine("%s: error: %s" % (brick.name, fail.getErrorMessage()))
+
+    def do_simulate(self, name, duration="10", rate=None):
+        """Simulate the channel of a Netemu"""
+
+        brick = self.factory.get_brick_by_name(name)
+        if brick is None or brick.get_type() != "Netemu":
+            self.sendLine("No Netemu '%s'" % name)
+            return
+        for direction in netsim.LR, netsim.RL:
+            try:
+                result = netsim.simulate_brick(
+                    brick, duration=float(duration),
+                    rate=float(rate) if rate else None, direction=direction)
+            except ValueError as e:
+                self.sendLine(str(e))
+                return
+            summary = result.summary()
+            self.sendLine(
+                "%s: %d sent, %d lost, %d dropped, %.1f B/s, latency "
+                "mean %.1f ms, p50 %.1f ms, p90 %.1f ms, p99 %.1f ms" % (
+                    direction, summary["sent"], summary["lost"],
+                    summary["dropped"], summary["throughput"],
+                    summary["latency_mean"], summary["latency_p50"],
+                    summary["latency_p90"], summary["latency_p99"]))
+
     # easter eggs
     def do_warranty(self):
         self.sendLine("NotImplementedError")
@@ -369,5 +516,6 @@ class ConfigurationProtocol(Protocol):
     def do_set(self, name, value):
         if settings.has_option(name):
             settings.set(name, value)
+            self.factory.settings_changed()
         else:
             self.sendLine("No such option %s" % name)
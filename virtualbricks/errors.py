@@ -115,3 +115,25 @@ class CommandError(Exception):
         super().__init__(stderr)
         self.exit_code = exit_code
         self.stderr = stderr
+
+
+class BrickNotRunningError(Error):
+    """The brick has no running process."""
+
+
+class BufferOverflowError(Error):
+    """The output of a management command is too long."""
+
+
+class CommandRejectedError(Error):
+    """
+    A running brick rejected a management command.
+    """
+
+    def __init__(self, code, message):
+        super().__init__(code, message)
+        self.code = code
+        self.message = message
+
+    def __str__(self):
+        return "{0} {1}".format(self.code, self.message)
@@ -656,10 +656,11 @@ class DisksLibraryWindow(_Window):
             self.w.cowsCellRendererText, self.set_cell_cows, brickfactory)
         self.w.sizeTreeViewColumn.set_cell_data_func(
             self.w.sizeCellRendererText, self.set_cell_size)
-        brickfactory.image_added.connect(self.on_disk_image_added, tree_model)
-        brickfactory.image_changed.connect(
+        brickfactory.image_added.connect_weak(
+            self.on_disk_image_added, tree_model)
+        brickfactory.image_changed.connect_weak(
             self.on_disk_image_changed, tree_model)
-        brickfactory.image_removed.connect(
+        brickfactory.image_removed.connect_weak(
             self.on_disk_image_removed, tree_model)
 
     def _show_edit_screen(self, disk_image):
@@ -2918,6 +2919,7 @@ class SettingsDialog(_Dialog):
         ksm_active = self.w.enableKsmSwitch.get_active()
         settings.set('ksm', ksm_active)
         tools.set_ksm(ksm_active)
+        self.virtualbricks_gui.brickfactory.settings_changed()
         if self.w.systraySwitch.get_active():
             self.virtualbricks_gui.start_systray()
         else:
@@ -879,8 +879,9 @@ class NetemuConfigController(_PlugMixin, ConfigController):
 
         # original parameters
         self.temp = deepcopy(self.original.markov_manager)
+        # the weights are read from self.temp every time, adding or removing
+        # a state can replace the matrix
         self.tempStates = self.temp.states
-        self.tempWeights = self.temp.weights
 
         go = self.get_object
         self.update(False, self.original.currentState)
@@ -953,7 +954,7 @@ class NetemuConfigController(_PlugMixin, ConfigController):
         go = self.get_object
 
         self.original.markov_manager.states = self.tempStates
-        self.original.markov_manager.weights = self.tempWeights
+        self.original.markov_manager.weights = self.temp.weights
 
         transPeriod = go("time_spinbutton").get_value_as_int()
         if transPeriod is not None:
@@ -1068,7 +1069,7 @@ class NetemuConfigController(_PlugMixin, ConfigController):
         if index is not None:
             otherIndex = go("cbWeight").get_selected_value()
             if otherIndex is not None:
-                self.tempWeights[index][otherIndex] = float(go("weight_spinbutton").get_value_as_int())
+                self.temp.weights[index][otherIndex] = float(go("weight_spinbutton").get_value_as_int())
 
     def on_cbState_changed(self, combobox):
         index = self.get_object("cbState").get_selected_value()
@@ -1080,10 +1081,10 @@ class NetemuConfigController(_PlugMixin, ConfigController):
         index = go("cbWeight").get_selected_value()
         if index is not None:
             otherIndex = go("cbState").get_selected_value()
-            if otherIndex is not None and otherIndex < len(self.tempWeights):
-                value = self.tempWeights[otherIndex][index]
+            if otherIndex is not None and otherIndex < len(self.temp.weights):
+                value = self.temp.weights[otherIndex][index]
                 maxWeight = 100
-                for weight in self.tempWeights[otherIndex]:
+                for weight in self.temp.weights[otherIndex]:
                     maxWeight -= weight
                 maxWeight += value
                 go("probAdjustment").set_upper(maxWeight)
@@ -2052,6 +2053,7 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
         self.set_title()
 
     def curtain_up(self, brick):
+        brick = self.brickfactory.materialize(brick)
         configframe = self.get_object("configframe")
         configframe.add(IConfigController(brick).get_view(self))
         configframe.show()
@@ -2263,13 +2265,17 @@ class VBGUI(TopologyMixin, ReadmeMixin, _Root):
                 if not success:
                     logger.failure(not_started, value)
 
-        l = [brick.poweron() for brick in self.brickfactory.bricks]
-        defer.DeferredList(l, consumeErrors=True).addCallback(started_all)
+        self.brickfactory.poweron_all().addCallback(started_all)
         return True
 
     def on_btnStopAll_clicked(self, toolbutton):
-        for brick in self.brickfactory.bricks:
-            brick.poweroff()
+
+        def stopped_all(results):
+            for result in results:
+                if not result.stopped:
+                    logger.failure(stop_error, result.status)
+
+        self.brickfactory.poweroff_all().addCallback(stopped_all)
         return True
 
     def __show_config_if_selected(self, treeview):
@@ -2471,6 +2477,8 @@ class VisualFactory(brickfactory.BrickFactory):
     def __init__(self, quit):
         brickfactory.BrickFactory.__init__(self, quit)
         self.socks = List()
+        # the tree models are updated on every notification, don't flood them
+        self.coalesce_changes()
 
 
 @implementer(log.ILogObserver)
@@ -141,3 +141,17 @@ class IProcess(Interface):
 
         @type data: C{bytes}
         """
+
+    def write_batch(commands):
+        """Send many commands at once to the stdin of the process.
+
+        @type commands: C{list} of C{bytes}
+        @return: a L{Deferred} fired when all the commands are executed.
+        """
+
+    def send_command(cmd):
+        """Send a command to the process and wait for its reply.
+
+        @type cmd: C{bytes}
+        @return: a L{Deferred} fired with the reply of the process.
+        """
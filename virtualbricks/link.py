@@ -16,6 +16,7 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import collections
 import os
 
 from twisted.internet import defer
@@ -43,8 +44,9 @@ class Plug:
     model = ""
     mac = ""
 
-    def __init__(self, brick):
+    def __init__(self, brick, graph=None):
         self.brick = brick
+        self.graph = graph
 
     def configured(self):
         return self.sock is not None
@@ -79,12 +81,16 @@ class Plug:
         assert sock is not None, "Cannot connect a plug to nothing"
         sock.plugs.append(self)
         self.sock = sock
+        if self.graph is not None:
+            self.graph.add_link(self.brick, sock.brick)
 
     def disconnect(self):
         assert self.sock is not None, "Plug not connected"
         assert self in self.sock.plugs, \
                 "sock %r has not reference to %r" % (self.sock, self)
         self.sock.plugs.remove(self)
+        if self.graph is not None:
+            self.graph.remove_link(self.brick, self.sock.brick)
         self.sock = None
 
     def save_to(self, fileobj):
@@ -107,3 +113,156 @@ class Sock:
 
     def has_valid_path(self):
         return os.access(os.path.dirname(self.path), os.W_OK)
+
+
+def _decrement(counter, key):
+    counter[key] -= 1
+    if counter[key] == 0:
+        del counter[key]
+
+
+class ConnectionGraph:
+    """
+    The bricks of a project and the links between them. A brick is linked
+    to another when one of its plugs is connected to a sock of the other.
+
+    The graph is updated incrementally: the factory adds and removes the
+    bricks and the plugs report their connections. Links to bricks that are
+    not in the graph (ex. the hostonly sock) and links of a brick to itself
+    are not recorded, but they are still reported as a change of the brick.
+
+    :param Optional[Callable] changed: called every time a link is added or
+        removed, with the brick whose plug changed.
+    """
+
+    def __init__(self, changed=None):
+        self._changed = changed
+        # brick -> Counter of the bricks it is plugged into
+        self._dependencies = {}
+        # brick -> Counter of the bricks plugged into it
+        self._dependents = {}
+
+    def __contains__(self, brick):
+        return brick in self._dependencies
+
+    def __len__(self):
+        return len(self._dependencies)
+
+    def add_brick(self, brick):
+        """
+        Add a brick and the links it already has to the other bricks of the
+        graph.
+        """
+
+        if brick in self._dependencies:
+            return
+        self._dependencies[brick] = collections.Counter()
+        self._dependents[brick] = collections.Counter()
+        for plug in brick.plugs:
+            if plug.sock is not None:
+                self.add_link(brick, plug.sock.brick)
+        for sock in brick.socks:
+            for plug in sock.plugs:
+                self.add_link(plug.brick, brick)
+
+    def remove_brick(self, brick):
+        for dependency in self._dependencies.pop(brick, ()):
+            del self._dependents[dependency][brick]
+        for dependent in self._dependents.pop(brick, ()):
+            del self._dependencies[dependent][brick]
+
+    def clear(self):
+        self._dependencies.clear()
+        self._dependents.clear()
+
+    def add_link(self, brick, other):
+        """Record that a plug of brick is connected to a sock of other."""
+
+        if brick not in self._dependencies:
+            return
+        if brick is not other and other in self._dependencies:
+            self._dependencies[brick][other] += 1
+            self._dependents[other][brick] += 1
+        if self._changed is not None:
+            self._changed(brick)
+
+    def remove_link(self, brick, other):
+        if brick not in self._dependencies:
+            return
+        if self._dependencies[brick].get(other, 0) > 0:
+            _decrement(self._dependencies[brick], other)
+            _decrement(self._dependents[other], brick)
+        if self._changed is not None:
+            self._changed(brick)
+
+    def dependencies(self, brick):
+        """
+        Return the bricks whose socks the brick is plugged into.
+
+        :rtype: List[virtualbricks.bricks.Brick]
+        """
+
+        return list(self._dependencies.get(brick, ()))
+
+    def dependents(self, brick):
+        """
+        Return the bricks plugged into the socks of the brick.
+
+        :rtype: List[virtualbricks.bricks.Brick]
+        """
+
+        return list(self._dependents.get(brick, ()))
+
+    def neighbours(self, brick):
+        """
+        Return the bricks linked to the brick, in any direction.
+
+        :rtype: List[virtualbricks.bricks.Brick]
+        """
+
+        neighbours = dict.fromkeys(self._dependencies.get(brick, ()))
+        neighbours.update(dict.fromkeys(self._dependents.get(brick, ())))
+        return list(neighbours)
+
+    def component(self, brick):
+        """
+        Return the bricks reachable from the brick, the brick included.
+
+        :rtype: Set[virtualbricks.bricks.Brick]
+        """
+
+        if brick not in self._dependencies:
+            return set()
+        seen = {brick}
+        queue = collections.deque([brick])
+        while queue:
+            for neighbour in self.neighbours(queue.popleft()):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    queue.append(neighbour)
+        return seen
+
+    def components(self):
+        """
+        Return the connected components of the graph.
+
+        :rtype: List[Set[virtualbricks.bricks.Brick]]
+        """
+
+        seen = set()
+        components = []
+        for brick in self._dependencies:
+            if brick not in seen:
+                component = self.component(brick)
+                seen.update(component)
+                components.append(component)
+        return components
+
+    def reachable(self, source, target):
+        """
+        Return True if a path of links connects the two bricks.
+
+        :rtype: bool
+        """
+
+        return target in self.component(source)
@@ -0,0 +1,363 @@
+# -*- test-case-name: virtualbricks.tests.test_markov -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Transition matrices of the Markov channel model of Netemu.
+
+The weight of the edge (i, j), i != j, is the probability in percent that
+the emulator moves from state i to state j at every transition period. The
+emulator stays in state i with the remaining probability, so the weights on
+the diagonal are ignored and the weights leaving a state must not sum to
+more than 100.
+
+Models with up to SPARSE_THRESHOLD states are stored in a NumPy array, if
+NumPy is installed, bigger models in a sparse matrix.
+"""
+
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ["DenseMatrix", "SparseMatrix", "TransitionMatrix", "expected",
+           "matrix", "resize", "SPARSE_THRESHOLD"]
+
+if False:  # pyflakes
+    _ = str
+
+
+SPARSE_THRESHOLD = 256
+
+
+class _Row:
+    """A row of a transition matrix, behaves like a list of floats."""
+
+    __slots__ = ("matrix", "index")
+
+    def __init__(self, matrix, index):
+        self.matrix = matrix
+        self.index = index
+
+    def __getitem__(self, j):
+        return self.matrix.get(self.index, j)
+
+    def __setitem__(self, j, value):
+        self.matrix.set(self.index, j, value)
+
+    def __len__(self):
+        return len(self.matrix)
+
+    def __iter__(self):
+        return iter(self.matrix.row(self.index))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class TransitionMatrix:
+
+    sparse = False
+
+    def __len__(self):
+        raise NotImplementedError()
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return _Row(self, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield _Row(self, i)
+
+    def __eq__(self, other):
+        return (len(self) == len(other) and
+                all(a == b for a, b in zip(self, other)))
+
+    def get(self, i, j):
+        raise NotImplementedError()
+
+    def set(self, i, j, value):
+        raise NotImplementedError()
+
+    def row(self, i):
+        """Return the weights leaving state i as a list."""
+
+        raise NotImplementedError()
+
+    def insert(self, index):
+        """Insert a new state at index, with all its weights set to 0."""
+
+        raise NotImplementedError()
+
+    def delete(self, index):
+        """Remove the state at index and all its weights."""
+
+        raise NotImplementedError()
+
+    def nonzero(self):
+        """
+        Iterate over the weights not zero, out of the diagonal.
+
+        :rtype: Iterator[Tuple[int, int, float]]
+        """
+
+        raise NotImplementedError()
+
+    def validate(self):
+        """
+        Check that the weights are finite, not negative and that the weights
+        leaving every state do not sum to more than 100.
+
+        :raises ValueError: if the matrix is not valid.
+        """
+
+        sums = [0.0] * len(self)
+        for i, j, weight in self.nonzero():
+            if not math.isfinite(weight) or weight < 0:
+                raise ValueError(_("Invalid weight {0} from state {1} to "
+                                   "state {2}").format(weight, i, j))
+            sums[i] += weight
+        self._check_sums(sums)
+
+    def _check_sums(self, sums):
+        for i, total in enumerate(sums):
+            if total > 100 + 1e-9:
+                raise ValueError(_("The weights leaving state {0} sum to "
+                                   "{1}, more than 100").format(i, total))
+
+    def stationary_distribution(self, tolerance=1e-12, max_iterations=100000):
+        """
+        Return the fraction of time spent in every state in the long run.
+
+        If the chain is not irreducible, the distribution depends on the
+        initial state; here the chain starts from a uniform distribution.
+
+        :rtype: List[float]
+        """
+
+        self.validate()
+        n = len(self)
+        stay = [1.0] * n
+        edges = []
+        for i, j, weight in self.nonzero():
+            stay[i] -= weight / 100.0
+            edges.append((i, j, weight / 100.0))
+        # the lazy chain (P + I) / 2 has the same stationary distribution
+        # and it is aperiodic, so the power iteration converges
+        pi = [1.0 / n] * n
+        for iteration in range(max_iterations):
+            new = [p * (1.0 + s) / 2.0 for p, s in zip(pi, stay)]
+            for i, j, probability in edges:
+                new[j] += pi[i] * probability / 2.0
+            delta = sum(abs(a - b) for a, b in zip(new, pi))
+            pi = new
+            if delta < tolerance:
+                break
+        total = sum(pi)
+        return [p / total for p in pi]
+
+
+class SparseMatrix(TransitionMatrix):
+    """Store only the weights that are not zero, one dict per row."""
+
+    sparse = True
+
+    def __init__(self, size=1):
+        self.rows = [{} for i in range(size)]
+
+    @classmethod
+    def from_matrix(cls, other):
+        new = cls(len(other))
+        for i, j, weight in other.nonzero():
+            new.rows[i][j] = weight
+        return new
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _check(self, j):
+        if not 0 <= j < len(self.rows):
+            raise IndexError(j)
+
+    def get(self, i, j):
+        self._check(j)
+        return self.rows[i].get(j, 0.0)
+
+    def set(self, i, j, value):
+        self._check(j)
+        if value:
+            self.rows[i][j] = float(value)
+        else:
+            self.rows[i].pop(j, None)
+
+    def row(self, i):
+        row = [0.0] * len(self.rows)
+        for j, weight in self.rows[i].items():
+            row[j] = weight
+        return row
+
+    def insert(self, index):
+        self.rows.insert(index, {})
+        for i, row in enumerate(self.rows):
+            if any(j >= index for j in row):
+                self.rows[i] = dict((j + 1 if j >= index else j, weight)
+                                    for j, weight in row.items())
+
+    def delete(self, index):
+        del self.rows[index]
+        for i, row in enumerate(self.rows):
+            if any(j >= index for j in row):
+                self.rows[i] = dict((j - 1 if j > index else j, weight)
+                                    for j, weight in row.items()
+                                    if j != index)
+
+    def nonzero(self):
+        for i, row in enumerate(self.rows):
+            for j, weight in sorted(row.items()):
+                if i != j:
+                    yield i, j, weight
+
+
+class DenseMatrix(TransitionMatrix):
+    """Store the weights in a NumPy array."""
+
+    def __init__(self, size=1):
+        self.array = numpy.zeros((size, size))
+
+    @classmethod
+    def from_matrix(cls, other):
+        new = cls(len(other))
+        for i, j, weight in other.nonzero():
+            new.array[i, j] = weight
+        return new
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def get(self, i, j):
+        return float(self.array[i, j])
+
+    def set(self, i, j, value):
+        self.array[i, j] = value
+
+    def row(self, i):
+        return self.array[i].tolist()
+
+    def insert(self, index):
+        array = numpy.insert(self.array, index, 0.0, axis=0)
+        self.array = numpy.insert(array, index, 0.0, axis=1)
+
+    def delete(self, index):
+        array = numpy.delete(self.array, index, axis=0)
+        self.array = numpy.delete(array, index, axis=1)
+
+    def _off_diagonal(self):
+        weights = self.array.copy()
+        numpy.fill_diagonal(weights, 0.0)
+        return weights
+
+    def nonzero(self):
+        weights = self._off_diagonal()
+        for i, j in zip(*numpy.nonzero(weights)):
+            yield int(i), int(j), float(weights[i, j])
+
+    def validate(self):
+        weights = self._off_diagonal()
+        invalid = ~numpy.isfinite(weights) | (weights < 0)
+        if invalid.any():
+            i, j = numpy.argwhere(invalid)[0]
+            raise ValueError(_("Invalid weight {0} from state {1} to "
+                               "state {2}").format(weights[i, j], i, j))
+        self._check_sums(weights.sum(axis=1).tolist())
+
+    def probabilities(self):
+        """
+        Return the matrix of the transition probabilities.
+
+        :rtype: numpy.ndarray
+        """
+
+        probabilities = self._off_diagonal() / 100.0
+        numpy.fill_diagonal(probabilities, 1.0 - probabilities.sum(axis=1))
+        return probabilities
+
+    def stationary_distribution(self, tolerance=1e-12, max_iterations=None):
+        self.validate()
+        n = len(self)
+        # solve pi (P - I) = 0 with sum(pi) = 1
+        system = self.probabilities().T - numpy.eye(n)
+        system[-1, :] = 1.0
+        target = numpy.zeros(n)
+        target[-1] = 1.0
+        pi = numpy.linalg.lstsq(system, target, rcond=None)[0]
+        pi = numpy.clip(pi, 0.0, None)
+        return (pi / pi.sum()).tolist()
+
+
+def matrix(size=1):
+    """
+    Return a new transition matrix, dense if NumPy is available and the
+    model is small enough, sparse otherwise.
+
+    :rtype: TransitionMatrix
+    """
+
+    if numpy is not None and size <= SPARSE_THRESHOLD:
+        return DenseMatrix(size)
+    return SparseMatrix(size)
+
+
+def expected(distribution, values):
+    """
+    Return the long-run averages of some values defined for every state.
+
+    :param distribution: the stationary distribution of the chain.
+    :type distribution: List[float]
+    :param values: for every quantity, its value in every state.
+    :type values: List[List[float]]
+    :rtype: List[float]
+    """
+
+    if numpy is not None:
+        values = numpy.asarray(values, dtype=float).reshape(len(values), -1)
+        return numpy.dot(values, numpy.asarray(distribution)).tolist()
+    return [sum(p * v for p, v in zip(distribution, row)) for row in values]
+
+
+def resize(weights):
+    """
+    Switch the storage of a matrix that grew over, or shrank under, the
+    sparse threshold.
+
+    :rtype: TransitionMatrix
+    """
+
+    if numpy is None:
+        return weights
+    if not weights.sparse and len(weights) > SPARSE_THRESHOLD:
+        return SparseMatrix.from_matrix(weights)
+    if weights.sparse and len(weights) <= SPARSE_THRESHOLD // 2:
+        return DenseMatrix.from_matrix(weights)
+    return weights
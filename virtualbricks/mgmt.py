@@ -0,0 +1,492 @@
+# -*- test-case-name: virtualbricks.tests.test_mgmt -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Clients of the VDE management consoles, either attached to the stdin of a
+brick process or connected to its management socket.
+"""
+
+import collections
+import locale
+import re
+
+from twisted.internet import defer, endpoints, protocol, reactor, task
+
+from virtualbricks import errors, log, settings
+
+
+__all__ = ["ManagementClient", "ManagementPool", "ManagementProtocol",
+           "PromptScanner", "Response", "parse_response"]
+
+if False:  # pyflakes
+    _ = str
+
+
+system_encoding = locale.getpreferredencoding(do_setlocale=True)
+
+logger = log.Logger()
+invalid_ack = log.Event("ACK received but no command sent.")
+output_truncated = log.Event("Management output too long, {size} bytes "
+                             "discarded.")
+output_overflow = log.Event("Management output too long, closing the "
+                            "connection.")
+connection_failed = log.Event("Cannot connect to {path}, retrying in "
+                              "{delay} seconds: {error}")
+connection_lost = log.Event("Connection to {path} lost")
+
+
+class PromptScanner:
+    """
+    Split the output of a management console in ACKs, the output between two
+    prompts.
+
+    Only the new bytes, and the last incomplete line because a prompt can be
+    split between two reads, are scanned on every call. The output of a single
+    command is bounded by max_size: when it is exceeded the oldest bytes are
+    discarded (TRUNCATE) or BufferOverflowError is raised (ERROR).
+    """
+
+    TRUNCATE = "truncate"
+    ERROR = "error"
+
+    def __init__(self, prompt, max_size=4 * 1024 * 1024, overflow=TRUNCATE):
+        self.prompt = prompt
+        self.max_size = max_size
+        self.overflow = overflow
+        self._buffer = bytearray()
+        self._scan = 0
+
+    def feed(self, data):
+        """
+        Add data to the buffer and return the ACKs completed.
+
+        :type data: bytes
+        :rtype: List[bytes]
+        :raises BufferOverflowError: if the overflow policy is ERROR and the
+            buffer grew over max_size.
+        """
+
+        buf = self._buffer
+        boundary = len(buf)
+        buf += data
+        acks = []
+        start = 0
+        while True:
+            match = self.prompt.search(buf, self._scan)
+            if match is None:
+                break
+            acks.append(bytes(buf[start:match.start()]))
+            start = self._scan = match.end()
+        if start:
+            del buf[:start]
+            boundary = max(boundary - start, 0)
+            self._scan = 0
+        newline = buf.rfind(b"\n", boundary)
+        if newline >= 0:
+            self._scan = newline + 1
+        if len(buf) > self.max_size:
+            self._overflow(len(buf) - self.max_size)
+        return acks
+
+    def _overflow(self, excess):
+        if self.overflow == self.ERROR:
+            del self._buffer[:]
+            self._scan = 0
+            raise errors.BufferOverflowError(excess)
+        del self._buffer[:excess]
+        self._scan = max(self._scan - excess, 0)
+        logger.warn(output_truncated, size=excess)
+
+
+Response = collections.namedtuple("Response", "code message body")
+
+
+def parse_response(ack):
+    """
+    Parse the output of a management command.
+
+    The output is terminated by a reply line with the VDE return code, 1000
+    plus an errno value, and may carry a body, delimited by a
+    ``0000 DATA END WITH '.'`` line and a line with a single dot.
+
+    :type ack: bytes
+    :rtype: Response
+    """
+
+    lines = ack.decode(system_encoding, "replace").splitlines()
+    code, message, body = 0, "", []
+    in_data = False
+    for line in lines:
+        if in_data:
+            if line == ".":
+                in_data = False
+            else:
+                body.append(line)
+        elif line.startswith("0000 DATA"):
+            in_data = True
+        else:
+            match = ManagementClient.reply.match(line)
+            if match:
+                code, message = int(match.group(1)) - 1000, match.group(2)
+            elif line:
+                body.append(line)
+    return Response(code, message, body)
+
+
+class ManagementClient:
+    """
+    A request/response client of a VDE management console.
+
+    Commands are pipelined: up to ``pipeline_size`` commands are sent before
+    their ACK, the prompt, is received. The replies are matched to the
+    commands in order.
+
+    @cvar delimiter: The line-ending delimiter to use.
+    """
+
+    _sent = 0
+    delimiter = b"\n"
+    prompt = re.compile(rb"^vde(?:\[[^]]*\]:|\$) ", re.MULTILINE)
+    reply = re.compile(r"^(\d{4}) (.*)$")
+    clock = reactor
+    high_water = 1024
+    max_output = 4 * 1024 * 1024
+    overflow = PromptScanner.TRUNCATE
+
+    def __init__(self, pipeline_size=None, timeout=None):
+        if pipeline_size is None:
+            pipeline_size = int(settings.get("pipeline_size"))
+        if timeout is None:
+            timeout = float(settings.get("command_timeout"))
+        self.pipeline_size = pipeline_size
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self._results = collections.deque()
+        self._writable = []
+        self._scanner = PromptScanner(self.prompt, self.max_output,
+                                      self.overflow)
+
+    def data_received(self, data):
+        """
+        Translates bytes into lines, and calls _ack_received.
+        """
+
+        assert isinstance(data, bytes)
+        try:
+            acks = self._scanner.feed(data)
+        except errors.BufferOverflowError:
+            self.logger.warn(output_overflow)
+            self.transport.loseConnection()
+        else:
+            for ack in acks:
+                self._ack_received(ack)
+
+    def _ack_received(self, ack):
+        self.logger.info(ack)
+        try:
+            self.queue.popleft()
+        except IndexError:
+            self.logger.warn(invalid_ack)
+            self.transport.loseConnection()
+        else:
+            self._sent -= 1
+            pending = self._results.popleft()
+            if pending is not None:
+                self._fire(pending, ack)
+            self._send_commands(self.pipeline_size)
+            self._notify_writable()
+
+    def _fire(self, pending, ack):
+        deferred, timeout = pending
+        if deferred.called:
+            # the command timed out
+            return
+        timeout.cancel()
+        response = parse_response(ack)
+        if response.code:
+            deferred.errback(errors.CommandRejectedError(response.code,
+                                                         response.message))
+        else:
+            deferred.callback(response)
+
+    def _timed_out(self, deferred, cmd):
+        deferred.errback(defer.TimeoutError(cmd))
+
+    def _send_commands(self, limit):
+        chunks = []
+        while self._sent < min(limit, len(self.queue)):
+            cmd = self.queue[self._sent]
+            pending = self._results[self._sent]
+            if pending is not None:
+                pending[1] = self.clock.callLater(
+                    self.timeout, self._timed_out, pending[0], cmd)
+            self._sent += 1
+            self.logger.info(cmd)
+            chunks.append(cmd)
+            if not cmd.endswith(self.delimiter):
+                chunks.append(self.delimiter)
+        if chunks:
+            self.transport.writeSequence(chunks)
+
+    def _enqueue(self, cmd):
+        deferred = defer.Deferred()
+        self.queue.append(cmd)
+        self._results.append([deferred, None])
+        return deferred
+
+    def _notify_writable(self):
+        if self._writable and len(self.queue) <= self.high_water // 2:
+            waiting, self._writable = self._writable, []
+            for deferred in waiting:
+                deferred.callback(None)
+
+    def wait_writable(self):
+        """
+        Wait until there is room in the queue. Producers of many commands
+        should wait on this before sending more of them.
+
+        :return: a Deferred fired when the queue is under half the high
+            water mark.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if len(self.queue) < self.high_water:
+            return defer.succeed(None)
+        deferred = defer.Deferred()
+        self._writable.append(deferred)
+        return deferred
+
+    def fail_pending(self, reason):
+        """Fail all the commands waiting for a reply."""
+
+        while self._results:
+            pending = self._results.popleft()
+            if pending is not None and not pending[0].called:
+                if pending[1] is not None:
+                    pending[1].cancel()
+                pending[0].errback(reason)
+        self.queue.clear()
+        self._sent = 0
+
+    def write(self, cmd):
+        self.queue.append(cmd)
+        self._results.append(None)
+        self._send_commands(self.pipeline_size)
+
+    def send_command(self, cmd):
+        """
+        Send a command to the management console.
+
+        :type cmd: bytes
+        :return: a Deferred fired with the :class:`Response` of the process,
+            or failed with :class:`virtualbricks.errors.CommandRejectedError`
+            if the process returned an error code or with
+            :class:`twisted.internet.defer.TimeoutError` if the process did
+            not reply in time.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        deferred = self._enqueue(cmd)
+        self._send_commands(self.pipeline_size)
+        return deferred
+
+    def write_batch(self, commands):
+        """
+        Send all the commands in one burst, without waiting for the ACK of
+        the previous ones.
+
+        :type commands: List[bytes]
+        :return: a Deferred fired when all the commands are acknowledged or
+            failed with the first command rejected by the process.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        results = [self._enqueue(cmd) for cmd in commands]
+        self._send_commands(len(self.queue))
+        deferred = defer.gatherResults(results, consumeErrors=True)
+        return deferred.addErrback(_unwrap_first_error)
+
+
+def _unwrap_first_error(fail):
+    fail.trap(defer.FirstError)
+    return fail.value.subFailure
+
+
+class ManagementProtocol(ManagementClient, protocol.Protocol):
+    """
+    A client connected to the management socket of a brick, the one passed
+    with -M. The banner sent by the brick when the connection is made is
+    discarded and ``ready`` is fired when the first prompt is received.
+    """
+
+    logger = logger
+    # the socket can belong to any VDE brick, wirefilter included
+    prompt = re.compile(rb"^(?:vde(?:\[[^]]*\]:|\$)|VDEwf\$) ", re.MULTILINE)
+
+    def __init__(self, pipeline_size=None, timeout=None):
+        ManagementClient.__init__(self, pipeline_size, timeout)
+        self.ready = defer.Deferred()
+        self.lost = defer.Deferred()
+
+    def _ack_received(self, ack):
+        if not self.ready.called:
+            self.ready.callback(self)
+        else:
+            ManagementClient._ack_received(self, ack)
+
+    def dataReceived(self, data):
+        self.data_received(data)
+
+    def connectionLost(self, reason):
+        self.fail_pending(reason)
+        if not self.ready.called:
+            self.ready.errback(reason)
+        self.lost.callback(self)
+
+
+class ManagementPool:
+    """
+    A pool of connections to management sockets, one per socket.
+
+    All the commands sent to the same socket share, and are pipelined on, the
+    same connection. A connection lost is opened again on the next command;
+    a connection that cannot be made, or that does not show the prompt
+    within the command timeout, is retried ``retries`` times, doubling the
+    delay every time. All the timers run on the given reactor.
+    """
+
+    retries = 3
+    retry_delay = 0.5
+
+    def __init__(self, reactor=reactor, pipeline_size=None, timeout=None):
+        self.reactor = reactor
+        self.pipeline_size = pipeline_size
+        self.timeout = timeout
+        self._connections = {}
+        self._connecting = {}
+
+    def _build_protocol(self):
+        proto = ManagementProtocol(self.pipeline_size, self.timeout)
+        proto.clock = self.reactor
+        return proto
+
+    def _factory(self):
+        return protocol.Factory.forProtocol(self._build_protocol)
+
+    def _endpoint(self, path):
+        return endpoints.UNIXClientEndpoint(self.reactor, path)
+
+    def connect(self, path, retries=None):
+        """
+        Return a connection to the socket, opening it if needed.
+
+        :param str path: the path of the management socket.
+        :param Optional[int] retries: how many times a failed connection is
+            retried, by default ``retries``.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if path in self._connections:
+            return defer.succeed(self._connections[path])
+        if retries is None:
+            retries = self.retries
+        deferred = defer.Deferred()
+        if path in self._connecting:
+            self._connecting[path].append(deferred)
+        else:
+            self._connecting[path] = [deferred]
+            self._connect(path, retries, self.retry_delay)
+        return deferred
+
+    def _connect(self, path, retries, delay):
+        deferred = self._endpoint(path).connect(self._factory())
+        deferred.addCallback(self._wait_ready)
+        deferred.addCallbacks(self._connected, self._failed,
+                              callbackArgs=(path, ),
+                              errbackArgs=(path, retries, delay))
+
+    def _wait_ready(self, proto):
+        """Wait for the first prompt, close the connection if it is late."""
+
+        def timed_out(result, timeout):
+            proto.transport.abortConnection()
+            result.trap(defer.CancelledError)
+            raise defer.TimeoutError(timeout, "no prompt")
+
+        return proto.ready.addTimeout(proto.timeout, self.reactor, timed_out)
+
+    def _connected(self, proto, path):
+        self._connections[path] = proto
+        proto.lost.addCallback(self._lost, path)
+        for deferred in self._connecting.pop(path):
+            deferred.callback(proto)
+
+    def _failed(self, fail, path, retries, delay):
+        if retries > 0:
+            logger.warn(connection_failed, path=path, delay=delay,
+                        error=fail.getErrorMessage())
+            task.deferLater(self.reactor, delay, self._connect, path,
+                            retries - 1, delay * 2)
+        else:
+            for deferred in self._connecting.pop(path):
+                deferred.errback(fail)
+
+    def _lost(self, proto, path):
+        if self._connections.get(path) is proto:
+            del self._connections[path]
+            logger.info(connection_lost, path=path)
+
+    def send_command(self, path, cmd):
+        """
+        Send a command to the management socket.
+
+        :param str path: the path of the management socket.
+        :type cmd: bytes
+        :return: a Deferred fired with the :class:`Response` of the brick.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        return self.connect(path).addCallback(
+            lambda proto: proto.send_command(cmd))
+
+    def write_batch(self, path, commands):
+        """
+        Send the commands to the management socket in one burst, see
+        :meth:`ManagementClient.write_batch`.
+
+        :param str path: the path of the management socket.
+        :type commands: List[bytes]
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        return self.connect(path).addCallback(
+            lambda proto: proto.write_batch(commands))
+
+    def disconnect(self, path):
+        proto = self._connections.pop(path, None)
+        if proto is not None:
+            proto.transport.loseConnection()
+            return proto.lost
+        return defer.succeed(None)
+
+    def disconnect_all(self):
+        return defer.DeferredList([self.disconnect(path)
+                                   for path in list(self._connections)])
+
+
+pool = ManagementPool()
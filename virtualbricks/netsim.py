@@ -0,0 +1,300 @@
+# -*- test-case-name: virtualbricks.tests.test_netsim -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Offline simulation of the channel of a Netemu brick.
+
+A constant bit rate stream of packets goes through the Markov model of the
+emulator: the model moves to a new state every transition period, every
+packet is lost with the probability of the current state, waits in a
+queue of chanbufsize bytes served at the bandwidth of the current state and
+then is delayed by the delay of the current state.
+
+The per packet random values are drawn all at once, with NumPy when it is
+installed; only the queue is served one packet at a time.
+"""
+
+import bisect
+import collections
+import math
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ["LR", "RL", "SimulationResult", "simulate", "simulate_brick"]
+
+if False:  # pyflakes
+    _ = str
+
+
+LR = "LR"
+RL = "RL"
+DEFAULT_RATE = 125000
+
+
+class _Random:
+
+    def __init__(self, seed):
+        if numpy is not None:
+            self.generator = numpy.random.default_rng(seed)
+        else:
+            self.generator = random.Random(seed)
+
+    def uniform(self, n):
+        if numpy is not None:
+            return self.generator.random(n)
+        return [self.generator.random() for i in range(n)]
+
+
+def _channel(states, direction):
+    """
+    Return, for every parameter of the channel, its value in every state in
+    the given direction.
+    """
+
+    channel = {}
+    for name in "delay", "loss", "bandwidth", "chanbufsize":
+        if direction == LR:
+            channel[name] = [state[name] for state in states]
+        else:
+            channel[name] = [
+                state[name if state[name + "symm"] else name + "r"]
+                for state in states]
+    return channel
+
+
+def _sample_path(weights, start, steps, uniform):
+    """Return the state of the model at every transition period."""
+
+    edges = [([], []) for i in range(len(weights))]
+    for i, j, weight in weights.nonzero():
+        cumulative, targets = edges[i]
+        cumulative.append((cumulative[-1] if cumulative else 0.0) + weight)
+        targets.append(j)
+    path = [start]
+    state = start
+    for u in uniform[1:steps]:
+        cumulative, targets = edges[state]
+        k = bisect.bisect_right(cumulative, u * 100)
+        if k < len(targets):
+            state = targets[k]
+        path.append(state)
+    return path
+
+
+def _percentile(values, percent):
+    # the same linear interpolation of numpy.percentile, values are sorted
+    k = (len(values) - 1) * percent / 100.0
+    lower = int(math.floor(k))
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+class SimulationResult:
+    """
+    The packets of a simulation.
+
+    :ivar int sent: the packets sent.
+    :ivar int lost: the packets lost because of the loss of the channel.
+    :ivar int dropped: the packets dropped because the buffer was full.
+    :ivar latencies: the latency, in milliseconds, of every packet received.
+    :ivar departures: the time, in seconds, every packet was received.
+    """
+
+    def __init__(self, duration, size, sent, lost, dropped, latencies,
+                 departures):
+        self.duration = duration
+        self.size = size
+        self.sent = sent
+        self.lost = lost
+        self.dropped = dropped
+        self.latencies = latencies
+        self.departures = departures
+
+    @property
+    def received(self):
+        return len(self.latencies)
+
+    def loss_rate(self):
+        if not self.sent:
+            return 0.0
+        return (self.lost + self.dropped) / self.sent
+
+    def mean_latency(self):
+        if not self.latencies:
+            return 0.0
+        return sum(self.latencies) / len(self.latencies)
+
+    def percentiles(self, percents=(50, 90, 99)):
+        """
+        Return the percentiles of the latency, in milliseconds.
+
+        :rtype: List[float]
+        """
+
+        if not self.latencies:
+            return [0.0] * len(percents)
+        if numpy is not None:
+            return numpy.percentile(self.latencies, percents).tolist()
+        latencies = sorted(self.latencies)
+        return [_percentile(latencies, percent) for percent in percents]
+
+    def throughput(self, window=1.0):
+        """
+        Return the bytes per second received in every window of time.
+
+        :rtype: List[float]
+        """
+
+        bins = int(math.ceil(self.duration / window)) or 1
+        if numpy is not None:
+            indexes = numpy.minimum(
+                numpy.asarray(self.departures) // window, bins - 1)
+            counts = numpy.bincount(indexes.astype(int), minlength=bins)
+            return (counts * (self.size / window)).tolist()
+        counts = collections.Counter(min(int(t // window), bins - 1)
+                                     for t in self.departures)
+        return [counts[i] * self.size / window for i in range(bins)]
+
+    def summary(self):
+        p50, p90, p99 = self.percentiles()
+        received = self.received * self.size
+        return {
+            "sent": self.sent,
+            "received": self.received,
+            "lost": self.lost,
+            "dropped": self.dropped,
+            "loss_rate": self.loss_rate(),
+            "latency_mean": self.mean_latency(),
+            "latency_p50": p50,
+            "latency_p90": p90,
+            "latency_p99": p99,
+            "throughput": received / self.duration if self.duration else 0.0,
+        }
+
+
+def simulate(states, weights, period, duration=10.0, rate=None, size=1000,
+             direction=LR, start=0, seed=None):
+    """
+    Simulate a constant bit rate stream through a Markov channel model.
+
+    :param states: the configuration of every state.
+    :type states: List[virtualbricks.wires.NetemuConfig]
+    :param weights: the transition weights between the states.
+    :type weights: virtualbricks.markov.TransitionMatrix
+    :param int period: the transition period in milliseconds.
+    :param float duration: the seconds of traffic to simulate.
+    :param float rate: the bytes per second sent, by default the highest
+        bandwidth of the states.
+    :param int size: the size of the packets in bytes.
+    :param str direction: LR or RL.
+    :param int start: the initial state.
+    :param seed: the seed of the random generator.
+    :rtype: SimulationResult
+    :raises ValueError: if the model is not valid.
+    """
+
+    if direction not in (LR, RL):
+        raise ValueError(_("Invalid direction {0}").format(direction))
+    if period <= 0:
+        raise ValueError(_("Invalid transition period {0}").format(period))
+    weights.validate()
+    channel = _channel(states, direction)
+    if rate is None:
+        rate = max(channel["bandwidth"]) or DEFAULT_RATE
+    count = int(duration * rate / size)
+    steps = int(duration * 1000 // period) + 1
+    rng = _Random(seed)
+    path = _sample_path(weights, start, steps, rng.uniform(steps))
+    interval = size / rate
+    if numpy is not None:
+        arrivals = numpy.arange(count) * interval
+        current = numpy.asarray(path)[
+            (arrivals * 1000 // period).astype(int)]
+        loss = numpy.asarray(channel["loss"], dtype=float)[current]
+        kept = rng.uniform(count) * 100 >= loss
+        current = current[kept]
+        bandwidth = numpy.asarray(channel["bandwidth"], dtype=float)[current]
+        service = numpy.divide(size, bandwidth,
+                               out=numpy.zeros_like(bandwidth),
+                               where=bandwidth > 0)
+        delay = numpy.asarray(channel["delay"], dtype=float)[current] / 1000
+        buffers = numpy.asarray(channel["chanbufsize"])[current]
+        packets = zip(arrivals[kept].tolist(), service.tolist(),
+                      delay.tolist(), buffers.tolist())
+        lost = count - int(kept.sum())
+    else:
+        loss = channel["loss"]
+        bandwidth = channel["bandwidth"]
+        delay = channel["delay"]
+        buffers = channel["chanbufsize"]
+        packets = []
+        for i, u in enumerate(rng.uniform(count)):
+            arrival = i * interval
+            state = path[int(arrival * 1000 // period)]
+            if u * 100 >= loss[state]:
+                packets.append((arrival,
+                                size / bandwidth[state] if bandwidth[state]
+                                else 0.0,
+                                delay[state] / 1000,
+                                buffers[state]))
+        lost = count - len(packets)
+    dropped, latencies, departures = _serve(packets, size)
+    return SimulationResult(duration, size, count, lost, dropped, latencies,
+                            departures)
+
+
+def _serve(packets, size):
+    # the queue holds the time every packet waiting finishes transmission
+    queue = collections.deque()
+    free = 0.0
+    dropped = 0
+    latencies = []
+    departures = []
+    for arrival, service, delay, buffer in packets:
+        while queue and queue[0] <= arrival:
+            queue.popleft()
+        if buffer and (len(queue) + 1) * size > buffer:
+            dropped += 1
+            continue
+        free = max(free, arrival) + service
+        queue.append(free)
+        departures.append(free + delay)
+        latencies.append((free + delay - arrival) * 1000)
+    return dropped, latencies, departures
+
+
+def simulate_brick(netemu, **kwds):
+    """
+    Simulate the channel of a Netemu brick, from its startup state.
+
+    :type netemu: virtualbricks.wires.Netemu
+    :rtype: SimulationResult
+    """
+
+    manager = netemu.markov_manager
+    if manager is None:
+        netemu.init_markov()
+        manager = netemu.markov_manager
+    kwds.setdefault("start", netemu.startupState)
+    return simulate(manager.states, manager.weights, netemu.transPeriod,
+                    **kwds)
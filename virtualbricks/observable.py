@@ -1,3 +1,4 @@
+# -*- test-case-name: virtualbricks.tests.test_observable -*-
 # Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
 # Copyright (C) 2019 Virtualbricks team
 
@@ -16,13 +17,39 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import contextlib
+import inspect
+import weakref
+
+
+def _observer_key(callback, args, kwds):
+    return callback, args, tuple(sorted(kwds.items()))
+
+
+def _weak_callback(callback, pruner):
+    if inspect.ismethod(callback):
+        return weakref.WeakMethod(callback, pruner)
+    return weakref.ref(callback, pruner)
+
+
 class Observable:
-    # TODO: investigate if weakref.WeakValueDictionary can be used to ease the
-    # disponse of observables.
+    """
+    The observers of every event are kept in an ordered dict keyed by
+    (callback, args, kwds), so the arguments must be hashable.
+
+    A weak observer does not keep its callback alive: when the callback, or
+    the object of a bound method, is collected the observer is removed.
+    """
 
-    def __init__(self, *names):
+    def __init__(self, *names, clock=None):
         self.__events = {}
+        self.__coalesced = set()
+        self.__pending = {}
+        self.__batch_depth = 0
+        self.__delayed = None
+        self.__clock = clock
         self._thawed = False
+        self._thaw_count = 0
         for name in names:
             self.add_event(name)
 
@@ -32,24 +59,97 @@ class Observable:
     def add_event(self, name):
         if name in self.__events:
             raise ValueError("Event %s already present" % name)
-        self.__events[name] = []
+        self.__events[name] = {}
 
-    def add_observer(self, name, callback, args, kwds):
+    def set_coalesce(self, name, coalesce=True):
+        """
+        In coalescing mode, the notifications of an event are not delivered
+        immediately but once per reactor turn, and repeated notifications
+        from the same emitter are collapsed into one.
+        """
+
+        assert name in self.__events, f'Event {name} not present'
+        if coalesce:
+            self.__coalesced.add(name)
+        else:
+            self.__coalesced.discard(name)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Hold back every notification until the end of the block, then deliver
+        them once for each emitter, in order. Batches can be nested.
+        """
+
+        self.__batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.__batch_depth -= 1
+            if self.__batch_depth == 0:
+                self.flush()
+
+    def flush(self):
+        """Deliver the pending notifications."""
+
+        if self.__delayed is not None:
+            if self.__delayed.active():
+                self.__delayed.cancel()
+            self.__delayed = None
+        while self.__pending:
+            pending, self.__pending = self.__pending, {}
+            for (name, _id), emitter in pending.items():
+                self._deliver(name, emitter)
+
+    def add_observer(self, name, callback, args, kwds, weak=False):
         assert callable(callback), f'{callable!r} is not callable'
         assert name in self.__events, f'Event {name} not present'
-        assert (callback, args, kwds) not in self.__events[name]
-        self.__events[name].append((callback, args, kwds))
+        observers = self.__events[name]
+        if weak:
+            def prune(ref):
+                observers.pop(_observer_key(ref, args, kwds), None)
+            callback = _weak_callback(callback, prune)
+        key = _observer_key(callback, args, kwds)
+        assert key not in observers
+        observers[key] = callback, args, kwds, weak
 
     def remove_observer(self, name, callback, args, kwds):
         assert callable(callback), f'{callable!r} is not callable'
         assert name in self.__events, f'Event {name} not present'
-        self.__events[name].remove((callback, args, kwds))
+        observers = self.__events[name]
+        if observers.pop(_observer_key(callback, args, kwds), None) is None:
+            try:
+                key = _observer_key(_weak_callback(callback, None), args, kwds)
+            except TypeError:
+                key = None
+            if observers.pop(key, None) is None:
+                raise ValueError(f'{callback!r} is not an observer of {name}')
 
     def notify(self, name, emitter):
         assert name in self.__events, f'Event {name} not present'
-        if not self._thawed:
-            for callback, args, kwds in self.__events[name]:
-                callback(emitter, *args, **kwds)
+        if self._thawed:
+            return
+        if self.__batch_depth or name in self.__coalesced:
+            self.__pending.setdefault((name, id(emitter)), emitter)
+            if not self.__batch_depth and self.__delayed is None:
+                self.__delayed = self._get_clock().callLater(0, self.flush)
+        else:
+            self._deliver(name, emitter)
+
+    def _deliver(self, name, emitter):
+        # an observer can remove itself or be pruned during the delivery
+        for callback, args, kwds, weak in tuple(self.__events[name].values()):
+            if weak:
+                callback = callback()
+                if callback is None:
+                    continue
+            callback(emitter, *args, **kwds)
+
+    def _get_clock(self):
+        if self.__clock is None:
+            from twisted.internet import reactor
+            self.__clock = reactor
+        return self.__clock
 
     def __len__(self):
         return len(self.__events)
@@ -63,7 +163,8 @@ class Signal:
     def __init__(self, observable, name):
         self.__observable = observable
         self.__name = name
-        self.__thawed = False
+        self._thawed = False
+        self._thaw_count = 0
         try:
             observable.add_event(name)
         except ValueError:
@@ -73,33 +174,52 @@ class Signal:
         assert callable(callback), f'{callable!r} is not callable'
         self.__observable.add_observer(self.__name, callback, args, kwds)
 
+    def connect_weak(self, callback, *args, **kwds):
+        """
+        Like connect() but the observer is removed when the callback is
+        garbage collected. Useful for the callbacks of dialogs and views.
+        """
+
+        assert callable(callback), f'{callable!r} is not callable'
+        self.__observable.add_observer(self.__name, callback, args, kwds,
+                                       weak=True)
+
     def disconnect(self, callback, *args, **kwds):
         assert callable(callback), f'{callable!r} is not callable'
         self.__observable.remove_observer(self.__name, callback, args, kwds)
 
     def notify(self, emitter):
-        if not self.__thawed:
+        if not self._thawed:
             self.__observable.notify(self.__name, emitter)
 
     def thaw(self):
         return ThawingSignalContextManager(self)
 
+    def set_coalesce(self, coalesce=True):
+        self.__observable.set_coalesce(self.__name, coalesce)
+
+    def batch(self):
+        return self.__observable.batch()
+
 
 Event = Signal
 
 
 class ThawingSignalContextManager:
+    """
+    Suppress the notifications of a signal or an observable inside the block.
+    The count is kept on the context so that nested blocks work.
+    """
 
     def __init__(self, signal_or_observer):
         self.context = signal_or_observer
-        self.count = 0
 
     def __enter__(self):
-        self.counter += 1
+        self.context._thaw_count += 1
         self.context._thawed = True
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self.counter > 0:
-            self.counter -= 1
-            if self.counter == 0:
+        if self.context._thaw_count > 0:
+            self.context._thaw_count -= 1
+            if self.context._thaw_count == 0:
                 self.context._thawed = False
@@ -289,6 +289,21 @@ class Project:
                     self.create()
                     return self.save(factory, True)
             raise
+        self._save_description()
+
+    def save_async(self, factory):
+        """
+        Like save() but the project file is written in a thread.
+
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+
+        if not self._path.isdir():
+            self.create()
+        self._save_description()
+        return configfile.save_async(factory, self._project.path)
+
+    def _save_description(self):
         if self._description_modified:
             text = self._description
             with open(self._path.child('README').path, 'wt') as fp:
@@ -411,8 +426,15 @@ class ProjectManager:
         return self.archive.create(output, files, images)
 
     def save_current(self, factory):
+        """
+        Save the current project in a thread.
+
+        :rtype: twisted.internet.defer.Deferred[None]
+        """
+
         if self.current:
-            self.current.save(factory)
+            return self.current.save_async(factory)
+        return defer.succeed(None)
 
     def restore_last(self, factory, settings=settings):
         """Restore the last project if found or create a new one."""
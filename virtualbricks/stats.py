@@ -0,0 +1,318 @@
+# -*- test-case-name: virtualbricks.tests.test_stats -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Collect the statistics of the ports of the running switches.
+"""
+
+import array
+import csv
+import re
+import weakref
+
+from twisted.internet import defer, reactor, task
+
+from virtualbricks import log, settings
+
+
+__all__ = ["PortSeries", "StatsCollector", "collector", "parse_fstp",
+           "parse_ports"]
+
+if False:  # pyflakes
+    _ = str
+
+
+logger = log.Logger()
+poll_failed = log.Event("Cannot collect the statistics of {switch}: "
+                        "{error}")
+
+PORT = re.compile(r"^\s*Port\s+(\d+)")
+COUNTERS = re.compile(r"^\s*(IN|OUT):\s+pkts\s+(\d+)\s+bytes\s+(\d+)")
+FSTP_PORT = re.compile(r"Port\s+(\d+)")
+FSTP_STATE = re.compile(r"\b(forwarding|learning|blocking|discarding|"
+                        r"listening|disabled)\b", re.IGNORECASE)
+
+
+def parse_ports(lines):
+    """
+    Parse the output of port/print.
+
+    :type lines: List[str]
+    :return: a mapping from the port number to its counters: packets in,
+        bytes in, packets out, bytes out. The counters are zero if the switch
+        was built without port counters.
+    :rtype: Dict[int, Tuple[int, int, int, int]]
+    """
+
+    ports = {}
+    port = None
+    for line in lines:
+        match = PORT.match(line)
+        if match:
+            port = int(match.group(1))
+            ports[port] = [0, 0, 0, 0]
+            continue
+        match = COUNTERS.match(line)
+        if match and port is not None:
+            offset = 0 if match.group(1) == "IN" else 2
+            ports[port][offset] = int(match.group(2))
+            ports[port][offset + 1] = int(match.group(3))
+    return dict((port, tuple(counters)) for port, counters in ports.items())
+
+
+def parse_fstp(lines):
+    """
+    Parse the output of fstp/print.
+
+    :type lines: List[str]
+    :return: a mapping from the port number to its FSTP state.
+    :rtype: Dict[int, str]
+    """
+
+    states = {}
+    for line in lines:
+        port = FSTP_PORT.search(line)
+        state = FSTP_STATE.search(line)
+        if port and state:
+            states[int(port.group(1))] = state.group(1).lower()
+    return states
+
+
+class PortSeries:
+    """
+    The time series of the counters of a port, in a ring buffer of fixed
+    capacity backed by arrays.
+    """
+
+    __slots__ = ("capacity", "times", "counters", "start", "size", "fstp")
+    FIELDS = ("pkts_in", "bytes_in", "pkts_out", "bytes_out")
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array.array("d", bytes(8 * capacity))
+        self.counters = array.array("Q", bytes(8 * 4 * capacity))
+        self.start = 0
+        self.size = 0
+        self.fstp = None
+
+    def __len__(self):
+        return self.size
+
+    def append(self, time, counters):
+        if self.size < self.capacity:
+            index = (self.start + self.size) % self.capacity
+            self.size += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[index] = time
+        self.counters[index * 4:index * 4 + 4] = array.array("Q", counters)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        index = (self.start + i) % self.capacity
+        return (self.times[index],
+                tuple(self.counters[index * 4:index * 4 + 4]))
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def throughput(self, window=None):
+        """
+        Return the bytes per second received and sent by the port.
+
+        :param float window: the seconds to look back, all the samples if
+            None.
+        :rtype: Tuple[float, float]
+        """
+
+        if self.size < 2:
+            return 0.0, 0.0
+        last_time, last = self[-1]
+        first = 0
+        if window is not None:
+            while (first < self.size - 2 and
+                    last_time - self[first][0] > window):
+                first += 1
+        first_time, counters = self[first]
+        elapsed = last_time - first_time
+        if elapsed <= 0:
+            return 0.0, 0.0
+        # the counters start again from zero if the switch was restarted
+        bytes_in = max(last[1] - counters[1], 0)
+        bytes_out = max(last[3] - counters[3], 0)
+        return bytes_in / elapsed, bytes_out / elapsed
+
+
+class StatsCollector:
+    """
+    Poll the running switches every ``interval`` seconds, all of them
+    concurrently, and record the counters of their ports.
+
+    A switch is not polled again until the previous poll is answered.
+    """
+
+    clock = reactor
+    capacity = 360
+
+    def __init__(self, factory, interval=None, capacity=None):
+        self.factory = factory
+        if interval is None:
+            interval = float(settings.get("stats_interval")) or 10.0
+        self.interval = interval
+        if capacity is not None:
+            self.capacity = capacity
+        self.series = {}
+        self._pending = set()
+        self._loop = None
+
+    @property
+    def running(self):
+        return self._loop is not None
+
+    def start(self, interval=None):
+        if interval is not None:
+            self.interval = interval
+        if self._loop is None:
+            self._loop = task.LoopingCall(self._tick)
+            self._loop.clock = self.clock
+            self._loop.start(self.interval)
+        return self
+
+    def stop(self):
+        if self._loop is not None:
+            loop, self._loop = self._loop, None
+            loop.stop()
+
+    def switches(self):
+        return [brick for brick in self.factory.bricks
+                if brick.get_type() == "Switch" and brick.proc is not None]
+
+    def _tick(self):
+        # the loop must not wait for the polls, a switch that does not
+        # answer would delay all the others
+        self.poll()
+
+    def poll(self):
+        """
+        Poll all the running switches.
+
+        :return: a Deferred fired when all the switches answered.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        deferreds = []
+        for switch in self.switches():
+            if switch.name not in self._pending:
+                self._pending.add(switch.name)
+                deferreds.append(self._poll(switch))
+        return defer.DeferredList(deferreds)
+
+    def _poll(self, switch):
+        requests = [switch.send_command(b"port/print")]
+        if switch.config["fstp"]:
+            requests.append(switch.send_command(b"fstp/print"))
+        deferred = defer.gatherResults(requests, consumeErrors=True)
+        deferred.addCallback(self._record, switch.name)
+        deferred.addErrback(self._failed, switch.name)
+        return deferred.addBoth(self._done, switch.name)
+
+    def _record(self, responses, name):
+        now = self.clock.seconds()
+        ports = self.series.setdefault(name, {})
+        states = {}
+        if len(responses) > 1:
+            states = parse_fstp(responses[1].body)
+        for port, counters in parse_ports(responses[0].body).items():
+            try:
+                series = ports[port]
+            except KeyError:
+                series = ports[port] = PortSeries(self.capacity)
+            series.append(now, counters)
+            series.fstp = states.get(port)
+
+    def _failed(self, fail, name):
+        fail.trap(defer.FirstError)
+        logger.warn(poll_failed, switch=name,
+                    error=fail.value.subFailure.getErrorMessage())
+
+    def _done(self, result, name):
+        self._pending.discard(name)
+        return result
+
+    def throughput(self, name, window=None):
+        """
+        Return the throughput of the ports of a switch.
+
+        :type name: str
+        :rtype: Dict[int, Tuple[float, float]]
+        """
+
+        return dict((port, series.throughput(window))
+                    for port, series in self.series.get(name, {}).items())
+
+    def top(self, n=10, window=None):
+        """
+        Return the n ports with the highest throughput, in and out summed.
+
+        :rtype: List[Tuple[str, int, float, float]]
+        """
+
+        ports = []
+        for name in self.series:
+            for port, (tin, tout) in self.throughput(name, window).items():
+                ports.append((name, port, tin, tout))
+        ports.sort(key=lambda p: p[2] + p[3], reverse=True)
+        return ports[:n]
+
+    def export(self, fileobj):
+        """
+        Write all the samples collected as CSV.
+
+        :param fileobj: a file opened in text mode.
+        """
+
+        writer = csv.writer(fileobj)
+        writer.writerow(("switch", "port", "time") + PortSeries.FIELDS +
+                        ("fstp", ))
+        for name, ports in sorted(self.series.items()):
+            for port, series in sorted(ports.items()):
+                for time, counters in series:
+                    writer.writerow((name, port, "%.3f" % time) + counters +
+                                    (series.fstp or "", ))
+
+
+_collectors = weakref.WeakKeyDictionary()
+
+
+def collector(factory):
+    """
+    Return the statistics collector of the factory, create it if needed.
+
+    :rtype: StatsCollector
+    """
+
+    try:
+        return _collectors[factory]
+    except KeyError:
+        stats = _collectors[factory] = StatsCollector(factory)
+        return stats
@@ -0,0 +1,171 @@
+# -*- test-case-name: virtualbricks.tests.test_supervisor -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import collections
+
+from twisted.internet import error
+import constantly as constants
+
+from virtualbricks import log
+
+
+if False:  # pyflakes
+    _ = str
+
+
+logger = log.Logger()
+restart_scheduled = log.Event("Process of {brick} ended, restarting in "
+                              "{delay:.1f} seconds")
+restart_give_up = log.Event("Process of {brick} restarted {restarts} times "
+                            "in {window} seconds, giving up")
+restart_failed = log.Event("Cannot restart {brick}")
+restart_dependent_failed = log.Event("Cannot restart {dependent} after the "
+                                     "restart of {brick}")
+
+
+class RestartPolicy(constants.Names):
+
+    NEVER = constants.NamedConstant()
+    ON_FAILURE = constants.NamedConstant()
+    ALWAYS = constants.NamedConstant()
+
+
+def policy_by_name(name):
+    """
+    Return the restart policy with the given name, ex. "on-failure".
+
+    :type name: str
+    :rtype: RestartPolicy
+    :raise ValueError: if the policy does not exist.
+    """
+
+    try:
+        return RestartPolicy.lookupByName(name.upper().replace("-", "_"))
+    except ValueError:
+        raise ValueError(_("Invalid restart policy %s") % name)
+
+
+class Supervisor:
+    """
+    Restart the process of a brick when it ends unexpectedly.
+
+    The restart is delayed with an exponential backoff, ``backoff *
+    factor ** n`` seconds up to ``max_backoff``, where n is the number of
+    restarts in the last ``window`` seconds. After ``max_restarts`` restarts
+    in the window the supervisor gives up.
+
+    If ``restart_dependents`` is True, when the brick is up again the
+    running bricks plugged into it are restarted too, because their
+    connection to the brick is lost. It is off by default because the
+    restart of a virtual machine throws away the state of the guest.
+    """
+
+    restarts = 0
+    delayed = None
+
+    def __init__(self, brick, policy=RestartPolicy.ON_FAILURE, backoff=1.0,
+                 factor=2.0, max_backoff=60.0, max_restarts=5, window=60.0,
+                 restart_dependents=False, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.brick = brick
+        self.policy = policy
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.max_restarts = max_restarts
+        self.window = window
+        self.restart_dependents = restart_dependents
+        self.clock = clock
+        self._history = collections.deque()
+
+    def should_restart(self, status, requested):
+        """
+        :param twisted.python.failure.Failure status: how the process ended.
+        :param bool requested: if the process was stopped by the user.
+        :rtype: bool
+        """
+
+        if requested or self.policy is RestartPolicy.NEVER:
+            return False
+        if self.policy is RestartPolicy.ON_FAILURE:
+            return not status.check(error.ProcessDone)
+        return True
+
+    def process_ended(self, status, requested):
+        if not self.should_restart(status, requested):
+            return
+        now = self.clock.seconds()
+        while self._history and self._history[0] <= now - self.window:
+            self._history.popleft()
+        if len(self._history) >= self.max_restarts:
+            logger.error(restart_give_up, brick=self.brick.name,
+                         restarts=len(self._history), window=self.window)
+            return
+        delay = min(self.backoff * self.factor ** len(self._history),
+                    self.max_backoff)
+        self._history.append(now)
+        logger.warn(restart_scheduled, brick=self.brick.name, delay=delay)
+        self.delayed = self.clock.callLater(delay, self._restart)
+
+    def _restart(self):
+        self.delayed = None
+        self.restarts += 1
+        deferred = self.brick.poweron()
+        if self.restart_dependents:
+            deferred.addCallback(self._restart_dependents)
+        deferred.addErrback(self._log_failure)
+        return deferred
+
+    def _restart_dependents(self, brick):
+        for dependent in brick.dependents():
+            if dependent.proc is not None:
+                deferred = dependent.restart()
+                deferred.addErrback(logger.failure_eb,
+                                    restart_dependent_failed,
+                                    brick=brick.name, dependent=dependent.name)
+        return brick
+
+    def _log_failure(self, fail):
+        logger.failure(restart_failed, fail, brick=self.brick.name)
+
+    def stop(self):
+        """Cancel a scheduled restart."""
+
+        if self.delayed is not None:
+            self.delayed.cancel()
+            self.delayed = None
+
+
+def supervise(brick, policy, **kwds):
+    """
+    Install a supervisor on the brick, or remove it if the policy is NEVER.
+
+    :type brick: virtualbricks.bricks.Brick
+    :type policy: RestartPolicy
+    :param kwds: the other parameters of Supervisor.
+    :rtype: Optional[Supervisor]
+    """
+
+    if brick.supervisor is not None:
+        brick.supervisor.stop()
+    if policy is RestartPolicy.NEVER:
+        brick.supervisor = None
+    else:
+        brick.supervisor = Supervisor(brick, policy, **kwds)
+    return brick.supervisor
@@ -47,7 +47,7 @@ class Switch(bricks.Brick):
     def set_name(self, name):
         self._name = name
         for so in self.socks:
-            so.nickname = name + "_port"
+            self.factory.rename_sock(so, name + "_port")
             so.path = os.path.join(settings.VIRTUALBRICKS_HOME, name + ".ctl")
 
     name = property(bricks.Brick.get_name, set_name)
@@ -17,6 +17,7 @@
 
 import os
 import sys
+import time
 import functools
 import difflib
 
@@ -28,6 +29,7 @@ from virtualbricks import settings
 __builtins__["_"] = str
 TEST_THREADS = 0x01
 TEST_DEPLOYMENT = 0x02
+TEST_BENCHMARK = 0x04
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), "data")
 
 
@@ -39,6 +41,27 @@ def should_test_deployment():
     return int(os.environ.get("VIRTUALBRICKS_TESTS", 0)) & TEST_DEPLOYMENT
 
 
+def should_test_benchmark():
+    return int(os.environ.get("VIRTUALBRICKS_TESTS", 0)) & TEST_BENCHMARK
+
+
+def benchmark(name, func, *args, **kwds):
+    """
+    Call func once and report the elapsed time on stdout.
+
+    :param str name: the label used in the report.
+    :param Callable func: the function to measure.
+    :return: the elapsed time in seconds.
+    :rtype: float
+    """
+
+    start = time.perf_counter()
+    func(*args, **kwds)
+    elapsed = time.perf_counter() - start
+    sys.stdout.write("\n{0}: {1:.3f}s\n".format(name, elapsed))
+    return elapsed
+
+
 def _id(obj):
     return obj
 
@@ -17,9 +17,12 @@
 
 import os
 import copy
+import tracemalloc
 
 from virtualbricks import base, _configparser
-from virtualbricks.tests import unittest, stubs
+from virtualbricks.virtualmachines import VirtualMachineConfig
+from virtualbricks.tests import (unittest, stubs, benchmark,
+                                 should_test_benchmark, skipUnless)
 
 
 marker = object()
@@ -121,6 +124,71 @@ class TestConfig(unittest.TestCase):
         self.assertIsNot(cfg, self.config2)
         self.assertIs(cfg["obj"], self.config2["obj"])
 
+    def test_class_parameters(self):
+        """
+        The class attribute holds only the declared parameters, the instance
+        attribute all of them.
+        """
+
+        self.assertEqual(sorted(Config2.parameters), ["int", "spinint"])
+        self.assertEqual(sorted(self.config2.parameters),
+                         ["bool", "float", "int", "obj", "spinint", "str"])
+        self.assertIs(self.config2.parameters["int"],
+                      Config2.parameters["int"])
+
+    def test_schema_shared(self):
+        """The schema is computed once per class."""
+
+        self.assertIs(self.config2._schema, Config2()._schema)
+        self.assertIsNot(self.config1._schema, self.config2._schema)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.config2, "__dict__"))
+        self.assertRaises(AttributeError, setattr, self.config2, "foo", 1)
+
+    def test_equality(self):
+        other = Config2()
+        self.assertEqual(self.config2, other)
+        other["str"] = "b"
+        self.assertNotEqual(self.config2, other)
+        self.assertEqual(other, dict(other.items()))
+        self.assertNotEqual(self.config1, self.config2)
+
+    def test_remove_parameter(self):
+        self.assertRaises(TypeError, self.config2.__delitem__, "str")
+
+    def test_generation(self):
+        """The generation changes only when a value changes."""
+
+        generation = self.config2.generation
+        self.config2["str"] = "a"
+        self.assertEqual(self.config2.generation, generation)
+        self.config2["str"] = "b"
+        self.assertNotEqual(self.config2.generation, generation)
+        self.assertNotEqual(copy.copy(self.config2).generation,
+                            self.config2.generation)
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestConfigBenchmark(unittest.TestCase):
+
+    def test_instantiate_10k_configs(self):
+        def instantiate():
+            for i in range(10000):
+                VirtualMachineConfig()
+
+        benchmark("instantiate 10k virtual machine configs", instantiate)
+
+    def test_memory_10k_configs(self):
+        tracemalloc.start()
+        self.addCleanup(tracemalloc.stop)
+        before = tracemalloc.get_traced_memory()[0]
+        configs = [VirtualMachineConfig() for i in range(10000)]
+        size = tracemalloc.get_traced_memory()[0] - before
+        print("\nmemory of 10k virtual machine configs: {0:.1f} KiB".format(
+            size / 1024.0))
+        self.assertEqual(len(configs), 10000)
+
 
 class TestTypes(unittest.TestCase):
 
@@ -20,11 +20,13 @@ import errno
 import signal
 
 from twisted.trial import unittest
-from twisted.internet import error, defer
+from twisted.internet import error, defer, task
+from twisted.python import failure
 from twisted.test import proto_helpers
 
-from virtualbricks import errors, link, bricks
-from virtualbricks.tests import stubs, successResultOf
+from virtualbricks import errors, link, bricks, mgmt
+from virtualbricks.tests import (stubs, successResultOf, benchmark,
+                                 should_test_benchmark, skipUnless)
 
 
 def kill(passthru, brick):
@@ -169,6 +171,107 @@ class TestBricks(unittest.TestCase):
         pass
 
 
+class FakeConnection:
+
+    def __init__(self, pool, path):
+        self.pool = pool
+        self.path = path
+
+    def send_command(self, cmd):
+        self.pool.commands.append((self.path, cmd))
+        return defer.succeed(None)
+
+    def write_batch(self, commands):
+        self.pool.commands.extend((self.path, cmd) for cmd in commands)
+        return defer.succeed(None)
+
+
+class FakePool:
+
+    refuse = False
+
+    def __init__(self):
+        self.commands = []
+
+    def connect(self, path, retries=None):
+        if self.refuse:
+            return defer.fail(error.ConnectionRefusedError())
+        return defer.succeed(FakeConnection(self, path))
+
+
+class TestManagementSocket(unittest.TestCase):
+    """
+    The commands to a process not started by this instance are sent through
+    its management socket.
+    """
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.patch(mgmt, "pool", self.pool)
+        self.path = self.mktemp()
+        open(self.path, "w").close()
+        self.factory = stubs.Factory()
+
+    def new_brick(self, type, name):
+        brick = self.factory.new_brick(type, name)
+        brick.console = lambda: self.path
+        return brick
+
+    def test_send(self):
+        switch = self.new_brick("switch", "sw")
+        switch.set({"numports": 8})
+        self.assertEqual(self.pool.commands,
+                         [(self.path, b"port/setnumports 8\n")])
+
+    def test_batch_set(self):
+        switch = self.new_brick("switch", "sw")
+        successResultOf(self, switch.batch_set({"numports": 8, "hub": True}))
+        self.assertEqual(sorted(self.pool.commands),
+                         [(self.path, b"port/sethub 1\n"),
+                          (self.path, b"port/setnumports 8\n")])
+
+    def test_no_socket(self):
+        switch = self.new_brick("switch", "sw")
+        os.remove(self.path)
+        switch.set({"numports": 8})
+        self.assertEqual(self.pool.commands, [])
+
+    def test_stale_socket(self):
+        """
+        A socket that does not accept connections is a leftover, the
+        configuration of the brick is changed anyway.
+        """
+
+        self.pool.refuse = True
+        switch = self.new_brick("switch", "sw")
+        successResultOf(self, switch.batch_set({"numports": 64}))
+        self.assertEqual(switch.config["numports"], 64)
+        switch.set({"numports": 8})
+        self.assertEqual(switch.config["numports"], 8)
+        self.assertEqual(self.flushLoggedErrors(), [])
+
+    def test_started_here(self):
+        """
+        The socket of a process started by this instance is never used,
+        when the process is stopped the socket is a leftover.
+        """
+
+        switch = self.new_brick("switch", "sw")
+        switch._spawned = True
+        successResultOf(self, switch.batch_set({"numports": 64}))
+        self.assertEqual(self.pool.commands, [])
+        self.failureResultOf(switch.send_command(b"port/print"),
+                             errors.BrickNotRunningError)
+
+    def test_netemu_update(self):
+        netemu = self.new_brick("netemu", "ne")
+        netemu.set({"delay": 10})
+        del self.pool.commands[:]
+        successResultOf(self, netemu.update())
+        self.assertIn((self.path, b"markov-numnodes 1\n"),
+                      self.pool.commands)
+
+
 class TestVDEProcessProtocol(unittest.TestCase):
 
     CMD1 = b"bandwidth LR 125000"
@@ -179,7 +282,9 @@ class TestVDEProcessProtocol(unittest.TestCase):
         brick = bricks.Brick(stubs.Factory(), "test")
         brick._started_d = defer.Deferred()
         brick._exited_d = defer.Deferred()
-        self.proto = bricks.VDEProcessProtocol(brick)
+        self.proto = bricks.VDEProcessProtocol(brick, pipeline_size=1,
+                                               timeout=10)
+        self.proto.clock = self.clock = task.Clock()
         self.transport = proto_helpers.StringTransport()
         self.transport.pid = -1
         self.proto.makeConnection(self.transport)
@@ -209,3 +314,114 @@ class TestVDEProcessProtocol(unittest.TestCase):
         self.assertEqual(len(self.proto.queue), 0)
         self.proto.data_received(self.PROMPT)
         self.assertTrue(self.transport.disconnecting)
+
+    def test_response(self):
+        """The Deferred is fired with the parsed response of the process."""
+
+        deferred = self.proto.send_command(b"port/print 1")
+        self.proto.data_received(
+            b"0000 DATA END WITH '.'\nPort 0001 untagged_vlan=0000 ACTIVE\n"
+            b".\n1000 Success\n\n" + self.PROMPT)
+        response = successResultOf(self, deferred)
+        self.assertEqual(response.code, 0)
+        self.assertEqual(response.message, "Success")
+        self.assertEqual(response.body,
+                         ["Port 0001 untagged_vlan=0000 ACTIVE"])
+
+    def test_rejected(self):
+        """If the process returns an error code, the Deferred fails."""
+
+        deferred = self.proto.send_command(self.CMD1)
+        self.proto.data_received(b"1022 Invalid argument\n" + self.PROMPT)
+        fail = self.failureResultOf(deferred, errors.CommandRejectedError)
+        self.assertEqual(fail.value.code, 22)
+        self.assertEqual(fail.value.message, "Invalid argument")
+
+    def test_pipeline(self):
+        """Up to pipeline_size commands are sent before their ACK."""
+
+        self.proto.pipeline_size = 2
+        for cmd in self.CMD1, self.CMD2, self.CMD1:
+            self.proto.send_command(cmd)
+        self.assertEqual(self.transport.value(),
+                         self.CMD1 + b"\n" + self.CMD2 + b"\n")
+        self.transport.clear()
+        self.proto.data_received(self.PROMPT)
+        self.assertEqual(self.transport.value(), self.CMD1 + b"\n")
+
+    def test_timeout(self):
+        """
+        If the process does not reply in time, the Deferred fails but the
+        late reply is still matched to its command.
+        """
+
+        first = self.proto.send_command(self.CMD1)
+        second = self.proto.send_command(self.CMD2)
+        self.clock.advance(10)
+        self.failureResultOf(first, defer.TimeoutError)
+        self.proto.data_received(self.PROMPT)
+        self.assertNoResult(second)
+        self.proto.data_received(self.PROMPT)
+        self.assertEqual(successResultOf(self, second).code, 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_wait_writable(self):
+        """Producers wait until the queue falls under the low water mark."""
+
+        self.proto.high_water = 4
+        self.assertIs(successResultOf(self, self.proto.wait_writable()), None)
+        for i in range(4):
+            self.proto.send_command(self.CMD1)
+        deferred = self.proto.wait_writable()
+        self.proto.data_received(self.PROMPT)
+        self.assertNoResult(deferred)
+        self.proto.data_received(self.PROMPT)
+        successResultOf(self, deferred)
+        self.proto.data_received(self.PROMPT * 2)
+
+    def test_output_overflow(self):
+        """
+        With the ERROR policy, the connection is closed if the output is too
+        long.
+        """
+
+        self.proto._scanner = mgmt.PromptScanner(
+            self.proto.prompt, 16, mgmt.PromptScanner.ERROR)
+        self.proto.send_command(self.CMD1)
+        self.proto.data_received(b"x" * 17)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_process_ended(self):
+        """The commands waiting for a reply fail if the process ends."""
+
+        deferred = self.proto.send_command(self.CMD1)
+        self.proto.processEnded(failure.Failure(error.ProcessDone(0)))
+        self.failureResultOf(deferred, error.ProcessDone)
+        self.assertEqual(len(self.proto.queue), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestVDEProcessProtocolBenchmark(unittest.TestCase):
+
+    def test_parse_4mb_in_64_bytes_chunks(self):
+        brick = bricks.Brick(stubs.Factory(), "test")
+        brick._started_d = defer.Deferred()
+        proto = bricks.VDEProcessProtocol(brick, pipeline_size=1, timeout=10)
+        proto.clock = task.Clock()
+        transport = proto_helpers.StringTransport()
+        transport.pid = -1
+        proto.makeConnection(transport)
+        line = b"Port 0001 untagged_vlan=0000 ACTIVE - Unnamed Allocatable\n"
+        output = (b"0000 DATA END WITH '.'\n" +
+                  line * (4 * 1024 * 1024 // len(line)) +
+                  b".\n1000 Success\n\nvde$ ")
+        chunks = [output[i:i + 64] for i in range(0, len(output), 64)]
+        deferred = proto.send_command(b"port/allprint")
+
+        def feed():
+            for chunk in chunks:
+                proto.data_received(chunk)
+
+        benchmark("parse 4MB of output in 64 bytes chunks", feed)
+        self.assertEqual(successResultOf(self, deferred).code, 0)
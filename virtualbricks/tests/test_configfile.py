@@ -18,10 +18,13 @@
 import os
 import io
 
+from twisted.internet import defer, task
 from twisted.python import log, filepath
 
-from virtualbricks import configfile, _configparser
-from virtualbricks.tests import unittest, stubs, LoggingObserver, Skip
+from virtualbricks import (configfile, errors, settings, _configparser,
+                           virtualmachines)
+from virtualbricks.tests import (unittest, stubs, LoggingObserver, Skip,
+                                 benchmark, should_test_benchmark, skipUnless)
 
 def file_text_from_bytes(filepath):
     return filepath.getContent().decode('utf8')
@@ -68,8 +71,9 @@ class TestConfigFile(unittest.TestCase):
 
         self.assertEqual(configfile.__all__,
             ["BrickBuilder", "ConfigFile", "EventBuilder", "ImageBuilder",
-             "LinkBuilder", "SockBuilder", "log_events", "restore",
-             "safe_save", "save"])
+             "JSON", "Journal", "LinkBuilder", "SockBuilder", "TEXT",
+             "log_events", "replay_journal", "restore", "safe_save",
+             "safe_save_async", "save", "save_async"])
 
     def test_exported_log_events(self):
         """
@@ -83,7 +87,9 @@ class TestConfigFile(unittest.TestCase):
              configfile.cannot_restore_backup, configfile.backup_restored,
              configfile.image_found, configfile.skip_image,
              configfile.skip_image_noa, configfile.config_dump,
-             configfile.open_project, configfile.config_save_error])
+             configfile.open_project, configfile.config_save_error,
+             configfile.json_project_loaded, configfile.journal_replayed,
+             configfile.journal_truncated])
 
     def test_restore_backup_does_not_exists(self):
         """Try to restore a backup that does not exists."""
@@ -139,6 +145,175 @@ class TestConfigFile(unittest.TestCase):
         config.restore(factory, fp)
         self.assertIsNotNone(factory.get_brick_by_name("sender"))
 
+    def _full_save(self, factory):
+        fileobj = io.StringIO()
+        configfile.ConfigFile().save_to(factory, fileobj)
+        return fileobj.getvalue()
+
+    def _incremental_project(self):
+        factory = stubs.Factory()
+        factory.new_disk_image("martin", "/vimages/martin.qcow2")
+        for i in range(3):
+            factory.new_brick("switch", "sw{0}".format(i))
+            wire = factory.new_brick("wire", "wire{0}".format(i))
+            factory.connect_to(wire, "sw{0}_port".format(i))
+        factory.new_event("event")
+        return factory
+
+    def test_save_incremental(self):
+        """
+        An incremental save serializes again only the bricks that changed.
+        """
+
+        factory = self._incremental_project()
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+        serialized = []
+
+        def save_to(fileobj, brick):
+            serialized.append(brick.name)
+            type(brick).save_to(brick, fileobj)
+
+        for brick in factory.bricks:
+            self.patch(brick, "save_to", lambda f, b=brick: save_to(f, b))
+        factory.get_brick_by_name("sw1").set({"numports": 8})
+        factory.connect_to(factory.get_brick_by_name("wire0"), "sw1_port")
+        config.save(factory, fp)
+        # connecting wire0 changed it too
+        self.assertEqual(serialized, ["wire0", "sw1"])
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+
+    def test_save_incremental_new_and_removed(self):
+        factory = self._incremental_project()
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        factory.del_brick(factory.get_brick_by_name("wire1"))
+        factory.new_brick("switch", "sw3")
+        config.save(factory, fp)
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+
+    def test_save_incremental_file_changed(self):
+        """If the file was modified by someone else, it is fully rewritten."""
+
+        factory = self._incremental_project()
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        fp.setContent(b"garbage")
+        factory.get_brick_by_name("sw1").set({"numports": 8})
+        config.save(factory, fp)
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+
+    def test_save_incremental_image_changed(self):
+        """The virtual machines refer to the images, save everything."""
+
+        factory = self._incremental_project()
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        factory.get_image_by_name("martin").set_description("new")
+        config.save(factory, fp)
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+
+    def test_save_incremental_network_cards(self):
+        """
+        The network cards of the virtual machines are saved by an
+        incremental save.
+        """
+
+        factory = self._incremental_project()
+        machine = factory.new_brick("vm", "vm")
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        actions = [
+            lambda: machine.add_plug(virtualmachines.hostonly_sock),
+            lambda: machine.add_sock(),
+            lambda: machine.add_plug(None),
+            lambda: setattr(machine.plugs[0], "mac", "00:11:22:33:44:55"),
+            lambda: setattr(machine.plugs[0], "model", "e1000"),
+            lambda: machine.remove_plug(machine.plugs[1]),
+        ]
+        for action in actions:
+            action()
+            config.save(factory, fp)
+            self.assertEqual(file_text_from_bytes(fp),
+                             self._full_save(factory))
+
+    def test_save_incremental_netemu(self):
+        """The Markov model of a stopped Netemu is saved."""
+
+        factory = self._incremental_project()
+        netemu = factory.new_brick("netemu", "ne")
+        netemu.set({"delay": 10})
+        fp = filepath.FilePath(self.mktemp())
+        config = configfile.ConfigFile(incremental=True)
+        config.save(factory, fp)
+        netemu.markov_manager.states[0]["delay"] = 20
+        netemu.update()
+        config.save(factory, fp)
+        self.assertIn("delay=20", file_text_from_bytes(fp))
+        self.assertEqual(file_text_from_bytes(fp), self._full_save(factory))
+
+    def test_incremental_setting(self):
+        """By default the incremental save follows the settings."""
+
+        config = configfile.ConfigFile()
+        self.assertFalse(config.get_incremental())
+        self.patch(settings, "get", {"incremental_save": True}.get)
+        self.assertTrue(config.get_incremental())
+        self.assertFalse(
+            configfile.ConfigFile(incremental=False).get_incremental())
+
+    def _json_project(self):
+        image = self.mktemp()
+        with open(image, "w"):
+            pass
+        factory = stubs.Factory()
+        factory.new_disk_image("martin", image, "first\nsecond")
+        vm = factory.new_brick("vm", "vm")
+        vm.set({"hda": vm._getvalue("hda", "martin"), "ram": 256})
+        vm.add_sock("00:11:22:33:44:55", "e1000")
+        factory.new_brick("switch", "sw")
+        factory.connect_to(vm, "sw_port")
+        netemu = factory.new_brick("netemu", "ne")
+        netemu.set({"delay": 10})
+        netemu.markov_manager.add(1)
+        netemu.markov_manager.weights[0][1] = 30.0
+        factory.connect_to(netemu, "sw_port")
+        factory.new_event("event").set({"delay": 5})
+        return factory
+
+    def test_json_round_trip(self):
+        """A project saved as JSON is restored as it was."""
+
+        factory = self._json_project()
+        fileobj = io.StringIO()
+        configfile.ConfigFile(format=configfile.JSON).save_to(factory,
+                                                              fileobj)
+        self.assertTrue(fileobj.getvalue().startswith("{"))
+        restored = stubs.Factory()
+        fileobj.seek(0)
+        configfile.ConfigFile(format=configfile.TEXT).restore_from(restored,
+                                                                   fileobj)
+        self.assertEqual(self._full_save(restored), self._full_save(factory))
+
+    def test_json_unsupported_version(self):
+        fileobj = io.StringIO('{"format":"virtualbricks","version":1000}')
+        self.assertRaises(errors.BadConfigError,
+                          configfile.ConfigFile().restore_from,
+                          stubs.Factory(), fileobj)
+
+    def test_format_setting(self):
+        """By default the project format comes from the settings."""
+
+        self.patch(settings, "get", {"project_format": "json"}.get)
+        self.assertEqual(configfile.ConfigFile().get_format(),
+                         configfile.JSON)
+
     def _add_observer(self, event=None):
         observer = LoggingObserver()
         if event:
@@ -214,6 +389,250 @@ class TestConfigFile(unittest.TestCase):
         self.assertEqual(len(brick.plugs), 1)
 
 
+
+
+def _full_save(factory):
+    fileobj = io.StringIO()
+    configfile.ConfigFile().save_to(factory, fileobj)
+    return fileobj.getvalue()
+
+
+class TestSaveAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.factory.new_brick("switch", "sw")
+        self.fp = filepath.FilePath(self.mktemp())
+        self.config = configfile.ConfigFile()
+        self.writes = []
+        self.patch(self.config, "deferToThread", self.defer_to_thread)
+
+    def defer_to_thread(self, function, *args):
+        deferred = defer.Deferred()
+        self.writes.append((deferred, function, args))
+        return deferred
+
+    def complete(self):
+        deferred, function, args = self.writes.pop(0)
+        defer.maybeDeferred(function, *args).chainDeferred(deferred)
+
+    def test_save(self):
+        deferred = self.config.save_async(self.factory, self.fp)
+        self.assertTrue(self.factory.is_dirty())
+        self.complete()
+        self.assertIsNone(self.successResultOf(deferred))
+        self.assertFalse(self.factory.is_dirty())
+        self.assertEqual(file_text_from_bytes(self.fp),
+                         _full_save(self.factory))
+
+    def test_snapshot(self):
+        """The changes made after the request are not saved."""
+
+        deferred = self.config.save_async(self.factory, self.fp)
+        self.factory.new_brick("switch", "sw1")
+        self.complete()
+        self.successResultOf(deferred)
+        self.assertNotIn("sw1", file_text_from_bytes(self.fp))
+        self.assertTrue(self.factory.is_dirty())
+
+    def test_coalesce(self):
+        """The requests made during a save are served by one more save."""
+
+        first = self.config.save_async(self.factory, self.fp)
+        self.factory.new_brick("switch", "sw1")
+        second = self.config.save_async(self.factory, self.fp)
+        third = self.config.save_async(self.factory, self.fp)
+        self.assertEqual(len(self.writes), 1)
+        self.complete()
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.assertEqual(len(self.writes), 1)
+        self.complete()
+        self.successResultOf(second)
+        self.successResultOf(third)
+        self.assertIn("sw1", file_text_from_bytes(self.fp))
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_snapshot_reuses_sections(self):
+        """
+        If the save is incremental, only the objects changed after the last
+        snapshot are serialized.
+        """
+
+        self.config.incremental = True
+        self.factory.new_brick("switch", "sw1")
+        self.config.snapshot(self.factory)
+        serialized = []
+        for brick in self.factory.bricks:
+            self.patch(brick, "save_to", lambda f, b=brick: (
+                serialized.append(b.name), type(b).save_to(b, f)))
+        self.factory.get_brick_by_name("sw1").set({"numports": 8})
+        chunks = self.config.snapshot(self.factory)
+        self.assertEqual(serialized, ["sw1"])
+        self.assertEqual("".join(chunks), _full_save(self.factory))
+
+    def test_save_async_incremental(self):
+        """
+        The asynchronous save, used by the autosave, is incremental too and
+        it reuses the sections of a synchronous save.
+        """
+
+        self.config.incremental = True
+        self.factory.new_brick("switch", "sw1")
+        self.config.save(self.factory, self.fp)
+        serialized = []
+        for brick in self.factory.bricks:
+            self.patch(brick, "save_to", lambda f, b=brick: (
+                serialized.append(b.name), type(b).save_to(b, f)))
+        self.factory.get_brick_by_name("sw1").set({"numports": 8})
+        deferred = self.config.save_async(self.factory, self.fp)
+        self.complete()
+        self.successResultOf(deferred)
+        self.assertEqual(serialized, ["sw1"])
+        self.assertEqual(file_text_from_bytes(self.fp),
+                         _full_save(self.factory))
+
+    def test_snapshot_not_notified(self):
+        """
+        By default every section is serialized again, the changes not
+        notified are saved too.
+        """
+
+        self.config.snapshot(self.factory)
+        self.factory.get_brick_by_name("sw").config["numports"] = 8
+        chunks = self.config.snapshot(self.factory)
+        self.assertIn("numports=8", "".join(chunks))
+
+    def test_snapshot_links(self):
+        """
+        The links are serialized at every snapshot, the changes of the plugs
+        and socks are saved even if they are not reported.
+        """
+
+        machine = self.factory.new_brick("vm", "vm")
+        self.config.snapshot(self.factory)
+        actions = [
+            lambda: machine.add_plug(virtualmachines.hostonly_sock),
+            lambda: machine.add_sock(),
+            lambda: setattr(machine.plugs[0].original, "mac",
+                            "00:11:22:33:44:55"),
+        ]
+        for action in actions:
+            action()
+            chunks = self.config.snapshot(self.factory)
+            self.assertEqual("".join(chunks), _full_save(self.factory))
+        self.assertIn("link|vm|_hostonly|rtl8139|00:11:22:33:44:55",
+                      "".join(chunks))
+
+    def test_failure(self):
+        deferred = self.config.save_async(self.factory,
+                                          self.fp.child("missing").child("x"))
+        self.complete()
+        self.failureResultOf(deferred, OSError)
+        self.assertTrue(self.factory.is_dirty())
+        self.assertEqual(self.config._saving, {})
+
+    def test_thread(self):
+        """The file is written by a worker thread."""
+
+        config = configfile.ConfigFile()
+        deferred = config.save_async(self.factory, self.fp, fsync=True)
+
+        def check(ignore):
+            self.assertEqual(file_text_from_bytes(self.fp),
+                             _full_save(self.factory))
+
+        return deferred.addCallback(check)
+
+
+def _sorted_save(factory):
+    return sorted(_full_save(factory).splitlines())
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = stubs.Factory()
+        for i in range(2):
+            self.factory.new_brick("switch", "sw{0}".format(i))
+            wire = self.factory.new_brick("wire", "wire{0}".format(i))
+            self.factory.connect_to(wire, "sw{0}_port".format(i))
+        self.fp = filepath.FilePath(self.mktemp())
+        configfile.ConfigFile().save(self.factory, self.fp)
+        self.journal = configfile.Journal(self.factory, self.fp.path,
+                                          clock=self.clock).start()
+        self.addCleanup(self.journal.stop)
+
+    def replay(self, until=None):
+        configfile.replay_journal(self.fp, until)
+        factory = stubs.Factory()
+        configfile.ConfigFile().restore(factory, self.fp)
+        return factory
+
+    def test_replay(self):
+        """After a crash the changes are recovered from the journal."""
+
+        factory = self.factory
+        factory.get_brick_by_name("sw0").set({"numports": 8})
+        factory.connect_to(factory.get_brick_by_name("wire0"), "sw1_port")
+        factory.new_event("event").set({"delay": 5})
+        factory.del_brick(factory.get_brick_by_name("wire1"))
+        factory.rename(factory.get_brick_by_name("sw1"), "renamed")
+        self.clock.advance(0)
+        self.assertEqual(_sorted_save(self.replay()), _sorted_save(factory))
+        self.assertFalse(configfile.journal_path(self.fp).exists())
+
+    def test_records_only_changes(self):
+        self.factory.get_brick_by_name("sw0").set({"numports": 8})
+        self.clock.advance(0)
+        self.assertEqual(self.journal.records, 1)
+        content = configfile.journal_path(self.fp).getContent()
+        self.assertEqual(content.count(b"\n"), 1)
+        self.assertIn(b"numports=8", content)
+
+    def test_save_empties_journal(self):
+        self.factory.get_brick_by_name("sw0").set({"numports": 8})
+        self.clock.advance(0)
+        configfile.ConfigFile().save(self.factory, self.fp)
+        self.assertFalse(configfile.journal_path(self.fp).exists())
+        self.assertEqual(self.journal.records, 0)
+
+    def test_truncated_record(self):
+        """A record not completely written is ignored."""
+
+        self.factory.get_brick_by_name("sw0").set({"numports": 8})
+        self.clock.advance(0)
+        with open(configfile.journal_path(self.fp).path, "a") as fp:
+            fp.write('{"generation":1000,"op":"del')
+        factory = self.replay()
+        self.assertEqual(_sorted_save(factory), _sorted_save(self.factory))
+
+    def test_point_in_time(self):
+        self.clock.advance(10)
+        self.factory.get_brick_by_name("sw0").set({"numports": 8})
+        self.clock.advance(10)
+        self.factory.get_brick_by_name("sw0").set({"numports": 16})
+        self.clock.advance(0)
+        factory = self.replay(until=15)
+        self.assertEqual(factory.get_brick_by_name("sw0").get("numports"), 8)
+
+    def test_compact(self):
+        """When the journal is too long, the project is saved."""
+
+        self.patch(configfile._config, "deferToThread", defer.maybeDeferred)
+        self.journal.max_records = 2
+        self.factory.get_brick_by_name("sw0").set({"numports": 8})
+        self.clock.advance(0)
+        self.factory.get_brick_by_name("sw1").set({"numports": 8})
+        self.clock.advance(0)
+        self.assertFalse(self.factory.is_dirty())
+        self.assertFalse(configfile.journal_path(self.fp).exists())
+        factory = stubs.Factory()
+        configfile.ConfigFile().restore(factory, self.fp)
+        self.assertEqual(_sorted_save(factory), _sorted_save(self.factory))
+
+
 class TestParser(unittest.TestCase):
 
     def test_iter(self):
@@ -236,6 +655,32 @@ class TestParser(unittest.TestCase):
         self.assertEqual(link, ("link", "sender", "sw1_port", "rtl8139",
                                 "00:aa:79:71:be:61"))
 
+    def test_non_seekable_stream(self):
+        """The parser reads the stream once and never seeks it."""
+
+        parser = _configparser.Parser(NonSeekable(CONFIG1))
+        items = [(i.type, i.name, list(i)) if is_section(i) else i
+                 for i in parser]
+        expected = [(i.type, i.name, list(i)) if is_section(i) else i
+                    for i in _configparser.Parser(io.StringIO(CONFIG1))]
+        self.assertEqual(items, expected)
+        self.assertEqual(len(items), 5)
+
+    def test_iter_lines(self):
+        """The lines split across chunks are joined."""
+
+        text = "first line\nsecond\n\nlast"
+        for size in 1, 3, 7, 100:
+            self.assertEqual(
+                list(_configparser.iter_lines(io.StringIO(text), size)),
+                ["first line", "second", "", "last"])
+
+    def test_section_stops_at_unknown_line(self):
+        sio = io.StringIO("[Switch:sw]\n# comment\nnumports=8\n\n"
+                          "- unknown\nfstp=*\n[Switch:sw2]\n")
+        section = next(iter(_configparser.Parser(sio)))
+        self.assertEqual(list(section), [("numports", "8")])
+
     def test_link_with_minus(self):
         """
         Bricks' name can contains the following characters (in regex notation):
@@ -342,6 +787,43 @@ path=/var/run/switch/sck
 """
 
 
+def _big_config(size):
+    section = ("[Qemu:vm{0}]\nname=vm{0}\nkvm=*\nram=512\nsnapshot=*\n"
+               "hda=image\nprivatehda=*\nvnc=*\n\n"
+               "link|vm{0}|sw_port|rtl8139|00:aa:79:71:be:61\n")
+    lines = []
+    total = i = 0
+    while total < size:
+        lines.append(section.format(i))
+        total += len(lines[-1])
+        i += 1
+    return "".join(lines)
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestParserBenchmark(unittest.TestCase):
+
+    def test_parse_50mb(self):
+        fileobj = NonSeekable(_big_config(50 * 1024 * 1024))
+
+        def parse():
+            for item in _configparser.Parser(fileobj):
+                if is_section(item):
+                    for option in item:
+                        pass
+
+        benchmark("parse 50MB project", parse)
+
+
+class NonSeekable:
+
+    def __init__(self, text):
+        self._fileobj = io.StringIO(text)
+
+    def read(self, size=-1):
+        return self._fileobj.read(size)
+
+
 def is_section(obj):
     return isinstance(obj, _configparser.Section)
 
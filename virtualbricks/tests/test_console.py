@@ -21,8 +21,10 @@ import textwrap
 from zope.interface import implementer
 from twisted.python import components
 from twisted.internet import interfaces
+from twisted.test import proto_helpers
 
-from virtualbricks import console
+from virtualbricks import configfile, console, virtualmachines as vm
+from virtualbricks.bricks import is_lazy
 from virtualbricks.tests import unittest, stubs
 
 
@@ -102,3 +104,129 @@ class TestProtocol(unittest.TestCase):
         self.parse("help")
         self.assertEqual(self.stdout.getvalue(),
                          textwrap.dedent(console.VBProtocol.__doc__) + "\n")
+
+
+class FakeFactory:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        factory = stubs.FactoryStub()
+        self.stub = stubs.BrickStub(factory, "stub")
+        self.vm = stubs.VirtualMachineStub(factory, "vm")
+        self.vm.get("hda").set_image(vm.Image("test", "/images/a b.img"))
+        self.broken = stubs.BrickStub(factory, "broken")
+        self.broken.prog = lambda: 1 / 0
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(
+            FakeFactory([self.stub, self.vm, self.broken]))
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def test_plan(self):
+        """The command line of every brick, in order."""
+
+        self.protocol.lineReceived("plan")
+        lines = self.transport.value().splitlines()
+        self.assertEqual(lines[0], b"stub: true -a arg1 -c -d d")
+        self.assertTrue(lines[1].startswith(b"vm: true "))
+        self.assertIn(b" -hda '/images/a b.img' ", lines[1])
+        self.assertTrue(lines[2].startswith(b"broken: error: "))
+        self.assertIsNone(self.stub.proc)
+        self.assertIsNone(self.vm.proc)
+
+
+LAZY_PROJECT = """\
+[Switch:sw]
+
+[Qemu:vm]
+name=vm
+
+link|vm|sw_port|rtl8139|00:aa:2c:e7:ef:4d
+"""
+
+
+class TestLazyBricks(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        configfile.ConfigFile().restore_from(
+            self.factory, io.StringIO(LAZY_PROJECT), lazy=True)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(self.factory)
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def assertLazy(self, *names):
+        for name in names:
+            self.assertTrue(is_lazy(self.factory.get_brick_by_name(name)))
+
+    def test_plan(self):
+        """The bricks not loaded are not built to show their plan."""
+
+        self.protocol.lineReceived("plan")
+        self.assertEqual(self.transport.value().splitlines()[:2],
+                         [b"sw: not loaded", b"vm: not loaded"])
+        self.assertLazy("sw", "vm")
+
+    def test_plan_named(self):
+        """Only the bricks named are built."""
+
+        self.protocol.lineReceived("plan sw")
+        self.assertTrue(self.transport.value().startswith(b"sw: "))
+        self.assertFalse(is_lazy(self.factory.get_brick_by_name("sw")))
+        self.assertLazy("vm")
+
+    def test_list(self):
+        for cmd in "list", "ps", "connections":
+            self.protocol.lineReceived(cmd)
+        self.assertIn(b"\tlink connected to sw_port with a rtl8139 "
+                      b"(00:aa:2c:e7:ef:4d) card", self.transport.value())
+        self.assertLazy("sw", "vm")
+
+    def test_state(self):
+        self.assertEqual(self.factory.get_brick_by_name("sw").get_state(),
+                         "off")
+        self.assertLazy("sw")
+
+
+class TestBrickAction(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.brick = self.factory.new_brick("stub", "test")
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(self.factory)
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def parse(self, cmd):
+        self.protocol.lineReceived(cmd)
+
+    def test_supervise(self):
+        """The supervisor settings are stored in the brick configuration."""
+
+        self.parse("test supervise always dependents")
+        self.assertEqual(self.brick.config["restart_policy"], "always")
+        self.assertTrue(self.brick.config["restart_dependents"])
+        self.assertIsNot(self.brick.supervisor, None)
+        self.parse("test supervise never")
+        self.assertEqual(self.brick.config["restart_policy"], "never")
+        self.assertIs(self.brick.supervisor, None)
+
+    def test_supervise_invalid_policy(self):
+        self.parse("test supervise sometimes")
+        self.assertEqual(self.brick.config["restart_policy"], "never")
+        self.assertIn(b"Invalid restart policy sometimes",
+                      self.transport.value())
+
+    def test_remove_lazy_brick(self):
+        configfile.ConfigFile().restore_from(
+            self.factory, io.StringIO("[Switch:sw]\n\n"), lazy=True)
+        self.assertTrue(is_lazy(self.factory.get_brick_by_name("sw")))
+        self.parse("sw remove")
+        self.assertIs(self.factory.get_brick_by_name("sw"), None)
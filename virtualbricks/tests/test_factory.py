@@ -15,10 +15,18 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+
+from twisted.internet import defer, task
 from twisted.trial import unittest
 
+from virtualbricks import (brickfactory, bricks, configfile, errors, settings,
+                           virtualmachines)
+from virtualbricks.bricks import is_lazy
+from virtualbricks.brickfactory import dependency_levels
 from virtualbricks.tools import is_running
-from virtualbricks.tests import stubs, successResultOf
+from virtualbricks.tests import (stubs, successResultOf, benchmark,
+                                 should_test_benchmark, skipUnless)
 from virtualbricks.errors import BrickRunningError
 
 
@@ -79,3 +87,549 @@ class TestFactory(unittest.TestCase):
         self.assertRaises(BrickRunningError, factory.del_brick, brick)
         self.assertEqual(factory.bricks, [brick])
         self.assertTrue(is_running(brick))
+
+    def test_get_brick_by_name(self):
+        factory = stubs.Factory()
+        brick = factory.new_brick("stub", "test_brick")
+        self.assertIs(factory.get_brick_by_name("test_brick"), brick)
+        factory.del_brick(brick)
+        self.assertIs(factory.get_brick_by_name("test_brick"), None)
+
+    def test_rename_brick(self):
+        factory = stubs.Factory()
+        brick = factory.new_brick("stub", "test_brick")
+        brick.rename("renamed")
+        self.assertIs(factory.get_brick_by_name("test_brick"), None)
+        self.assertIs(factory.get_brick_by_name("renamed"), brick)
+
+    def test_rename_switch_socks(self):
+        """The socks of a switch follow the switch's name."""
+
+        factory = stubs.Factory()
+        switch = factory.new_brick("switch", "sw")
+        sock = switch.socks[0]
+        self.assertIs(factory.get_sock_by_name("sw_port"), sock)
+        switch.rename("sw1")
+        self.assertIs(factory.get_sock_by_name("sw_port"), None)
+        self.assertIs(factory.get_sock_by_name("sw1_port"), sock)
+
+    def test_del_brick_socks(self):
+        factory = stubs.Factory()
+        switch = factory.new_brick("switch", "sw")
+        wire = factory.new_brick("wire", "wire")
+        factory.connect_to(wire, "sw_port")
+        self.assertIs(wire.plugs[0].sock, switch.socks[0])
+        factory.del_brick(switch)
+        self.assertIs(factory.get_sock_by_name("sw_port"), None)
+        self.assertIs(wire.plugs[0].sock, None)
+
+    def test_graph(self):
+        """The connection graph follows the links between the bricks."""
+
+        factory = stubs.Factory()
+        switch = factory.new_brick("switch", "sw")
+        wire = factory.new_brick("wire", "wire")
+        factory.connect_to(wire, "sw_port")
+        self.assertEqual(factory.graph.neighbours(switch), [wire])
+        self.assertEqual(factory.graph.dependencies(wire), [switch])
+        factory.del_brick(wire)
+        self.assertNotIn(wire, factory.graph)
+        self.assertEqual(factory.graph.neighbours(switch), [])
+
+    def test_get_event_by_name(self):
+        factory = stubs.Factory()
+        event = factory.new_event("test_event")
+        self.assertIs(factory.get_event_by_name("test_event"), event)
+        self.assertTrue(factory.is_in_use("test_event"))
+
+    def test_get_image_by_path(self):
+        factory = stubs.Factory()
+        image = factory.new_disk_image("image", "/tmp/image.img")
+        self.assertIs(factory.get_image_by_path("/tmp/image.img"), image)
+        image.set_path("/tmp/other.img")
+        self.assertIs(factory.get_image_by_path("/tmp/image.img"), None)
+        self.assertIs(factory.get_image_by_path("/tmp/other.img"), image)
+        factory.remove_disk_image(image)
+        self.assertIs(factory.get_image_by_path("/tmp/other.img"), None)
+
+    def test_next_name(self):
+        factory = stubs.Factory()
+        factory.new_brick("stub", "brick")
+        factory.new_brick("stub", "brick.1")
+        self.assertEqual(factory.next_name("brick"), "brick.2")
+
+
+class LinkedBrick(stubs.StubBrick):
+
+    started = None
+
+    def __init__(self, factory, name):
+        stubs.StubBrick.__init__(self, factory, name)
+        self.plugs.append(factory.new_plug(self))
+        self.socks.append(factory.new_sock(self, name + "_port"))
+
+    def poweron(self):
+        self.started.append(self.name)
+        return stubs.StubBrick.poweron(self)
+
+    def poweroff(self, kill=False):
+        self.started.remove(self.name)
+        return stubs.StubBrick.poweroff(self, kill)
+
+
+class StubbornBrick(LinkedBrick):
+    """A brick that stops only when killed."""
+
+    def poweron(self):
+        LinkedBrick.poweron(self)
+        self._exited_d = defer.Deferred()
+        return defer.succeed(self)
+
+    def poweroff(self, kill=False):
+        exited = self._exited_d
+        if kill:
+            self.started.remove(self.name)
+            self.proc = self._exited_d = None
+            exited.callback((self, "killed"))
+        return exited
+
+
+class BrokenBrick(LinkedBrick):
+
+    def poweron(self):
+        self.started.append(self.name)
+        return defer.fail(errors.BadConfigError(self.name))
+
+
+class SlowBrick(LinkedBrick):
+    """A brick whose process is started one second after poweron()."""
+
+    clock = None
+    starting = None
+    peak = None
+
+    def poweron(self):
+        if self.proc is not None:
+            return defer.succeed(self)
+        self.started.append(self.name)
+        self.starting.append(self.name)
+        self.peak.append(len(self.starting))
+        return task.deferLater(self.clock, 1, self._spawn)
+
+    def _spawn(self):
+        self.starting.remove(self.name)
+        self.proc = bricks.FakeProcess(self)
+        return self
+
+
+class LinkedBricksMixin:
+
+    def setUp(self):
+        self.started = []
+        self.patch(LinkedBrick, "started", self.started)
+        self.factory = stubs.Factory()
+        self.factory.register_brick_type(LinkedBrick, "linked")
+        self.factory.register_brick_type(BrokenBrick, "broken")
+        self.factory.register_brick_type(StubbornBrick, "stubborn")
+        self.factory.register_brick_type(SlowBrick, "slow")
+
+    def chain(self, *types):
+        """Create a chain of bricks, each one plugged into the previous."""
+
+        bricks = []
+        for i, type in enumerate(types):
+            brick = self.factory.new_brick(type, "brick{0}".format(i))
+            if bricks:
+                brick.plugs[0].connect(bricks[-1].socks[0])
+            bricks.append(brick)
+        return bricks
+
+
+class TestPoweronAll(LinkedBricksMixin, unittest.TestCase):
+
+    def test_dependency_levels(self):
+        b0, b1, b2 = self.chain("linked", "linked", "linked")
+        self.assertEqual(dependency_levels([b2, b1, b0]), [[b0], [b1], [b2]])
+
+    def test_dependency_levels_loop(self):
+        b0, b1 = self.chain("linked", "linked")
+        b0.plugs[0].connect(b1.socks[0])
+        self.assertEqual(dependency_levels([b0, b1]), [[b0, b1]])
+
+    def test_poweron_all(self):
+        """The bricks are started following the topology."""
+
+        b0, b1, b2 = self.chain("linked", "linked", "linked")
+        results = successResultOf(self, self.factory.poweron_all(
+            [b2, b1, b0], max_concurrency=1))
+        self.assertEqual(results, [(True, b2), (True, b1), (True, b0)])
+        self.assertEqual(self.started, ["brick0", "brick1", "brick2"])
+
+    def test_poweron_all_dependency_failed(self):
+        """
+        If a brick cannot start, the bricks plugged into it are not started.
+        """
+
+        b0, b1, b2 = self.chain("linked", "broken", "linked")
+        results = successResultOf(self, self.factory.poweron_all())
+        self.assertEqual(self.started, ["brick0", "brick1"])
+        self.assertEqual(results[0], (True, b0))
+        self.assertFalse(results[1][0])
+        results[1][1].trap(errors.BadConfigError)
+        self.assertFalse(results[2][0])
+        results[2][1].trap(errors.NotConnectedError)
+        self.assertFalse(is_running(b2))
+
+
+    def slow_bricks(self):
+        self.clock = task.Clock()
+        self.starting = []
+        self.peak = []
+        self.patch(SlowBrick, "clock", self.clock)
+        self.patch(SlowBrick, "starting", self.starting)
+        self.patch(SlowBrick, "peak", self.peak)
+
+    def test_poweron_all_loop(self):
+        """
+        The bricks of a loop, a switch-wire-switch ring, are started one at
+        a time, so none of them is started twice.
+        """
+
+        self.slow_bricks()
+        sw0, wire, sw1 = self.chain("slow", "slow", "slow")
+        sw0.plugs[0].connect(sw1.socks[0])
+        deferred = self.factory.poweron_all()
+        self.clock.pump([1] * 3)
+        results = successResultOf(self, deferred)
+        self.assertEqual(results, [(True, sw0), (True, wire), (True, sw1)])
+        self.assertEqual(self.started, ["brick0", "brick1", "brick2"])
+        self.assertEqual(self.peak, [1, 1, 1])
+
+    def test_poweron_all_dependencies(self):
+        """
+        The bricks plugged into are started first, even if they are not
+        listed, instead of by every brick of the next level.
+        """
+
+        self.slow_bricks()
+        switch, wire0 = self.chain("slow", "slow")
+        wire1 = self.factory.new_brick("slow", "brick2")
+        wire1.plugs[0].connect(switch.socks[0])
+        deferred = self.factory.poweron_all([wire0, wire1])
+        self.clock.pump([1] * 2)
+        results = successResultOf(self, deferred)
+        self.assertEqual(results, [(True, wire0), (True, wire1)])
+        self.assertEqual(self.started, ["brick0", "brick1", "brick2"])
+        self.assertTrue(is_running(switch))
+
+
+class TestPoweroffAll(LinkedBricksMixin, unittest.TestCase):
+
+    def setUp(self):
+        LinkedBricksMixin.setUp(self)
+        self.clock = task.Clock()
+
+    def test_poweroff_all(self):
+        """The bricks are stopped in the reverse order of the topology."""
+
+        bricks = self.chain("linked", "linked", "linked")
+        successResultOf(self, self.factory.poweron_all())
+        stopped = []
+        for brick in bricks:
+            self.patch(brick, "poweroff", lambda kill=False, b=brick: (
+                stopped.append(b.name), LinkedBrick.poweroff(b, kill))[1])
+        results = successResultOf(self, self.factory.poweroff_all(
+            clock=self.clock, max_concurrency=1))
+        self.assertEqual(stopped, ["brick2", "brick1", "brick0"])
+        self.assertEqual([r.brick for r in results], bricks)
+        self.assertTrue(all(r.stopped for r in results))
+        self.assertEqual([r.step for r in results], ["term"] * 3)
+        self.assertEqual(self.started, [])
+
+    def test_not_running(self):
+        brick, = self.chain("linked")
+        result, = successResultOf(self, self.factory.poweroff_all(
+            clock=self.clock))
+        self.assertTrue(result.stopped)
+        self.assertIs(result.step, None)
+        self.assertEqual(result.elapsed, 0)
+
+    def test_escalation(self):
+        """If a brick does not stop before the deadline, it is killed."""
+
+        brick, = self.chain("stubborn")
+        successResultOf(self, self.factory.poweron_all())
+        deferred = self.factory.poweroff_all(timeout=10, clock=self.clock)
+        self.assertNoResult(deferred)
+        self.clock.advance(10)
+        result, = successResultOf(self, deferred)
+        self.assertTrue(result.stopped)
+        self.assertEqual(result.step, "kill")
+        self.assertEqual(result.elapsed, 10)
+        self.assertEqual(result.status, "killed")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertFalse(is_running(brick))
+
+    def test_cannot_stop(self):
+        """If all the steps time out, the brick is reported as running."""
+
+        brick, = self.chain("stubborn")
+        successResultOf(self, self.factory.poweron_all())
+        self.patch(brick, "poweroff_steps", (("term", {}), ))
+        deferred = self.factory.poweroff_all(timeout=10, clock=self.clock)
+        self.clock.advance(10)
+        result, = successResultOf(self, deferred)
+        self.assertFalse(result.stopped)
+        result.status.trap(errors.BrickRunningError)
+        self.assertTrue(is_running(brick))
+
+
+def _big_project(nswitches):
+    lines = []
+    for i in range(nswitches):
+        lines.append("[Switch:sw{0}]\n\n".format(i))
+        lines.append("[Wire:wire{0}]\n\n".format(i))
+    for i in range(nswitches):
+        lines.append("link|wire{0}|sw{0}_port||\n".format(i))
+        lines.append("link|wire{0}|sw{1}_port||\n".format(
+            i, (i + 1) % nswitches))
+    return "".join(lines)
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestFactoryBenchmark(unittest.TestCase):
+
+    def test_restore_10k_bricks(self):
+        factory = stubs.Factory()
+        fileobj = io.StringIO(_big_project(5000))
+        benchmark("restore 10k bricks", configfile.ConfigFile().restore_from,
+                  factory, fileobj)
+        self.assertEqual(len(factory.bricks), 10000)
+
+    def test_incremental_save_10k_bricks(self):
+        factory = stubs.Factory()
+        configfile.ConfigFile().restore_from(
+            factory, io.StringIO(_big_project(5000)))
+        filename = self.mktemp()
+        config = configfile.ConfigFile(incremental=True)
+        benchmark("full save of 10k bricks", config.save, factory, filename)
+        factory.get_brick_by_name("sw42").set({"numports": 8})
+        benchmark("incremental save of 10k bricks", config.save, factory,
+                  filename)
+
+    def test_del_brick_5k_bricks(self):
+        factory = stubs.Factory()
+        configfile.ConfigFile().restore_from(
+            factory, io.StringIO(_big_project(2500)))
+        switch = factory.get_brick_by_name("sw0")
+        benchmark("delete a brick from 5k bricks", factory.del_brick, switch)
+        self.assertEqual(len(factory.graph.components()), 1)
+
+    def test_lazy_restore_10k_bricks(self):
+        factory = stubs.Factory()
+        fileobj = io.StringIO(_big_project(5000))
+        benchmark("lazy restore of 10k bricks",
+                  configfile.ConfigFile().restore_from, factory, fileobj,
+                  True)
+        wire = factory.get_brick_by_name("wire42")
+        benchmark("build a lazy brick of 10k bricks", wire.materialize)
+        self.assertEqual(len(wire.plugs), 2)
+
+
+class TestDirtyTracking(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.saved = []
+        self.patch(configfile, "safe_save_async", self.saved.append)
+
+    def test_changes(self):
+        """Adding, changing, linking and removing make the project dirty."""
+
+        factory = self.factory
+        self.assertFalse(factory.is_dirty())
+        switch = factory.new_brick("switch", "sw")
+        wire = factory.new_brick("wire", "wire")
+        event = factory.new_event("event")
+        actions = [
+            lambda: factory.connect_to(wire, "sw_port"),
+            lambda: switch.set({"numports": 8}),
+            lambda: event.set({"delay": 10}),
+            lambda: wire.plugs[0].disconnect(),
+            lambda: factory.del_event(event),
+            lambda: factory.del_brick(wire),
+        ]
+        for action in actions:
+            generation = factory.generation
+            action()
+            self.assertGreater(factory.generation, generation)
+        self.assertTrue(factory.is_dirty())
+
+    def test_network_cards(self):
+        """
+        The network cards of a virtual machine make the project dirty, the
+        hostonly ones and the links to the machine itself too.
+        """
+
+        factory = self.factory
+        vm = factory.new_brick("vm", "vm")
+        sock = vm.add_sock()
+        actions = [
+            lambda: vm.add_plug(virtualmachines.hostonly_sock),
+            lambda: vm.add_plug(sock),
+            lambda: vm.add_sock(),
+            lambda: setattr(vm.plugs[0], "mac", "00:11:22:33:44:55"),
+            lambda: setattr(vm.socks[0], "model", "e1000"),
+            lambda: vm.plugs[1].disconnect(),
+            lambda: vm.remove_plug(vm.plugs[0]),
+            lambda: vm.remove_plug(vm.socks[1]),
+        ]
+        for action in actions:
+            factory.mark_clean()
+            action()
+            self.assertTrue(factory.is_dirty())
+
+    def test_set_image(self):
+        image = self.factory.new_disk_image("martin", "/vimages/martin.qcow2")
+        vm = self.factory.new_brick("vm", "vm")
+        self.factory.mark_clean()
+        vm.set_image("hda", image)
+        self.assertTrue(self.factory.is_dirty())
+        self.factory.mark_clean()
+        vm.set_image("hda", image)
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_mark_clean(self):
+        self.factory.new_brick("switch", "sw")
+        generation = self.factory.generation
+        self.factory.new_brick("switch", "sw1")
+        self.factory.mark_clean(generation)
+        self.assertTrue(self.factory.is_dirty())
+        self.factory.mark_clean()
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_save_marks_clean(self):
+        self.factory.new_brick("switch", "sw")
+        configfile.ConfigFile().save(self.factory, self.mktemp())
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_autosave_skips_clean_project(self):
+        brickfactory.autosave(self.factory)
+        self.assertEqual(self.saved, [])
+        self.factory.new_brick("switch", "sw")
+        brickfactory.autosave(self.factory)
+        self.assertEqual(self.saved, [self.factory])
+
+    def test_save_on_change(self):
+        clock = task.Clock()
+        saver = brickfactory.SaveOnChange(self.factory, delay=5, max_delay=12,
+                                          clock=clock).start()
+        self.addCleanup(saver.stop)
+        self.factory.new_brick("switch", "sw")
+        clock.advance(4)
+        self.factory.new_brick("switch", "sw1")
+        clock.advance(4)
+        self.assertEqual(self.saved, [])
+        clock.advance(1)
+        self.assertEqual(self.saved, [self.factory])
+
+    def test_save_on_change_max_delay(self):
+        """A stream of changes does not postpone the save forever."""
+
+        clock = task.Clock()
+        saver = brickfactory.SaveOnChange(self.factory, delay=5, max_delay=12,
+                                          clock=clock).start()
+        self.addCleanup(saver.stop)
+        for i in range(4):
+            self.factory.new_brick("switch", "sw{0}".format(i))
+            clock.advance(4)
+        self.assertEqual(self.saved, [self.factory])
+
+
+class TestLazyRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        configfile.ConfigFile().restore_from(
+            self.factory, io.StringIO(_big_project(3)), lazy=True)
+        self.factory.mark_clean()
+
+    def test_nothing_built(self):
+        self.assertEqual(len(self.factory.bricks), 6)
+        self.assertTrue(all(map(is_lazy, self.factory.bricks)))
+        self.assertEqual(self.factory.socks, [])
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_build_on_access(self):
+        """
+        A brick is built when it is used, with the bricks it is plugged into.
+        """
+
+        wire = self.factory.get_brick_by_name("wire1")
+        self.assertEqual([p.sock.nickname for p in wire.plugs],
+                         ["sw1_port", "sw2_port"])
+        self.assertIsNot(wire.brick, None)
+        built = [b.name for b in self.factory.bricks if not is_lazy(b)]
+        self.assertEqual(built, ["sw1", "wire1", "sw2"])
+        self.assertEqual(self.factory.graph.dependencies(wire.brick),
+                         [self.factory.get_brick_by_name(n)
+                          for n in ("sw1", "sw2")])
+        self.assertFalse(self.factory.is_dirty())
+
+    def test_keep_order(self):
+        names = [b.name for b in self.factory.bricks]
+        self.factory.get_brick_by_name("wire1").materialize()
+        self.assertEqual([b.name for b in self.factory.bricks], names)
+
+    def test_save(self):
+        """A project with lazy bricks is saved as if all were built."""
+
+        fileobj = io.StringIO()
+        config = configfile.ConfigFile()
+        self.factory.get_brick_by_name("wire1").materialize()
+        config.save_to(self.factory, fileobj)
+        factory = stubs.Factory()
+        config.restore_from(factory, io.StringIO(_big_project(3)))
+        expected = io.StringIO()
+        config.save_to(factory, expected)
+        self.assertEqual(sorted(fileobj.getvalue().splitlines()),
+                         sorted(expected.getvalue().splitlines()))
+
+    def test_del_lazy_brick(self):
+        self.factory.del_brick(self.factory.get_brick_by_name("wire0"))
+        self.assertIs(self.factory.get_brick_by_name("wire0"), None)
+        self.assertEqual(len(self.factory.bricks), 5)
+        self.assertTrue(all(map(is_lazy, self.factory.bricks)))
+
+    def test_rename_linked_brick(self):
+        """
+        The links of the lazy bricks follow the renamed socks of a built
+        brick.
+        """
+
+        self.factory.get_brick_by_name("sw1").rename("core")
+        self.assertTrue(is_lazy(self.factory.get_brick_by_name("wire0")))
+        self.assertTrue(self.factory.is_dirty())
+        fileobj = io.StringIO()
+        configfile.ConfigFile().save_to(self.factory, fileobj)
+        self.assertIn("link|wire0|core_port||", fileobj.getvalue())
+        self.assertNotIn("sw1_port", fileobj.getvalue())
+        wire = self.factory.get_brick_by_name("wire0").materialize()
+        self.assertEqual([p.sock.nickname for p in wire.plugs],
+                         ["sw0_port", "core_port"])
+
+    def test_poweroff_all(self):
+        """Lazy bricks were never started, they are not built to stop them."""
+
+        results = successResultOf(self, self.factory.poweroff_all())
+        self.assertTrue(all(result.stopped for result in results))
+        self.assertTrue(all(map(is_lazy, self.factory.bricks)))
+
+    def test_lazy_setting(self):
+        fp = self.mktemp()
+        with open(fp, "w") as fd:
+            fd.write(_big_project(1))
+        self.patch(settings, "get", {"lazy_restore": True}.get)
+        factory = stubs.Factory()
+        configfile.restore(factory, fp)
+        self.assertTrue(all(map(is_lazy, factory.bricks)))
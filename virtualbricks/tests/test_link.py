@@ -121,3 +121,125 @@ class TestSock(unittest.TestCase):
             pass
         self.sock.path = filename
         self.assertTrue(self.sock.has_valid_path())
+
+
+class Node:
+
+    def __init__(self, name):
+        self.name = name
+        self.plugs = []
+        self.socks = []
+
+    def __repr__(self):
+        return "<Node {0.name}>".format(self)
+
+
+class TestConnectionGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = link.ConnectionGraph()
+        self.switch = self.node("switch")
+        self.switch.socks.append(link.Sock(self.switch, "switch_port"))
+
+    def node(self, name):
+        node = Node(name)
+        self.graph.add_brick(node)
+        return node
+
+    def plug(self, node, sock=None):
+        plug = link.Plug(node, self.graph)
+        node.plugs.append(plug)
+        if sock is not None:
+            plug.connect(sock)
+        return plug
+
+    def test_connect(self):
+        vm = self.node("vm")
+        self.plug(vm, self.switch.socks[0])
+        self.assertEqual(self.graph.dependencies(vm), [self.switch])
+        self.assertEqual(self.graph.dependents(self.switch), [vm])
+        self.assertEqual(self.graph.neighbours(self.switch), [vm])
+        self.assertEqual(self.graph.neighbours(vm), [self.switch])
+
+    def test_disconnect(self):
+        """
+        The link is removed only when the last plug between the bricks is
+        disconnected.
+        """
+
+        vm = self.node("vm")
+        plug1 = self.plug(vm, self.switch.socks[0])
+        plug2 = self.plug(vm, self.switch.socks[0])
+        plug1.disconnect()
+        self.assertEqual(self.graph.neighbours(vm), [self.switch])
+        plug2.disconnect()
+        self.assertEqual(self.graph.neighbours(vm), [])
+        self.assertEqual(self.graph.dependents(self.switch), [])
+
+    def test_self_link(self):
+        vm = self.node("vm")
+        vm.socks.append(link.Sock(vm, "vm_sock"))
+        self.plug(vm, vm.socks[0])
+        self.assertEqual(self.graph.neighbours(vm), [])
+
+    def test_unknown_brick(self):
+        """Links to bricks that are not in the graph are ignored."""
+
+        outsider = Node("outsider")
+        outsider.socks.append(link.Sock(outsider, "outsider_port"))
+        vm = self.node("vm")
+        plug = self.plug(vm, outsider.socks[0])
+        self.assertEqual(self.graph.neighbours(vm), [])
+        plug.disconnect()
+
+    def test_changes_reported(self):
+        """
+        Every link of a brick of the graph is reported, the ones that are not
+        recorded too.
+        """
+
+        changed = []
+        self.graph = link.ConnectionGraph(changed.append)
+        outsider = Node("outsider")
+        outsider.socks.append(link.Sock(outsider, "outsider_port"))
+        vm = self.node("vm")
+        vm.socks.append(link.Sock(vm, "vm_sock"))
+        plug1 = self.plug(vm, outsider.socks[0])
+        plug2 = self.plug(vm, vm.socks[0])
+        plug1.disconnect()
+        plug2.disconnect()
+        self.assertEqual(changed, [vm] * 4)
+        self.plug(outsider, vm.socks[0])
+        self.assertEqual(changed, [vm] * 4)
+
+    def test_add_connected_brick(self):
+        """The links made before the brick is added are recorded."""
+
+        vm = Node("vm")
+        self.plug(vm, self.switch.socks[0])
+        self.graph.add_brick(vm)
+        self.assertEqual(self.graph.dependencies(vm), [self.switch])
+
+    def test_remove_brick(self):
+        vm = self.node("vm")
+        self.plug(vm, self.switch.socks[0])
+        self.graph.remove_brick(self.switch)
+        self.assertNotIn(self.switch, self.graph)
+        self.assertEqual(self.graph.neighbours(vm), [])
+
+    def test_components(self):
+        vm1, vm2, vm3 = self.node("vm1"), self.node("vm2"), self.node("vm3")
+        self.plug(vm1, self.switch.socks[0])
+        self.plug(vm2, self.switch.socks[0])
+        components = self.graph.components()
+        self.assertEqual(len(components), 2)
+        self.assertIn({self.switch, vm1, vm2}, components)
+        self.assertIn({vm3}, components)
+
+    def test_reachable(self):
+        vm1, vm2, vm3 = self.node("vm1"), self.node("vm2"), self.node("vm3")
+        self.plug(vm1, self.switch.socks[0])
+        self.plug(vm2, self.switch.socks[0])
+        self.assertTrue(self.graph.reachable(vm1, vm2))
+        self.assertFalse(self.graph.reachable(vm1, vm3))
+        self.assertFalse(self.graph.reachable(Node("outsider"), vm1))
@@ -0,0 +1,183 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import copy
+
+from virtualbricks import markov, wires
+from virtualbricks.tests import unittest, skipUnless
+
+
+class _MatrixTests:
+
+    def matrix(self, size):
+        raise NotImplementedError()
+
+    def test_rows(self):
+        weights = self.matrix(2)
+        weights[0][1] = 30
+        self.assertEqual(len(weights), 2)
+        self.assertEqual([list(row) for row in weights], [[0, 30], [0, 0]])
+        self.assertEqual(weights[0][1], 30.0)
+        self.assertRaises(IndexError, weights.__getitem__, 2)
+        self.assertRaises(IndexError, weights[0].__getitem__, 2)
+
+    def test_insert_delete(self):
+        weights = self.matrix(2)
+        weights[0][1] = 10
+        weights[1][0] = 20
+        weights.insert(1)
+        self.assertEqual([list(row) for row in weights],
+                         [[0, 0, 10], [0, 0, 0], [20, 0, 0]])
+        weights[1][2] = 5
+        weights.delete(0)
+        self.assertEqual([list(row) for row in weights], [[0, 5], [0, 0]])
+
+    def test_deepcopy(self):
+        weights = self.matrix(2)
+        other = copy.deepcopy(weights)
+        other[0][1] = 10
+        self.assertEqual(weights[0][1], 0.0)
+        self.assertNotEqual(weights, other)
+
+    def test_validate(self):
+        weights = self.matrix(3)
+        weights[0][1] = 60
+        weights[0][2] = 40
+        # the diagonal is ignored
+        weights[1][1] = 1000
+        weights.validate()
+        weights[0][2] = 41
+        self.assertRaises(ValueError, weights.validate)
+        weights[0][2] = -1
+        self.assertRaises(ValueError, weights.validate)
+        weights[0][2] = float("nan")
+        self.assertRaises(ValueError, weights.validate)
+
+    def test_stationary_distribution(self):
+        weights = self.matrix(2)
+        weights[0][1] = 10
+        weights[1][0] = 30
+        pi = weights.stationary_distribution()
+        self.assertAlmostEqual(pi[0], 0.75)
+        self.assertAlmostEqual(pi[1], 0.25)
+
+    def test_stationary_distribution_periodic(self):
+        weights = self.matrix(3)
+        weights[0][1] = weights[1][2] = weights[2][0] = 100
+        for p in weights.stationary_distribution():
+            self.assertAlmostEqual(p, 1 / 3)
+
+
+class TestSparseMatrix(_MatrixTests, unittest.TestCase):
+
+    def matrix(self, size):
+        return markov.SparseMatrix(size)
+
+    def test_sparse(self):
+        """Only the weights not zero are stored."""
+
+        weights = self.matrix(1000)
+        weights[0][999] = 1
+        weights[0][999] = 0
+        weights[10][20] = 1
+        self.assertEqual(sum(len(row) for row in weights.rows), 1)
+
+
+@skipUnless(markov.numpy, "NumPy is not installed, the dense matrices are "
+            "not tested: install the markov extra to test them")
+class TestDenseMatrix(_MatrixTests, unittest.TestCase):
+
+    def matrix(self, size):
+        return markov.DenseMatrix(size)
+
+    def test_probabilities(self):
+        weights = self.matrix(2)
+        weights[0][1] = 10
+        self.assertEqual(weights.probabilities().tolist(),
+                         [[0.9, 0.1], [0.0, 1.0]])
+
+    def test_resize(self):
+        weights = markov.matrix(markov.SPARSE_THRESHOLD)
+        weights[0][1] = 10
+        weights.insert(0)
+        weights = markov.resize(weights)
+        self.assertTrue(weights.sparse)
+        self.assertEqual(weights[1][2], 10)
+
+
+class TestMarkovConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.config = wires.NetemuConfig()
+        self.manager = wires.MarkovConfig(self.config)
+        self.manager.add(1)
+
+    def test_add_remove(self):
+        self.manager.weights[0][1] = 10
+        self.manager.add(0)
+        self.assertEqual(len(self.manager.weights), 3)
+        self.assertEqual(self.manager.weights[1][2], 10)
+        self.manager.remove(2)
+        self.assertEqual([list(row) for row in self.manager.weights],
+                         [[0, 0], [0, 0]])
+
+    def test_expected(self):
+        self.manager.weights[0][1] = 10
+        self.manager.weights[1][0] = 30
+        self.config["delay"] = 100
+        self.config["loss"] = 4
+        bad = self.manager.states[1]
+        bad["delay"] = 500
+        bad["delaysymm"] = False
+        bad["delayr"] = 1000
+        bad["loss"] = 20
+        expected = self.manager.expected()
+        self.assertAlmostEqual(expected["delay"][0], 200)
+        self.assertAlmostEqual(expected["delay"][1], 325)
+        self.assertAlmostEqual(expected["loss"][0], 8)
+        self.assertAlmostEqual(expected["loss"][1], 8)
+        self.assertAlmostEqual(expected["bandwidth"][0], 125000)
+
+    def test_expected_unlimited(self):
+        """A state with unlimited bandwidth makes the average unlimited."""
+
+        self.manager.weights[0][1] = 10
+        self.manager.weights[1][0] = 30
+        self.config["bandwidth"] = 1000
+        unlimited = self.manager.states[1]
+        unlimited["bandwidthsymm"] = False
+        unlimited["bandwidth"] = 0
+        unlimited["bandwidthr"] = 2000
+        expected = self.manager.expected()
+        self.assertEqual(expected["bandwidth"][0], float("inf"))
+        self.assertAlmostEqual(expected["bandwidth"][1], 1250)
+
+    def test_expected_unlimited_unreachable(self):
+        """
+        A state with unlimited bandwidth that is never visited does not
+        change the average.
+        """
+
+        self.manager.weights[1][0] = 100
+        self.config["bandwidth"] = 1000
+        self.manager.states[1]["bandwidth"] = 0
+        expected = self.manager.expected()
+        self.assertAlmostEqual(expected["bandwidth"][0], 1000)
+
+    def test_expected_invalid(self):
+        self.manager.weights[0][1] = 200
+        self.assertRaises(ValueError, self.manager.expected)
@@ -0,0 +1,213 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, protocol, reactor, task
+from twisted.protocols import basic
+from twisted.test import proto_helpers
+
+from virtualbricks import errors, mgmt
+
+
+BANNER = b"VDE switch V.2.3.2\n(C) Virtual Square Team\n\nvde$ "
+
+
+class FakeConsole(basic.LineReceiver):
+
+    delimiter = b"\n"
+
+    def connectionMade(self):
+        self.factory.connections.append(self)
+        self.transport.write(BANNER)
+
+    def lineReceived(self, line):
+        self.factory.commands.append(line)
+        if line == b"bad":
+            self.transport.write(b"1022 Invalid argument\n\nvde$ ")
+        else:
+            self.transport.write(b"1000 Success\n\nvde$ ")
+
+
+class FakeConsoleFactory(protocol.Factory):
+
+    protocol = FakeConsole
+
+    def __init__(self):
+        self.connections = []
+        self.commands = []
+
+
+class TestPromptScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.scanner = mgmt.PromptScanner(mgmt.ManagementClient.prompt, 32)
+
+    def test_split_prompt(self):
+        """A prompt split between two reads is recognized."""
+
+        self.assertEqual(self.scanner.feed(b"1000 Success\nvd"), [])
+        self.assertEqual(self.scanner.feed(b"e$ "), [b"1000 Success\n"])
+
+    def test_many_acks(self):
+        self.assertEqual(self.scanner.feed(b"a\nvde$ b\nvde[sw]: c"),
+                         [b"a\n", b"b\n"])
+        self.assertEqual(self.scanner.feed(b"\nvde$ "), [b"c\n"])
+
+    def test_prompt_at_line_start(self):
+        """The prompt is recognized only at the start of a line."""
+
+        self.assertEqual(self.scanner.feed(b"a vde$ b\n"), [])
+        self.assertEqual(self.scanner.feed(b"vde$ "), [b"a vde$ b\n"])
+
+    def test_truncate(self):
+        """The oldest bytes are discarded when the buffer is full."""
+
+        self.scanner.feed(b"a" * 30 + b"\n")
+        self.scanner.feed(b"b" * 4 + b"\n")
+        acks = self.scanner.feed(b"vde$ ")
+        self.assertEqual(acks, [b"a" * 26 + b"\n" + b"b" * 4 + b"\n"])
+        self.assertEqual(len(self.flushLoggedErrors()), 0)
+
+    def test_overflow_error(self):
+        self.scanner.overflow = mgmt.PromptScanner.ERROR
+        self.assertRaises(errors.BufferOverflowError, self.scanner.feed,
+                          b"a" * 33)
+        self.assertEqual(self.scanner.feed(b"vde$ "), [b""])
+
+
+class TestManagementPool(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.factory = FakeConsoleFactory()
+        port = reactor.listenUNIX(self.path, self.factory)
+        self.addCleanup(port.stopListening)
+        self.pool = mgmt.ManagementPool(timeout=5)
+        self.addCleanup(self.pool.disconnect_all)
+
+    @defer.inlineCallbacks
+    def test_send_command(self):
+        """The banner is discarded and the response is returned."""
+
+        response = yield self.pool.send_command(self.path, b"port/print")
+        self.assertEqual(response.code, 0)
+        self.assertEqual(response.message, "Success")
+        self.assertEqual(self.factory.commands, [b"port/print"])
+
+    @defer.inlineCallbacks
+    def test_rejected(self):
+        d = self.pool.send_command(self.path, b"bad")
+        yield self.assertFailure(d, errors.CommandRejectedError)
+
+    @defer.inlineCallbacks
+    def test_multiplex(self):
+        """Concurrent commands share the same connection."""
+
+        yield defer.gatherResults([
+            self.pool.send_command(self.path, b"cmd%d" % i)
+            for i in range(10)])
+        self.assertEqual(len(self.factory.connections), 1)
+        self.assertEqual(self.factory.commands,
+                         [b"cmd%d" % i for i in range(10)])
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        """A connection lost is opened again on the next command."""
+
+        yield self.pool.send_command(self.path, b"cmd1")
+        proto = yield self.pool.connect(self.path)
+        self.factory.connections[0].transport.loseConnection()
+        yield proto.lost
+        yield self.pool.send_command(self.path, b"cmd2")
+        self.assertEqual(len(self.factory.connections), 2)
+
+    @defer.inlineCallbacks
+    def test_write_batch(self):
+        yield self.pool.write_batch(self.path, [b"cmd1", b"cmd2"])
+        self.assertEqual(self.factory.commands, [b"cmd1", b"cmd2"])
+
+    @defer.inlineCallbacks
+    def test_connection_failed(self):
+        """Connections are retried before giving up."""
+
+        self.pool.retries = 1
+        self.pool.retry_delay = 0.01
+        d = self.pool.send_command(self.mktemp(), b"cmd")
+        yield self.assertFailure(d, error.ConnectError)
+
+
+class FakeEndpoint:
+
+    def __init__(self, result=None):
+        self.result = result
+        self.protocols = []
+
+    def connect(self, factory):
+        if self.result is not None:
+            return defer.fail(self.result)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(proto_helpers.StringTransport())
+        self.protocols.append(proto)
+        return defer.succeed(proto)
+
+
+class TestManagementPoolClock(unittest.TestCase):
+    """All the timers of the pool run on the reactor it is given."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pool = mgmt.ManagementPool(self.clock, timeout=5)
+        self.endpoint = FakeEndpoint()
+        self.pool._endpoint = lambda path: self.endpoint
+
+    def test_prompt_timeout(self):
+        """A socket that never shows the prompt is closed."""
+
+        self.pool.retries = 0
+        d = self.pool.connect("path")
+        self.assertNoResult(d)
+        self.clock.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+        self.assertTrue(self.endpoint.protocols[0].transport.disconnecting)
+
+    def test_retry(self):
+        self.endpoint.result = error.ConnectError()
+        self.pool.retries = 1
+        d = self.pool.connect("path")
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(self.pool.retry_delay)
+        self.failureResultOf(d, error.ConnectError)
+
+    def test_no_retries(self):
+        self.endpoint.result = error.ConnectError()
+        d = self.pool.connect("path", retries=0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.failureResultOf(d, error.ConnectError)
+
+    def test_command_timeout(self):
+        d = self.pool.connect("path")
+        proto = self.endpoint.protocols[0]
+        proto.dataReceived(BANNER)
+        self.assertIs(self.successResultOf(d), proto)
+        d = self.pool.send_command("path", b"cmd")
+        self.clock.advance(5)
+        self.failureResultOf(d, defer.TimeoutError)
+
+    def test_wirefilter_prompt(self):
+        d = self.pool.connect("path")
+        self.endpoint.protocols[0].dataReceived(b"VDEwf$ ")
+        self.successResultOf(d)
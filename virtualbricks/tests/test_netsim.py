@@ -0,0 +1,152 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.test import proto_helpers
+
+from virtualbricks import console, netsim, wires
+from virtualbricks.tests import (unittest, stubs, benchmark,
+                                 should_test_benchmark, skipUnless)
+
+
+def channel(*states, **weights):
+    """Return a Markov model, weights are given as wIJ=weight."""
+
+    manager = wires.MarkovConfig(wires.NetemuConfig())
+    for i in range(1, len(states)):
+        manager.add(i)
+    for state, attrs in zip(manager.states, states):
+        for name, value in attrs.items():
+            state[name] = value
+    for edge, weight in weights.items():
+        manager.weights[int(edge[1])][int(edge[2])] = weight
+    return manager
+
+
+PRESETS = {
+    "lan": channel({"delay": 1, "bandwidth": 12500000}),
+    "lossy": channel({"delay": 20, "loss": 10}),
+    "gilbert": channel({"delay": 10}, {"delay": 10, "loss": 50},
+                       w01=10, w10=30),
+    "congested": channel({"delay": 5, "chanbufsize": 10000}),
+    "asymmetric": channel({"delay": 10, "delaysymm": False, "delayr": 50}),
+}
+
+
+def simulate(preset, **kwds):
+    manager = PRESETS[preset]
+    kwds.setdefault("seed", 1)
+    return netsim.simulate(manager.states, manager.weights, 100, **kwds)
+
+
+class TestPresets(unittest.TestCase):
+    """
+    The expected behaviour of some channels, guard against regressions of
+    the simulator.
+    """
+
+    def test_lan(self):
+        result = simulate("lan", duration=1, rate=6250000)
+        summary = result.summary()
+        self.assertEqual(summary["sent"], 6250)
+        self.assertEqual(summary["loss_rate"], 0)
+        self.assertAlmostEqual(summary["latency_p99"], 1.08)
+        self.assertAlmostEqual(summary["throughput"], 6250000)
+
+    def test_lossy(self):
+        result = simulate("lossy", duration=100)
+        self.assertApproximates(result.loss_rate(), 0.1, 0.01)
+        self.assertEqual(result.dropped, 0)
+        # the stream uses the whole bandwidth but never queues
+        self.assertAlmostEqual(result.percentiles()[-1], 28)
+
+    def test_gilbert(self):
+        """The loss rate is the one expected from the stationary state."""
+
+        result = simulate("gilbert", duration=300)
+        expected = PRESETS["gilbert"].expected()["loss"][0]
+        self.assertAlmostEqual(expected, 12.5)
+        self.assertApproximates(result.loss_rate(), expected / 100, 0.03)
+
+    def test_congested(self):
+        """A full queue drops the packets and caps the latency."""
+
+        result = simulate("congested", duration=10, rate=250000)
+        self.assertApproximates(result.dropped / result.sent, 0.5, 0.01)
+        self.assertEqual(result.lost, 0)
+        p50, p90, p99 = result.percentiles()
+        self.assertApproximates(p99, 5 + 10 * 8, 4)
+        throughput = result.throughput(window=1.0)
+        self.assertEqual(len(throughput), 10)
+        for value in throughput[1:-1]:
+            self.assertApproximates(value, 125000, 2000)
+
+    def test_asymmetric(self):
+        self.assertAlmostEqual(simulate("asymmetric").mean_latency(), 18)
+        self.assertAlmostEqual(
+            simulate("asymmetric", direction=netsim.RL).mean_latency(), 58)
+
+    def test_reproducible(self):
+        self.assertEqual(simulate("gilbert").latencies,
+                         simulate("gilbert").latencies)
+
+    def test_invalid(self):
+        manager = channel({}, {}, w01=150)
+        self.assertRaises(ValueError, netsim.simulate, manager.states,
+                          manager.weights, 100)
+
+
+class FakeFactory:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+    def get_brick_by_name(self, name):
+        for brick in self.bricks:
+            if brick.name == name:
+                return brick
+
+
+class TestConsole(unittest.TestCase):
+
+    def setUp(self):
+        self.netemu = wires.Netemu(stubs.FactoryStub(), "netemu")
+        self.netemu.init_markov()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(FakeFactory([self.netemu]))
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def test_simulate(self):
+        self.protocol.lineReceived("simulate netemu 1")
+        lines = self.transport.value().splitlines()
+        self.assertTrue(lines[0].startswith(b"LR: 125 sent, 0 lost"))
+        self.assertTrue(lines[1].startswith(b"RL: 125 sent, 0 lost"))
+
+    def test_not_netemu(self):
+        self.protocol.lineReceived("simulate nothing")
+        self.assertEqual(self.transport.value().splitlines()[0],
+                         b"No Netemu 'nothing'")
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestSimulatorBenchmark(unittest.TestCase):
+
+    def test_gilbert_125k_packets(self):
+        result = benchmark("simulate 125k packets",
+                           lambda: simulate("gilbert", duration=100,
+                                            rate=1250000))
+        self.assertGreater(result, 0)
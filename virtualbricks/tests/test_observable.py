@@ -0,0 +1,245 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from virtualbricks import observable
+from virtualbricks.tests import (stubs, benchmark, should_test_benchmark,
+                                 skipUnless)
+
+
+class Emitter:
+    pass
+
+
+class TestObservable(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.observable = observable.Observable("changed", "removed",
+                                                clock=self.clock)
+        self.changed = observable.Signal(self.observable, "changed")
+        self.removed = observable.Signal(self.observable, "removed")
+        self.received = []
+        self.changed.connect(self.received.append)
+
+    def test_notify(self):
+        emitter = Emitter()
+        self.changed.notify(emitter)
+        self.assertEqual(self.received, [emitter])
+
+    def test_coalesce(self):
+        """
+        In coalescing mode the notifications are delivered in the next
+        reactor turn, once for every emitter.
+        """
+
+        self.changed.set_coalesce()
+        emitter1, emitter2 = Emitter(), Emitter()
+        for i in range(100):
+            self.changed.notify(emitter1)
+            self.changed.notify(emitter2)
+        self.assertEqual(self.received, [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(self.received, [emitter1, emitter2])
+
+    def test_coalesce_only_selected_events(self):
+        self.changed.set_coalesce()
+        removed = []
+        self.removed.connect(removed.append)
+        emitter = Emitter()
+        self.removed.notify(emitter)
+        self.assertEqual(removed, [emitter])
+
+    def test_coalesce_disabled(self):
+        self.changed.set_coalesce()
+        self.changed.set_coalesce(False)
+        emitter = Emitter()
+        self.changed.notify(emitter)
+        self.assertEqual(self.received, [emitter])
+
+    def test_batch(self):
+        emitter = Emitter()
+        with self.changed.batch():
+            with self.observable.batch():
+                self.changed.notify(emitter)
+            self.changed.notify(emitter)
+            self.assertEqual(self.received, [])
+        self.assertEqual(self.received, [emitter])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_batch_flushes_coalesced(self):
+        """The end of a batch delivers also the coalesced notifications."""
+
+        self.changed.set_coalesce()
+        emitter = Emitter()
+        self.changed.notify(emitter)
+        with self.observable.batch():
+            self.changed.notify(emitter)
+        self.assertEqual(self.received, [emitter])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_batch_keeps_order(self):
+        emitter = Emitter()
+        order = []
+        self.changed.connect(lambda e: order.append("changed"))
+        self.removed.connect(lambda e: order.append("removed"))
+        with self.observable.batch():
+            self.removed.notify(emitter)
+            self.changed.notify(emitter)
+        self.assertEqual(order, ["removed", "changed"])
+
+    def test_thaw_signal(self):
+        emitter = Emitter()
+        with self.changed.thaw():
+            with self.changed.thaw():
+                self.changed.notify(emitter)
+            self.changed.notify(emitter)
+        self.assertEqual(self.received, [])
+        self.changed.notify(emitter)
+        self.assertEqual(self.received, [emitter])
+
+    def test_thaw_observable(self):
+        emitter = Emitter()
+        with self.observable.thaw():
+            self.changed.notify(emitter)
+        self.assertEqual(self.received, [])
+        self.changed.notify(emitter)
+        self.assertEqual(self.received, [emitter])
+
+
+class TestFactoryNotifications(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.brick = self.factory.new_brick("stub", "brick")
+        self.received = []
+        self.factory.connect("brick-changed", self.received.append)
+
+    def test_batch(self):
+        """A bulk update notifies the change of a brick only once."""
+
+        with self.factory.batch():
+            for i in range(10):
+                self.brick.notify_changed()
+        self.assertEqual(self.received, [self.brick])
+
+
+class Listener:
+
+    def __init__(self):
+        self.received = []
+
+    def on_changed(self, emitter, *args, **kwds):
+        self.received.append((emitter, args, kwds))
+
+
+class TestObservers(unittest.TestCase):
+
+    def setUp(self):
+        self.observable = observable.Observable("changed")
+        self.changed = observable.Signal(self.observable, "changed")
+
+    def test_arguments(self):
+        listener = Listener()
+        emitter = Emitter()
+        self.changed.connect(listener.on_changed, 1, key="value")
+        self.changed.notify(emitter)
+        self.assertEqual(listener.received,
+                         [(emitter, (1, ), {"key": "value"})])
+
+    def test_order(self):
+        """The observers are called in the order they are connected."""
+
+        listener = Listener()
+        for i in range(10):
+            self.changed.connect(listener.on_changed, i)
+        self.changed.notify(None)
+        self.assertEqual([args for e, args, kw in listener.received],
+                         [(i, ) for i in range(10)])
+
+    def test_disconnect(self):
+        listener = Listener()
+        self.changed.connect(listener.on_changed, 1)
+        self.changed.connect(listener.on_changed, 2)
+        self.changed.disconnect(listener.on_changed, 1)
+        self.changed.notify(None)
+        self.assertEqual(listener.received, [(None, (2, ), {})])
+
+    def test_disconnect_unknown(self):
+        listener = Listener()
+        self.assertRaises(ValueError, self.changed.disconnect,
+                          listener.on_changed)
+
+    def test_disconnect_during_notify(self):
+        listener = Listener()
+
+        def disconnect(emitter):
+            self.changed.disconnect(disconnect)
+            self.changed.disconnect(listener.on_changed)
+
+        self.changed.connect(disconnect)
+        self.changed.connect(listener.on_changed)
+        self.changed.notify(None)
+        self.assertEqual(len(listener.received), 1)
+        self.changed.notify(None)
+        self.assertEqual(len(listener.received), 1)
+
+    def test_weak(self):
+        listener = Listener()
+        self.changed.connect_weak(listener.on_changed)
+        self.changed.notify(None)
+        self.assertEqual(len(listener.received), 1)
+        del listener
+        self.changed.notify(None)
+        # connecting a new observer with the same key does not fail
+        listener = Listener()
+        self.changed.connect_weak(listener.on_changed)
+
+    def test_weak_pruned(self):
+        """The dead weak observers are removed."""
+
+        self.changed.connect_weak(Listener().on_changed)
+        self.changed.connect_weak(Listener().on_changed, 1)
+        self.assertEqual(
+            len(self.observable._Observable__events["changed"]), 0)
+
+    def test_disconnect_weak(self):
+        listener = Listener()
+        self.changed.connect_weak(listener.on_changed)
+        self.changed.disconnect(listener.on_changed)
+        self.changed.notify(None)
+        self.assertEqual(listener.received, [])
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestObservableBenchmark(unittest.TestCase):
+
+    def test_connect_disconnect_100k(self):
+        signal = observable.Signal(observable.Observable("changed"),
+                                   "changed")
+        listeners = [Listener() for i in range(100000)]
+
+        def cycle():
+            for listener in listeners:
+                signal.connect(listener.on_changed)
+            for listener in listeners:
+                signal.disconnect(listener.on_changed)
+
+        benchmark("100k connect/disconnect", cycle)
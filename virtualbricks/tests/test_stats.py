@@ -0,0 +1,203 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from virtualbricks import console, errors, mgmt, stats
+from virtualbricks.tests import unittest
+
+
+PORT_PRINT = """\
+Port 0001 untagged_vlan=0000 ACTIVE - Unnamed Allocatable
+ Current User: root Access Control: (User: NONE - Group: NONE)
+ IN:  pkts         12          bytes                 {0}
+ OUT: pkts         10          bytes                 {1}
+  -- endpoint ID 0003 module unix prog   : vde_plug
+Port 0002 untagged_vlan=0000 ACTIVE - Unnamed Allocatable
+ Current User: root Access Control: (User: NONE - Group: NONE)
+"""
+FSTP_PRINT = """\
+FSTP: VLAN 0000
+ -- Port 0001 tagged=0 portcost=20000000 role=Root forwarding
+ -- Port 0002 tagged=0 portcost=20000000 role=Alternate blocking
+"""
+
+
+class FakeSwitch:
+
+    proc = object()
+
+    def __init__(self, name, fstp=False):
+        self.name = name
+        self.config = {"fstp": fstp}
+        self.bytes = 0
+        self.commands = []
+
+    def get_type(self):
+        return "Switch"
+
+    def send_command(self, cmd):
+        self.commands.append(cmd)
+        if cmd == b"fstp/print":
+            body = FSTP_PRINT
+        else:
+            body = PORT_PRINT.format(self.bytes, self.bytes // 2)
+        return defer.succeed(mgmt.Response(0, "Success", body.splitlines()))
+
+
+class FakeFactory:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+
+class TestParse(unittest.TestCase):
+
+    def test_ports(self):
+        ports = stats.parse_ports(PORT_PRINT.format(1234, 567).splitlines())
+        self.assertEqual(ports, {1: (12, 1234, 10, 567), 2: (0, 0, 0, 0)})
+
+    def test_fstp(self):
+        self.assertEqual(stats.parse_fstp(FSTP_PRINT.splitlines()),
+                         {1: "forwarding", 2: "blocking"})
+
+
+class TestPortSeries(unittest.TestCase):
+
+    def test_ring(self):
+        """Only the last capacity samples are kept."""
+
+        series = stats.PortSeries(3)
+        for i in range(5):
+            series.append(float(i), (i, i * 10, i, i * 20))
+        self.assertEqual(len(series), 3)
+        self.assertEqual([time for time, counters in series], [2, 3, 4])
+        self.assertEqual(series[-1], (4.0, (4, 40, 4, 80)))
+
+    def test_throughput(self):
+        series = stats.PortSeries(10)
+        self.assertEqual(series.throughput(), (0.0, 0.0))
+        for i in range(5):
+            series.append(float(i), (0, i * 100, 0, i * 10))
+        self.assertEqual(series.throughput(), (100.0, 10.0))
+        self.assertEqual(series.throughput(window=1), (100.0, 10.0))
+
+    def test_counters_reset(self):
+        """The counters of a restarted switch start from zero."""
+
+        series = stats.PortSeries(10)
+        series.append(0.0, (0, 1000, 0, 1000))
+        series.append(1.0, (0, 10, 0, 10))
+        self.assertEqual(series.throughput(), (0.0, 0.0))
+
+
+class TestStatsCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sw1 = FakeSwitch("sw1")
+        self.sw2 = FakeSwitch("sw2", fstp=True)
+        self.factory = FakeFactory([self.sw1, self.sw2])
+        self.collector = stats.StatsCollector(self.factory, interval=10)
+        self.collector.clock = self.clock
+
+    def test_poll(self):
+        """All the switches are polled at every interval."""
+
+        self.collector.start()
+        self.sw1.bytes = 1000
+        self.clock.advance(10)
+        self.collector.stop()
+        self.assertEqual(self.sw1.commands, [b"port/print"] * 2)
+        self.assertEqual(self.sw2.commands,
+                         [b"port/print", b"fstp/print"] * 2)
+        self.assertEqual(len(self.collector.series["sw1"][1]), 2)
+        self.assertEqual(self.collector.throughput("sw1")[1], (100.0, 50.0))
+        self.assertEqual(self.collector.series["sw2"][2].fstp, "blocking")
+        self.assertEqual(self.collector.top(1)[0], ("sw1", 1, 100.0, 50.0))
+
+    def test_skip_pending(self):
+        """A switch is not polled again until it answers."""
+
+        pending = defer.Deferred()
+        self.sw1.send_command = lambda cmd: pending
+        self.collector.poll()
+        self.collector.poll()
+        self.assertEqual(self.collector._pending, {"sw1"})
+        self.assertEqual(len(self.sw2.commands), 4)
+
+    def test_hung_switch(self):
+        """
+        A switch that does not answer does not delay the polls of the other
+        switches.
+        """
+
+        pending = defer.Deferred()
+        self.sw1.send_command = lambda cmd: pending
+        self.collector.start()
+        self.clock.advance(10)
+        self.clock.advance(10)
+        self.collector.stop()
+        self.assertEqual(self.collector._pending, {"sw1"})
+        self.assertEqual(len(self.sw2.commands), 6)
+
+    def test_poll_failed(self):
+        self.sw1.send_command = lambda cmd: defer.fail(
+            errors.CommandRejectedError(22, "Invalid argument"))
+        self.collector.poll()
+        self.assertNotIn("sw1", self.collector.series)
+        self.assertEqual(self.collector._pending, set())
+
+    def test_export(self):
+        self.collector.poll()
+        fp = io.StringIO()
+        self.collector.export(fp)
+        lines = fp.getvalue().splitlines()
+        self.assertEqual(lines[0], "switch,port,time,pkts_in,bytes_in,"
+                         "pkts_out,bytes_out,fstp")
+        self.assertEqual(lines[1], "sw1,1,0.000,12,0,10,0,")
+        self.assertEqual(len(lines), 5)
+
+
+class TestConsole(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = FakeFactory([FakeSwitch("sw1")])
+        self.collector = stats.collector(self.factory)
+        self.collector.clock = task.Clock()
+        self.addCleanup(self.collector.stop)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(self.factory)
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def test_start_stop(self):
+        self.protocol.lineReceived("stats start 5")
+        self.assertTrue(self.collector.running)
+        self.assertEqual(self.collector.interval, 5)
+        self.protocol.lineReceived("stats stop")
+        self.assertFalse(self.collector.running)
+
+    def test_switch(self):
+        self.collector.poll()
+        self.protocol.lineReceived("stats sw1")
+        lines = self.transport.value().splitlines()
+        self.assertEqual(lines[0], b"Port\tIn (B/s)\tOut (B/s)\tFSTP")
+        self.assertEqual(lines[1], b"1\t0.0\t0.0\t-")
@@ -0,0 +1,216 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import io
+
+from twisted.trial import unittest
+from twisted.internet import defer, error, task
+from twisted.python import failure
+
+from virtualbricks import bricks, supervisor
+from virtualbricks.supervisor import RestartPolicy
+from virtualbricks.tests import stubs
+
+
+class SupervisedBrick(stubs.StubBrick):
+
+    def __init__(self, factory, name):
+        stubs.StubBrick.__init__(self, factory, name)
+        self.socks.append(factory.new_sock(self, name + "_port"))
+        self.plugs.append(factory.new_plug(self))
+        self.poweron_count = 0
+
+    def poweron(self):
+        if not self.proc:
+            self.poweron_count += 1
+            self._exited_d = defer.Deferred()
+        return stubs.StubBrick.poweron(self)
+
+    def poweroff(self, kill=False):
+        if self.proc is None:
+            return bricks.Brick.poweroff(self, kill)
+        self._poweroff_requested = True
+        proc = self.proc
+        deferred = self._exited_d
+        self.process_ended(proc, failure.Failure(error.ProcessDone(0)))
+        return deferred
+
+    def crash(self):
+        status = failure.Failure(error.ProcessTerminated(1))
+        self.process_ended(self.proc, status)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.factory = stubs.Factory()
+        self.factory.register_brick_type(SupervisedBrick, "supervised")
+        self.brick = self.factory.new_brick("supervised", "brick")
+        self.brick.poweron()
+
+    def supervise(self, policy=RestartPolicy.ON_FAILURE, **kwds):
+        return supervisor.supervise(self.brick, policy, clock=self.clock,
+                                    **kwds)
+
+    def test_restart_on_failure(self):
+        sup = self.supervise()
+        self.brick.crash()
+        self.assertIs(self.brick.proc, None)
+        self.clock.advance(1)
+        self.assertIsInstance(self.brick.proc, bricks.FakeProcess)
+        self.assertEqual(self.brick.poweron_count, 2)
+        self.assertEqual(sup.restarts, 1)
+
+    def test_no_restart_on_success(self):
+        """With the on-failure policy, a clean exit is not restarted."""
+
+        sup = self.supervise()
+        status = failure.Failure(error.ProcessDone(0))
+        self.brick.process_ended(self.brick.proc, status)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(sup.restarts, 0)
+
+    def test_restart_always(self):
+        self.supervise(RestartPolicy.ALWAYS)
+        status = failure.Failure(error.ProcessDone(0))
+        self.brick.process_ended(self.brick.proc, status)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_no_restart_on_poweroff(self):
+        """A brick stopped by the user is not restarted."""
+
+        self.supervise(RestartPolicy.ALWAYS)
+        self.brick.poweroff()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_poweroff_during_backoff(self):
+        """A brick stopped while waiting to be restarted stays down."""
+
+        self.supervise()
+        self.brick.crash()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.brick.poweroff()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(60)
+        self.assertIs(self.brick.proc, None)
+        self.assertEqual(self.brick.poweron_count, 1)
+
+    def test_poweroff_all_during_backoff(self):
+        self.supervise()
+        self.brick.crash()
+        self.factory.poweroff_all([self.brick], clock=self.clock)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.clock.advance(60)
+        self.assertIs(self.brick.proc, None)
+
+    def test_backoff(self):
+        """The delay doubles at every restart."""
+
+        self.supervise(backoff=1, factor=2)
+        delays = []
+        for i in range(3):
+            self.brick.crash()
+            call, = self.clock.getDelayedCalls()
+            delays.append(call.getTime() - self.clock.seconds())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4])
+
+    def test_give_up(self):
+        """After too many restarts in the window, the brick is left down."""
+
+        sup = self.supervise(backoff=1, factor=1, max_restarts=2, window=60)
+        for i in range(2):
+            self.brick.crash()
+            self.clock.advance(1)
+        self.brick.crash()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(sup.restarts, 2)
+
+    def test_restart_dependents(self):
+        """
+        If asked, the running bricks plugged into the brick are restarted.
+        """
+
+        dependent = self.factory.new_brick("supervised", "dependent")
+        dependent.plugs[0].connect(self.brick.socks[0])
+        dependent.poweron()
+        self.supervise(restart_dependents=True)
+        self.brick.crash()
+        self.clock.advance(1)
+        self.assertEqual(dependent.poweron_count, 2)
+        self.assertIsNot(dependent.proc, None)
+
+    def test_dependents_not_restarted(self):
+        """By default the bricks plugged into the brick are left alone."""
+
+        dependent = self.factory.new_brick("supervised", "dependent")
+        dependent.plugs[0].connect(self.brick.socks[0])
+        dependent.poweron()
+        self.supervise()
+        self.brick.crash()
+        self.clock.advance(1)
+        self.assertEqual(self.brick.poweron_count, 2)
+        self.assertEqual(dependent.poweron_count, 1)
+
+    def test_never_removes_supervisor(self):
+        self.supervise()
+        self.assertIs(self.supervise(RestartPolicy.NEVER), None)
+        self.assertIs(self.brick.supervisor, None)
+
+    def test_policy_by_name(self):
+        self.assertIs(supervisor.policy_by_name("on-failure"),
+                      RestartPolicy.ON_FAILURE)
+        self.assertRaises(ValueError, supervisor.policy_by_name, "sometimes")
+
+
+class TestSupervisorConfig(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.Factory()
+        self.factory.register_brick_type(SupervisedBrick, "supervised")
+        self.brick = self.factory.new_brick("supervised", "brick")
+
+    def test_set_installs_supervisor(self):
+        self.brick.set({"restart_policy": "always", "restart_max": 3,
+                        "restart_dependents": True})
+        sup = self.brick.supervisor
+        self.assertIs(sup.policy, RestartPolicy.ALWAYS)
+        self.assertEqual(sup.max_restarts, 3)
+        self.assertTrue(sup.restart_dependents)
+        self.brick.set({"restart_policy": "never"})
+        self.assertIs(self.brick.supervisor, None)
+
+    def test_invalid_policy(self):
+        self.brick.set({"restart_policy": "sometimes"})
+        self.assertIs(self.brick.supervisor, None)
+        self.flushLoggedErrors()
+
+    def test_save_and_restore(self):
+        """The supervisor settings are saved with the brick."""
+
+        self.brick.set({"restart_policy": "on-failure",
+                        "restart_window": 30.0})
+        sio = io.StringIO()
+        self.brick.save_to(sio)
+        brick = self.factory.new_brick("supervised", "restored")
+        section = [line.split("=", 1) for line in
+                   sio.getvalue().splitlines()[1:] if line]
+        brick.load_from(section)
+        self.assertIs(brick.supervisor.policy, RestartPolicy.ON_FAILURE)
+        self.assertEqual(brick.supervisor.window, 30.0)
+        self.assertFalse(brick.supervisor.restart_dependents)
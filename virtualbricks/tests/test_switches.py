@@ -17,8 +17,11 @@
 
 import os
 
-from virtualbricks import switches, errors, settings
-from virtualbricks.tests import unittest, stubs
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from virtualbricks import switches, errors, settings, bricks
+from virtualbricks.tests import unittest, stubs, successResultOf
 
 settings.load()
 
@@ -59,6 +62,75 @@ class TestSwitch(unittest.TestCase):
         )
 
 
+class TestBatchSet(unittest.TestCase):
+
+    PROMPT = b"vde$ "
+
+    def setUp(self):
+        self.switch = switches.Switch(stubs.FactoryStub(), "test_switch")
+        self.switch._started_d = defer.Deferred()
+        self.switch._exited_d = defer.Deferred()
+        self.proc = bricks.VDEProcessProtocol(self.switch)
+        self.proc.clock = task.Clock()
+        self.transport = proto_helpers.StringTransport()
+        self.transport.pid = -1
+        self.proc.makeConnection(self.transport)
+        self.switch.proc = self.proc
+        self.changes = []
+        self.switch.changed.connect(self.changes.append)
+
+    def test_not_running(self):
+        """If the switch is not running, the values are just set."""
+
+        self.switch.proc = None
+        deferred = self.switch.batch_set({"numports": 8, "hub": True})
+        self.assertIs(successResultOf(self, deferred), None)
+        self.assertEqual(self.switch.config["numports"], 8)
+        self.assertTrue(self.switch.config["hub"])
+        self.assertEqual(self.changes, [self.switch])
+
+    def test_validate(self):
+        """Nothing is set if one of the values is not valid."""
+
+        self.assertRaises(ValueError, self.switch.batch_set,
+                          {"hub": True, "numports": 1000})
+        self.assertRaises(ValueError, self.switch.batch_set,
+                          {"hub": True, "ports": 10})
+        self.assertFalse(self.switch.config["hub"])
+        self.assertEqual(self.transport.value(), b"")
+        self.assertEqual(self.changes, [])
+
+    def test_burst(self):
+        """
+        The commands are sent in one burst and the change is notified once,
+        when all of them are acknowledged.
+        """
+
+        deferred = self.switch.batch_set({"numports": 8, "hub": True})
+        self.assertEqual(sorted(self.transport.value().splitlines()),
+                         [b"port/sethub 1", b"port/setnumports 8"])
+        self.assertEqual(self.changes, [])
+        self.proc.outReceived(b"1000 Success\n" + self.PROMPT)
+        self.assertNoResult(deferred)
+        self.proc.outReceived(b"1000 Success\n" + self.PROMPT)
+        successResultOf(self, deferred)
+        self.assertEqual(self.changes, [self.switch])
+        self.assertEqual(self.switch.config["numports"], 8)
+
+    def test_rollback(self):
+        """If a command is rejected, the configuration is rolled back."""
+
+        deferred = self.switch.batch_set({"numports": 8, "hub": True})
+        self.proc.outReceived(b"1000 Success\n" + self.PROMPT +
+                              b"1022 Invalid argument\n" + self.PROMPT)
+        failure = self.failureResultOf(deferred, errors.CommandRejectedError)
+        self.assertEqual(failure.value.code, 22)
+        self.assertEqual(self.switch.config["numports"], 32)
+        self.assertFalse(self.switch.config["hub"])
+        self.assertEqual(self.changes, [])
+        self.assertEqual(len(self.flushLoggedErrors()), 0)
+
+
 class TestSwitchWrapper(unittest.TestCase):
 
     def setUp(self):
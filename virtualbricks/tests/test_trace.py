@@ -0,0 +1,218 @@
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+from twisted.internet import defer, task
+from twisted.test import proto_helpers
+
+from virtualbricks import console, trace, wires
+from virtualbricks.tests import (unittest, stubs, benchmark,
+                                 should_test_benchmark, skipUnless)
+
+
+CSV_TRACE = """\
+time,delay,loss,bandwidth
+0,10,0,125000
+1,10,0,125000
+2,50,,
+2.5,50,5,
+"""
+
+
+class FakeProcess:
+
+    def __init__(self):
+        self.batches = []
+
+    def write_batch(self, commands):
+        self.batches.append(commands)
+        return defer.succeed(None)
+
+
+class _TraceMixin:
+
+    def write_trace(self, content=CSV_TRACE):
+        filename = self.mktemp()
+        with open(filename, "w") as fp:
+            fp.write(content)
+        return filename
+
+
+class TestRead(_TraceMixin, unittest.TestCase):
+
+    def test_csv(self):
+        samples = list(trace.read_trace(self.write_trace()))
+        self.assertEqual(len(samples), 4)
+        self.assertEqual(samples[0], trace.Sample(0.0, 10, 0.0, 125000))
+        self.assertEqual(samples[2], trace.Sample(2.0, 50, None, None))
+
+    def test_binary(self):
+        filename = self.mktemp()
+        with open(filename, "wb") as fp:
+            trace.write_binary(trace.read_trace(self.write_trace()), fp)
+        self.assertEqual(list(trace.read_trace(filename)),
+                         list(trace.read_trace(self.write_trace())))
+
+    def test_binary_truncated(self):
+        filename = self.mktemp()
+        with open(filename, "wb") as fp:
+            trace.write_binary([trace.Sample(0.0, 1, 1.0, 1)], fp)
+            fp.write(b"\x00")
+        self.assertRaises(ValueError, list, trace.read_trace(filename))
+
+    def test_no_time(self):
+        filename = self.write_trace("delay,loss\n10,0\n")
+        self.assertRaises(ValueError, list, trace.read_trace(filename))
+
+    def test_invalid_sample(self):
+        filename = self.write_trace("time,delay\n0,ten\n")
+        self.assertRaises(ValueError, list, trace.read_trace(filename))
+
+
+class TestSchedule(_TraceMixin, unittest.TestCase):
+
+    def test_changes_only(self):
+        """The samples that change nothing are not scheduled."""
+
+        schedule = trace.Schedule.load(self.write_trace())
+        self.assertEqual(list(schedule.times), [0.0, 2.0, 2.5])
+        self.assertEqual(list(schedule.masks),
+                         [trace.DELAY | trace.LOSS | trace.BANDWIDTH,
+                          trace.DELAY, trace.LOSS])
+        self.assertEqual(list(schedule.bandwidths), [125000] * 3)
+        self.assertEqual(schedule.end, 2.5)
+
+    def test_time_goes_back(self):
+        samples = [trace.Sample(1.0, 1, None, None),
+                   trace.Sample(0.5, 2, None, None)]
+        self.assertRaises(ValueError, trace.Schedule.from_samples, samples)
+
+    def test_commands(self):
+        schedule = trace.Schedule.load(self.write_trace())
+        self.assertEqual(schedule.commands(2, trace.DELAY | trace.LOSS, 1),
+                         [b"delay 50[1]\n", b"loss 5.000000[1]\n"])
+
+
+class TestTracePlayer(_TraceMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(trace.TracePlayer, "clock", self.clock)
+        self.netemu = wires.Netemu(stubs.FactoryStub(), "netemu")
+        self.netemu.init_markov()
+        self.netemu.proc = self.proc = FakeProcess()
+
+    def test_play(self):
+        done = self.netemu.play(self.write_trace())
+        self.clock.advance(0)
+        self.assertEqual(self.proc.batches, [[b"delay 10[0]\n",
+                                              b"loss 0.000000[0]\n",
+                                              b"bandwidth 125000[0]\n"]])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(2)
+        self.assertEqual(self.proc.batches[-1], [b"delay 50[0]\n"])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0.5)
+        self.assertEqual(self.proc.batches[-2], [b"loss 5.000000[0]\n"])
+        # the model is restored at the end
+        self.assertIn(b"markov-numnodes 1\n", self.proc.batches[-1])
+        self.assertIsNone(self.netemu.player)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        done.addCallback(self.assertIsNone)
+        return done
+
+    def test_late(self):
+        """The steps due are merged when the timer fires late."""
+
+        self.netemu.play(self.write_trace())
+        self.clock.advance(0)
+        call = self.clock.getDelayedCalls()[0]
+        self.clock.rightNow = 3
+        call.func(*call.args)
+        self.assertEqual(self.proc.batches[1],
+                         [b"delay 50[0]\n", b"loss 5.000000[0]\n"])
+
+    def test_loop(self):
+        self.netemu.play(self.write_trace(), loop=True)
+        self.clock.pump([2, 0.5, 0.1])
+        self.assertEqual(self.proc.batches[-1], [b"delay 10[0]\n",
+                                                 b"loss 0.000000[0]\n",
+                                                 b"bandwidth 125000[0]\n"])
+        self.assertIsNotNone(self.netemu.player)
+        self.netemu.stop_playback()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_process_ended(self):
+        self.netemu.play(self.write_trace())
+        self.netemu._exited_d = defer.Deferred()
+        self.netemu.process_ended(self.proc, 0)
+        self.assertIsNone(self.netemu.player)
+        # the model is not sent to the process ended
+        self.assertEqual(self.proc.batches, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_invalid_trace(self):
+        filename = self.write_trace("time,delay\n1,1\n0,2\n")
+        self.assertRaises(ValueError, self.netemu.play, filename)
+        self.assertEqual(self.proc.batches, [])
+
+
+class FakeFactory:
+
+    def __init__(self, bricks):
+        self.bricks = bricks
+
+    def get_brick_by_name(self, name):
+        for brick in self.bricks:
+            if brick.name == name:
+                return brick
+
+
+class TestConsole(_TraceMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.patch(trace.TracePlayer, "clock", task.Clock())
+        self.netemu = wires.Netemu(stubs.FactoryStub(), "netemu")
+        self.netemu.init_markov()
+        self.transport = proto_helpers.StringTransport()
+        self.protocol = console.VBProtocol(FakeFactory([self.netemu]))
+        self.protocol.makeConnection(self.transport)
+        self.transport.clear()
+
+    def test_not_running(self):
+        self.protocol.lineReceived("netemu play trace.csv")
+        self.assertEqual(self.transport.value().splitlines()[0],
+                         b"netemu is not running")
+
+    def test_play_stop(self):
+        self.netemu.proc = FakeProcess()
+        self.protocol.lineReceived("netemu play %s loop" %
+                                   self.write_trace())
+        self.assertTrue(self.netemu.player.loop)
+        self.protocol.lineReceived("netemu play stop")
+        self.assertIsNone(self.netemu.player)
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestScheduleBenchmark(unittest.TestCase):
+
+    def test_load_1m_samples(self):
+        filename = self.mktemp()
+        with open(filename, "wb") as fp:
+            trace.write_binary((trace.Sample(i * 0.01, i % 100, None, None)
+                                for i in range(1000000)), fp)
+        benchmark("load a trace of 1M samples",
+                  lambda: trace.Schedule.load(filename))
@@ -31,7 +31,8 @@ from virtualbricks import errors
 from virtualbricks import link
 from virtualbricks import settings
 from virtualbricks import virtualmachines as vm
-from virtualbricks.tests import stubs, test_link, patch_settings
+from virtualbricks.tests import (stubs, test_link, patch_settings, benchmark,
+                                 should_test_benchmark, skipUnless)
 
 
 def disks(vm):
@@ -150,6 +151,143 @@ class TestVirtualMachine(unittest.TestCase):
     #     self.assertEqual(_image.acquired, _image.released)
 
 
+class TestArgsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = stubs.FactoryStub()
+        self.vm = stubs.VirtualMachineStub(self.factory, "vm")
+        self.image = vm.Image("test", os.path.abspath(self.mktemp()))
+        self.vm.get("hda").set_image(self.image)
+        self.calls = []
+        args = vm.Disk.args
+
+        def count(disk, *a, **kw):
+            self.calls.append(disk.device)
+            return args(disk, *a, **kw)
+
+        self.patch(vm.Disk, "args", count)
+
+    def args(self):
+        return self.successResultOf(self.vm.args())
+
+    def test_cached(self):
+        """The command line is built only the first time."""
+
+        args = self.args()
+        self.assertEqual(len(self.calls), 7)
+        self.assertEqual(self.args(), args)
+        self.assertEqual(len(self.calls), 7)
+        self.assertIsNot(self.args(), self.args())
+
+    def test_config_changed(self):
+        self.args()
+        self.vm.set({"ram": 64})
+        self.args()
+        self.assertEqual(len(self.calls), 7)
+        self.vm.set({"ram": 128})
+        self.assertIn("128", self.args())
+        self.assertEqual(len(self.calls), 14)
+
+    def test_image_changed(self):
+        self.args()
+        image = vm.Image("other", os.path.abspath(self.mktemp()))
+        self.vm.get("hda").set_image(image)
+        self.assertIn(image.path, self.args())
+
+    def test_same_image_path(self):
+        """A new image is used even if its path did not change."""
+
+        self.args()
+        self.vm.set_image("hda", vm.Image("other", self.image.path))
+        self.args()
+        self.assertEqual(len(self.calls), 14)
+
+    def test_settings_changed(self):
+        machine = self.factory.new_brick("vm", "test")
+        self.patch(machine, "prog", lambda: "true")
+        self.successResultOf(machine.args())
+        self.successResultOf(machine.args())
+        self.assertEqual(len(self.calls), 7)
+        self.factory.settings_changed()
+        self.successResultOf(machine.args())
+        self.assertEqual(len(self.calls), 14)
+
+    def test_prog_removed(self):
+        """The qemu binary is looked for again if it was removed."""
+
+        path = os.path.abspath(self.mktemp())
+        os.mkdir(path)
+        patch_settings(self, qemupath=path)
+        qemu = os.path.join(path, "qemu-test")
+        with open(qemu, "w"):
+            pass
+        os.chmod(qemu, 0o755)
+        machine = vm.VirtualMachine(self.factory, "test")
+        machine.set({"argv0": "qemu-test"})
+        self.assertEqual(machine.prog(), qemu)
+        os.remove(qemu)
+        self.assertRaises(FileNotFoundError, machine.prog)
+
+    def test_link_changed(self):
+        self.assertIn("none", self.args())
+        self.vm.add_plug(vm.hostonly_sock)
+        self.assertNotIn("none", self.args())
+
+    def test_private_image(self):
+        """
+        The private image is checked again only if it changed on disk.
+        """
+
+        created = []
+
+        def ensure(path):
+            created.append(path)
+            with open(path, "w"):
+                pass
+            return defer.succeed(None)
+
+        self.patch(vm.Disk, "_basefolder", lambda disk: os.getcwd())
+        self.patch(vm.Disk, "_ensure_private_image_cow",
+                   lambda disk, path: ensure(path))
+        self.vm.set({"privatehda": True})
+        self.args()
+        self.args()
+        self.assertEqual(len(created), 1)
+        os.remove(created[0])
+        self.args()
+        self.assertEqual(len(created), 2)
+
+    def test_plan(self):
+        """plan() does not create the private images."""
+
+        self.patch(vm.Disk, "_ensure_private_image_cow",
+                   lambda disk, path: self.fail("private image created"))
+        self.patch(vm.Disk, "_basefolder", lambda disk: "/project")
+        self.vm.set({"privatehda": True})
+        plan = self.successResultOf(self.vm.plan())
+        self.assertIn("/project/vm_hda.cow", plan)
+        self.assertIsNone(self.vm._argv)
+
+
+@skipUnless(should_test_benchmark(), "benchmarks are not enabled")
+class TestArgsCacheBenchmark(unittest.TestCase):
+
+    def test_args_1000_vms(self):
+        factory = stubs.FactoryStub()
+        vms = [stubs.VirtualMachineStub(factory, "vm%d" % i)
+               for i in range(1000)]
+        for machine in vms:
+            machine.get("hda").set_image(vm.Image("test", "/images/a.img"))
+            machine.add_plug(vm.hostonly_sock)
+
+        def args():
+            for machine in vms:
+                machine.args()
+
+        benchmark("build the command line of 1000 VMs", args)
+        benchmark("cached command line of 1000 VMs", args)
+
+
 class TestVMPlug(test_link.TestPlug):
 
     @staticmethod
@@ -15,14 +15,18 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import io
+
 try:
     import mock
 except ImportError:
     mock = None
 from twisted.trial import unittest
+from twisted.internet import defer, error
+from twisted.python import failure
 
-from virtualbricks import wires, link, settings
-from virtualbricks.tests import stubs, skipUnless
+from virtualbricks import wires, link, settings, configfile
+from virtualbricks.tests import stubs, skipUnless, successResultOf
 
 
 class TestNetemu(unittest.TestCase):
@@ -58,6 +62,26 @@ class TestNetemu(unittest.TestCase):
                 "--nofifo"]
         self.assertEqual(self.netemu.args(), args)
 
+    def test_save_restore_states(self):
+        """The Markov states survive a save and a restore."""
+
+        factory = stubs.Factory()
+        netemu = factory.new_brick("netemu", "ne")
+        netemu.set({"delay": 10})
+        netemu.markov_manager.add(1)
+        netemu.markov_manager.states[1]["delay"] = 20
+        netemu.markov_manager.weights[0][1] = 30.0
+        saved = io.StringIO()
+        configfile.ConfigFile().save_to(factory, saved)
+        factory2 = stubs.Factory()
+        configfile.ConfigFile().restore_from(
+            factory2, io.StringIO(saved.getvalue()))
+        netemu2 = factory2.get_brick_by_name("ne")
+        self.assertEqual(len(netemu2.markov_manager.states), 2)
+        self.assertEqual(netemu2.markov_manager.states[0]["delay"], 10)
+        self.assertEqual(netemu2.markov_manager.states[1]["delay"], 20)
+        self.assertEqual(netemu2.markov_manager.weights[0][1], 30.0)
+
     @skipUnless(mock is not None, "Mock library not installed")
     def test_live_management(self):
         """
@@ -100,3 +124,94 @@ class TestNetemu(unittest.TestCase):
         self.netemu.cbset_delay.assert_called_once_with(1)
         self.netemu.cbset_delayr.assert_called_once_with(2)
         self.netemu.send.assert_called_once_with("delay 1\n")
+
+
+class FakeProcess:
+
+    def __init__(self):
+        self.batches = []
+        self.result = defer.succeed(None)
+
+    def write_batch(self, commands):
+        self.batches.append(commands)
+        return self.result
+
+
+class TestNetemuUpdate(unittest.TestCase):
+
+    def setUp(self):
+        self.netemu = wires.Netemu(stubs.FactoryStub(), "test_netemu")
+        self.netemu.init_markov()
+        self.netemu.proc = self.proc = FakeProcess()
+        self.netemu.update()
+
+    def last_batch(self):
+        return self.proc.batches[-1]
+
+    def test_full_update(self):
+        """The first update sends the whole model."""
+
+        commands = self.last_batch()
+        self.assertEqual(commands[0], b"markov-numnodes 1\n")
+        self.assertIn(b"delay 0[0]\n", commands)
+        self.assertIn(b"setedge 0,0,0.000000\n", commands)
+        self.assertEqual(commands[-1], b"markov-time 100\n")
+
+    def test_no_changes(self):
+        self.netemu.update()
+        self.assertEqual(self.last_batch(), [])
+
+    def test_changed_parameter(self):
+        """Only the parameters changed are sent."""
+
+        self.netemu.markov_manager.states[0]["delay"] = 10
+        self.netemu.transPeriod = 200
+        self.netemu.update()
+        self.assertEqual(self.last_batch(),
+                         [b"delay 10[0]\n", b"markov-time 200\n"])
+
+    def test_new_state(self):
+        """A new state is sent with all its parameters and weights."""
+
+        self.netemu.markov_manager.add(1)
+        self.netemu.markov_manager.weights[1][0] = 0.5
+        self.netemu.update()
+        commands = self.last_batch()
+        self.assertEqual(commands[0], b"markov-numnodes 2\n")
+        self.assertIn(b"delay 0[1]\n", commands)
+        self.assertNotIn(b"delay 0[0]\n", commands)
+        self.assertEqual([c for c in commands if c.startswith(b"setedge")],
+                         [b"setedge 0,1,0.000000\n",
+                          b"setedge 1,0,0.500000\n",
+                          b"setedge 1,1,0.000000\n"])
+
+    def test_resync_after_failure(self):
+        """If the emulator rejected a command, the whole model is sent."""
+
+        self.proc.result = defer.fail(ValueError())
+        self.netemu.markov_manager.states[0]["delay"] = 10
+        self.netemu.update()
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.proc.result = defer.succeed(None)
+        self.netemu.update()
+        self.assertEqual(self.last_batch()[0], b"markov-numnodes 1\n")
+
+    def test_resync_after_restart(self):
+        """The model is sent again to a restarted emulator."""
+
+        self.netemu._exited_d = defer.Deferred()
+        self.netemu.process_ended(self.proc,
+                                  failure.Failure(error.ProcessDone(0)))
+        self.netemu.proc = self.proc
+        self.netemu.update()
+        self.assertEqual(self.last_batch(), self.proc.batches[0])
+
+    def test_update_stopped(self):
+        """The change is notified even if the emulator is not running."""
+
+        changed = []
+        self.netemu.changed.connect(changed.append)
+        self.netemu.proc = None
+        self.netemu.markov_manager.states[0]["delay"] = 10
+        self.assertIs(successResultOf(self, self.netemu.update()), None)
+        self.assertEqual(changed, [self.netemu])
@@ -0,0 +1,297 @@
+# -*- test-case-name: virtualbricks.tests.test_trace -*-
+# Virtualbricks - a vde/qemu gui written in python and GTK/Glade.
+# Copyright (C) 2019 Virtualbricks team
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""
+Replay a recorded time series of delay, loss and bandwidth on a running
+Netemu.
+
+A trace is either a CSV file with a header row and the columns time
+(seconds from the start), delay (milliseconds), loss (percent) and
+bandwidth (bytes per second), all but time optional, or a binary file
+written by write_binary. Traces are read as a stream and compiled in a
+Schedule, which keeps in arrays only the steps where something changes.
+"""
+
+import array
+import collections
+import csv
+import struct
+
+from twisted.internet import defer, reactor
+
+from virtualbricks import log
+
+
+__all__ = ["Sample", "Schedule", "TracePlayer", "read_trace",
+           "write_binary"]
+
+if False:  # pyflakes
+    _ = str
+
+
+logger = log.Logger()
+playback_failed = log.Event("Cannot replay the trace on {brick}")
+
+MAGIC = b"VBTRACE1"
+# time, mask, delay, loss, bandwidth
+RECORD = struct.Struct("<dBIfI")
+CHUNK = 4096
+
+DELAY = 1
+LOSS = 2
+BANDWIDTH = 4
+FIELDS = (("delay", DELAY), ("loss", LOSS), ("bandwidth", BANDWIDTH))
+
+Sample = collections.namedtuple("Sample", "time delay loss bandwidth")
+
+
+def _read_csv(fileobj):
+    reader = csv.DictReader(fileobj)
+    if not reader.fieldnames or "time" not in reader.fieldnames:
+        raise ValueError(_("The trace has no time column"))
+    for row in reader:
+        try:
+            yield Sample(
+                float(row["time"]),
+                int(float(row["delay"])) if row.get("delay") else None,
+                float(row["loss"]) if row.get("loss") else None,
+                int(float(row["bandwidth"])) if row.get("bandwidth")
+                else None)
+        except ValueError:
+            raise ValueError(_("Invalid sample at line {0} of the "
+                               "trace").format(reader.line_num))
+
+
+def _read_binary(fileobj):
+    while True:
+        data = fileobj.read(RECORD.size * CHUNK)
+        if len(data) % RECORD.size:
+            raise ValueError(_("The trace is truncated"))
+        if not data:
+            return
+        for time, mask, delay, loss, bandwidth in RECORD.iter_unpack(data):
+            yield (time,
+                   delay if mask & DELAY else None,
+                   loss if mask & LOSS else None,
+                   bandwidth if mask & BANDWIDTH else None)
+
+
+def read_trace(filename):
+    """
+    Iterate over the samples of a trace, CSV or binary, without reading
+    the whole file in memory. The values missing are None.
+
+    :return: the samples as (time, delay, loss, bandwidth) tuples.
+    :rtype: Iterator[Tuple[float, int, float, int]]
+    :raises ValueError: if the trace is not valid.
+    """
+
+    with open(filename, "rb") as fp:
+        binary = fp.read(len(MAGIC)) == MAGIC
+        if binary:
+            yield from _read_binary(fp)
+    if not binary:
+        with open(filename, newline="") as fp:
+            yield from _read_csv(fp)
+
+
+def write_binary(samples, fileobj):
+    """
+    Write the samples in the binary format.
+
+    :type samples: Iterable[Sample]
+    :param fileobj: a file opened in binary mode.
+    """
+
+    fileobj.write(MAGIC)
+    for sample in samples:
+        mask = 0
+        values = []
+        for name, flag in FIELDS:
+            value = getattr(sample, name)
+            if value is not None:
+                mask |= flag
+            values.append(value or 0)
+        fileobj.write(RECORD.pack(sample.time, mask, *values))
+
+
+class Schedule:
+    """
+    The steps of a trace where at least one value changes.
+
+    Every step holds all the values current at that time and a mask of
+    the values changed.
+    """
+
+    __slots__ = ("times", "masks", "delays", "losses", "bandwidths", "end")
+
+    def __init__(self):
+        self.times = array.array("d")
+        self.masks = array.array("B")
+        self.delays = array.array("I")
+        self.losses = array.array("f")
+        self.bandwidths = array.array("I")
+        self.end = 0.0
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_samples(cls, samples):
+        """
+        :type samples: Iterable[Sample]
+        :rtype: Schedule
+        :raises ValueError: if the times go back.
+        """
+
+        schedule = cls()
+        append_time = schedule.times.append
+        append_mask = schedule.masks.append
+        append_delay = schedule.delays.append
+        append_loss = schedule.losses.append
+        append_bandwidth = schedule.bandwidths.append
+        end = 0.0
+        delay = loss = bandwidth = None
+        for time, new_delay, new_loss, new_bandwidth in samples:
+            if time < end or time < 0:
+                raise ValueError(_("The time of the trace goes back at "
+                                   "{0}").format(time))
+            end = time
+            mask = 0
+            if new_delay is not None and new_delay != delay:
+                delay = new_delay
+                mask |= DELAY
+            if new_loss is not None and new_loss != loss:
+                loss = new_loss
+                mask |= LOSS
+            if new_bandwidth is not None and new_bandwidth != bandwidth:
+                bandwidth = new_bandwidth
+                mask |= BANDWIDTH
+            if mask:
+                append_time(time)
+                append_mask(mask)
+                append_delay(delay or 0)
+                append_loss(loss or 0.0)
+                append_bandwidth(bandwidth or 0)
+        schedule.end = end
+        return schedule
+
+    @classmethod
+    def load(cls, filename):
+        return cls.from_samples(read_trace(filename))
+
+    def commands(self, index, mask, state):
+        """
+        Return the commands that set the values of a step changed in mask.
+
+        :rtype: List[bytes]
+        """
+
+        commands = []
+        if mask & DELAY:
+            commands.append(b"delay %d[%d]\n" % (self.delays[index], state))
+        if mask & LOSS:
+            commands.append(b"loss %f[%d]\n" % (self.losses[index], state))
+        if mask & BANDWIDTH:
+            commands.append(b"bandwidth %d[%d]\n" % (
+                self.bandwidths[index], state))
+        return commands
+
+
+class TracePlayer:
+    """
+    Replay a schedule on a running Netemu, on its current state.
+
+    Only one timer is pending at any time, armed for the next step. The
+    steps due when the timer fires are merged and only the last values
+    are sent, so a late reactor never queues stale commands.
+
+    If the playback loops, the time of the last sample is the length of
+    the period.
+    """
+
+    clock = reactor
+
+    def __init__(self, netemu, schedule, loop=False):
+        self.netemu = netemu
+        self.schedule = schedule
+        self.loop = loop
+        self.done = None
+        self._call = None
+        self._index = 0
+        self._start = 0.0
+        self._offset = 0.0
+
+    @property
+    def running(self):
+        return self.done is not None
+
+    def start(self):
+        """
+        :return: a Deferred fired when the playback ends or is stopped.
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        self.done = defer.Deferred()
+        self._start = self.clock.seconds()
+        self._arm()
+        return self.done
+
+    def stop(self):
+        if self._call is not None:
+            call, self._call = self._call, None
+            call.cancel()
+        self._finish()
+
+    def _finish(self):
+        if self.done is not None:
+            done, self.done = self.done, None
+            done.callback(self)
+
+    def _arm(self):
+        schedule = self.schedule
+        if self._index >= len(schedule):
+            if not (self.loop and len(schedule) and schedule.end > 0):
+                self._finish()
+                return
+            self._index = 0
+            self._offset += schedule.end
+        due = self._start + self._offset + schedule.times[self._index]
+        self._call = self.clock.callLater(max(due - self.clock.seconds(), 0),
+                                          self._tick)
+
+    def _tick(self):
+        self._call = None
+        if self.netemu.proc is None:
+            self._finish()
+            return
+        schedule = self.schedule
+        now = self.clock.seconds() - self._start - self._offset
+        mask = 0
+        index = self._index
+        while index < len(schedule) and schedule.times[index] <= now:
+            mask |= schedule.masks[index]
+            index += 1
+        self._index = index
+        if mask:
+            commands = schedule.commands(index - 1, mask,
+                                         self.netemu.currentState)
+            deferred = self.netemu.proc.write_batch(commands)
+            deferred.addErrback(logger.failure_eb, playback_failed,
+                                brick=self.netemu)
+        self._arm()
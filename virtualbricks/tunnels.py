@@ -18,7 +18,7 @@
 
 import os
 
-from virtualbricks import bricks, link, log
+from virtualbricks import bricks, log
 from virtualbricks.spawn import abspath_vde
 
 
@@ -46,7 +46,7 @@ class TunnelListen(bricks.Brick):
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
         self.command_builder["-s"] = self.sock_path
-        self.plugs.append(link.Plug(self))
+        self.plugs.append(factory.new_plug(self))
 
     def sock_path(self):
         if self.configured():
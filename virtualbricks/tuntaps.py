@@ -19,7 +19,7 @@
 import os
 from collections import OrderedDict as odict
 
-from virtualbricks import bricks, link, settings
+from virtualbricks import bricks, settings
 from virtualbricks.spawn import abspath_vde
 
 if False:  # pyflakes
@@ -42,7 +42,7 @@ class Capture(PrivilegedBrick):
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
-        self.plugs.append(link.Plug(self))
+        self.plugs.append(factory.new_plug(self))
         self.command_builder = odict((("-s", self.sock_path),
                                       ("*iface", "iface")))
 
@@ -86,7 +86,7 @@ class Tap(PrivilegedBrick):
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
-        self.plugs.append(link.Plug(self))
+        self.plugs.append(factory.new_plug(self))
         self.command_builder["-s"] = self.sock_path
         self.command_builder["*tap"] = self.get_name
 
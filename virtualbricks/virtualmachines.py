@@ -154,20 +154,25 @@ class Wrapper:
                 setattr(self.original, name, value)
 
 
-class VMPlug(Wrapper):
+class _Link(Wrapper):
+    """A network card of a virtual machine, a change of it is reported."""
+
+    def __init__(self, original):
+        Wrapper.__init__(self, original)
+        Wrapper.__setattr__(self, "model", "rtl8139")
+        Wrapper.__setattr__(self, "mac", tools.random_mac())
+
+    def __setattr__(self, name, value):
+        Wrapper.__setattr__(self, name, value)
+        if name in ("model", "mac"):
+            self.brick.notify_changed()
 
-    def __init__(self, plug):
-        Wrapper.__init__(self, plug)
-        self.model = "rtl8139"
-        self.mac = tools.random_mac()
 
+class VMPlug(_Link):
+    pass
 
-class VMSock(Wrapper):
 
-    def __init__(self, sock):
-        Wrapper.__init__(self, sock)
-        self.model = "rtl8139"
-        self.mac = tools.random_mac()
+class VMSock(_Link):
 
     def connect(self, endpoint):
         return
@@ -421,7 +426,11 @@ class Disk:
     def _basefolder(self):
         return project.manager.current.path
 
-    def args(self):
+    def args(self, ensure=True):
+        """
+        :param bool ensure: if False, do not create or check the private
+            image, used to show the command line without starting the VM.
+        """
 
         def cb(disk_name):
             if self.vm.get('use_virtio'):
@@ -430,7 +439,12 @@ class Disk:
                 return ['-' + self.device, disk_name]
 
         if self.image:
-            d = self.get_real_disk_name()
+            if ensure:
+                d = self.get_real_disk_name()
+            elif self.is_cow():
+                d = defer.succeed(self.get_cow_path())
+            else:
+                d = defer.succeed(self.image.path)
             d.addCallback(cb)
             return d
         else:
@@ -439,6 +453,8 @@ class Disk:
 
     def set_image(self, image):
         self.image = image
+        if self.vm is not None:
+            self.vm.invalidate_args()
 
     def acquire(self):
         self.lock_image()
@@ -586,6 +602,27 @@ class Disk:
     def readonly(self):
         return self.vm.config['snapshot']
 
+    def args_key(self):
+        """
+        Return what the arguments of this disk depend on, out of the
+        configuration of the VM: the image and the identity of the private
+        image, if any. The private image is recreated, with a new identity,
+        if its backing file is wrong.
+
+        :rtype: tuple
+        """
+
+        if self.image is None:
+            return None
+        if not self.is_cow():
+            return self.image.path, None, None
+        path = self.get_cow_path()
+        try:
+            st = os.stat(path)
+        except OSError:
+            return self.image.path, path, None
+        return self.image.path, path, (st.st_dev, st.st_ino)
+
     def __deepcopy__(self, memo):
         new = self.__class__(self.vm, self.device, self.image)
         return new
@@ -837,9 +874,16 @@ class VirtualMachine(bricks.Brick):
     config_factory = VirtualMachineConfig
     process_protocol = bricks.Process
     default_arg0 = 'qemu-system-x86_64'
+    poweroff_steps = (
+        ("powerdown", {}),
+        ("term", {"term": True}),
+        ("kill", {"kill": True}),
+    )
 
     def __init__(self, factory, name):
         bricks.Brick.__init__(self, factory, name)
+        self._argv = None
+        self._prog = None
         self._observable.add_event("image-changed")
         self.image_changed = Event(self._observable, 'image-changed')
         self.config["name"] = name
@@ -896,6 +940,7 @@ class VirtualMachine(bricks.Brick):
             return defer.succeed((self, self._last_status))
         elif not any((kill, term)):
             self.logger.info(powerdown, vm=self)
+            self._poweroff_requested = True
             self.send(b"system_powerdown\n")
             return self._exited_d
         if term:
@@ -937,13 +982,65 @@ class VirtualMachine(bricks.Brick):
             arg0 = self.config['argv0']
         else:
             arg0 = self.default_arg0
-        return abspath_qemu(arg0)
+        key = arg0, settings.get("qemupath")
+        if self._prog is not None and self._prog[0] == key:
+            # the binary may have been removed or replaced since
+            if _mtime(self._prog[1]) == self._prog[2]:
+                return self._prog[1]
+        path = abspath_qemu(arg0)
+        self._prog = key, path, _mtime(path)
+        return path
+
+    def args_key(self):
+        """
+        Return everything the command line depends on. The command line is
+        built again only when the key changes.
+
+        :rtype: tuple
+        """
+
+        links = []
+        for link in itertools.chain(self.plugs, self.socks):
+            sock = getattr(link, "sock", None)
+            links.append((link.mode, link.model, link.mac,
+                          getattr(link, "path", None),
+                          sock and (sock.mode, sock.path)))
+        return (self.config.generation, self.name, settings.get("qemupath"),
+                tuple(links), tuple(disk.args_key() for disk in self.disks()))
+
+    def invalidate_args(self):
+        """Forget the command line built, for changes the key cannot see."""
+
+        self._argv = None
+        self._prog = None
 
     def args(self):
+        key = self.args_key()
+        if self._argv is not None and self._argv[0] == key:
+            return defer.succeed(list(self._argv[1]))
         d = defer.gatherResults([disk.args() for disk in self.disks()])
         d.addCallback(self.__args)
+        d.addCallback(self._cache_args, key)
         return d
 
+    def _cache_args(self, argv, key):
+        # the private images may have been created in the meantime, the
+        # command line is not cached if anything else changed
+        after = self.args_key()
+        if (after[:-1] == key[:-1] and
+                [d and d[:2] for d in after[-1]] ==
+                [d and d[:2] for d in key[-1]]):
+            self._argv = after, list(argv)
+        return argv
+
+    def plan(self):
+        key = self.args_key()
+        if self._argv is not None and self._argv[0] == key:
+            return defer.succeed(list(self._argv[1]))
+        d = defer.gatherResults([disk.args(ensure=False)
+                                 for disk in self.disks()])
+        return d.addCallback(self.__args)
+
     def __args(self, results):
         res = [self.prog()]
         if (self.config['kvm'] or self.config['machine'] or
@@ -1032,17 +1129,16 @@ class VirtualMachine(bricks.Brick):
         return res
 
     def add_sock(self, mac=None, model=None):
-        s = self.factory.new_sock(self)
-        sock = VMSock(s)
         vlan = len(self.plugs) + len(self.socks)
-        sock.path = "{0}/{1.brick.name}_sock_eth{2}[]".format(
-            settings.VIRTUALBRICKS_HOME, sock, vlan)
-        sock.nickname = "{0.brick.name}_sock_eth{1}".format(sock, vlan)
+        nickname = "{0}_sock_eth{1}".format(self.name, vlan)
+        sock = VMSock(self.factory.new_sock(self, nickname))
+        sock.path = "{0}/{1}[]".format(settings.VIRTUALBRICKS_HOME, nickname)
         self.socks.append(sock)
         if mac:
             sock.mac = mac
         if model:
             sock.model = model
+        self.notify_changed()
         return sock
 
     def add_plug(self, sock, mac=None, model=None):
@@ -1054,6 +1150,7 @@ class VirtualMachine(bricks.Brick):
             plug.mac = mac
         if model:
             plug.model = model
+        self.notify_changed()
         return plug
 
     def connect(self, sock, *args):
@@ -1067,6 +1164,10 @@ class VirtualMachine(bricks.Brick):
                 self.plugs.remove(plug)
         except ValueError:
             self.logger.error(own_err, plug=plug, brick=self)
+        else:
+            if plug.mode != "sock" and plug.configured():
+                plug.disconnect()
+            self.notify_changed()
 
     def commit_disks(self, args):
         # XXX: fixme
@@ -1096,9 +1197,14 @@ class VirtualMachine(bricks.Brick):
             yield self.config[hd]
 
     def set_image(self, disk, image):
+        changed = self.config[disk].image is not image
         self.config[disk].image = image
+        self.invalidate_args()
         if not self._restore:
             self._observable.notify("image-changed", (self, image))
+        if changed:
+            # the image is saved with the machine
+            self.notify_changed()
 
     def set_vm(self, disk):
         disk.vm = self
@@ -1107,5 +1213,12 @@ class VirtualMachine(bricks.Brick):
             cbset_mtblock = set_vm
 
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
 def is_virtualmachine(brick):
     return brick.get_type() == "Qemu"
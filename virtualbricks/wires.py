@@ -16,15 +16,22 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import collections
 import re
 
-from virtualbricks import bricks, log
+from twisted.internet import defer
+
+from virtualbricks import bricks, errors, log, markov, trace
+from virtualbricks._configparser import is_blank
 from virtualbricks.spawn import abspath_vde
 
 if False:  # pyflakes
     _ = str
 
 
+logger = log.Logger()
+update_failed = log.Event("Cannot update the emulator {brick}")
+
 class Wire(bricks.Brick):
 
     type = "Wire"
@@ -93,26 +100,21 @@ class MarkovConfig():
     # calling __init__ with the current active config (Netemu.config) will link it to state nr. 0 
     def __init__(self, config):
         self.states = list()
-        self.weights = list()
-        self.weights.append(list())
-        self.weights[0].append(0.0)
+        self.weights = markov.matrix(1)
         self.states.append(config)
 
     # append a new state with default config at the end of the state list
     # all weights to and from the new state are 0 by default
     def add(self, index):
         new = NetemuConfig() # create a new config instance for each state
-        length = len(self.states)
-        self.weights.insert(index, list())
+        self.weights.insert(index)
+        self.weights = markov.resize(self.weights)
 
         unavailable = []
         defaultOccupied = False
         defaultName = NetemuConfig.parameters["name"].default
 
         for i, state in enumerate(self.states):
-            self.weights[i].insert(index, 0.0)
-            self.weights[index].append(0.0)
-
             # default naming of each state uses the default name + a positive integer at the end (e.g. default name 0, default name 1...)
             if state["name"].startswith(defaultName):
                 args = state["name"].split(" ")
@@ -124,8 +126,6 @@ class MarkovConfig():
                 elif not defaultOccupied and len(args) == defaultArgsLen:
                     defaultOccupied = True
 
-        self.weights[length].append(0.0)
-
         if not defaultOccupied:
             self.states.insert(index, new)
             return
@@ -146,12 +146,65 @@ class MarkovConfig():
         if len(self.states) == 1:
             return
         
-        del(self.weights[index])
+        self.weights.delete(index)
+        self.weights = markov.resize(self.weights)
+        del(self.states[index])
 
-        for weight in self.weights:
-            del(weight[index])
+    def validate(self):
+        """
+        Check the transition weights.
+
+        :raises ValueError: if a weight is negative or the weights leaving a
+            state sum to more than 100.
+        """
+
+        self.weights.validate()
+
+    def stationary_distribution(self):
+        """
+        Return the fraction of time the emulator spends in every state in
+        the long run.
+
+        :rtype: List[float]
+        """
+
+        return self.weights.stationary_distribution()
+
+    def expected(self):
+        """
+        Return the long-run average delay, loss and bandwidth of the
+        channel, in both directions.
+
+        A bandwidth of 0 means unlimited. If the emulator spends some time in
+        a state with unlimited bandwidth, the average bandwidth in that
+        direction is unlimited too and it is reported as ``inf``.
+
+        :return: a mapping from the parameter name to the pair of values
+            left to right and right to left.
+        :rtype: Dict[str, Tuple[float, float]]
+        """
+
+        names = "delay", "loss", "bandwidth"
+        values = []
+        for name in names:
+            values.append([state[name] for state in self.states])
+            values.append([state[name if state[name + "symm"] else name + "r"]
+                           for state in self.states])
+        distribution = self.stationary_distribution()
+        averages = markov.expected(distribution, values)
+        for i in 4, 5:
+            # the distribution is computed iteratively, a state never visited
+            # can be left with a residual probability
+            if any(p > 1e-9 and value == 0
+                   for p, value in zip(distribution, values[i])):
+                averages[i] = float("inf")
+        return dict((name, tuple(averages[i * 2:i * 2 + 2]))
+                    for i, name in enumerate(names))
+
+# The model as last acknowledged by the emulator
+_MarkovSnapshot = collections.namedtuple("_MarkovSnapshot",
+                                         "states weights time")
 
-        del(self.states[index])
 
 class WFProcessProtocol(bricks.VDEProcessProtocol):
 
@@ -170,6 +223,8 @@ class Netemu(Wire):
         self.currentState = 0      # used for GUI updating and communicating to Netemu
         self.startupState = 0      # the state the emulator will start into
         self.transPeriod = 100     # default value for Netemu
+        self._acked = None         # the model acknowledged by the emulator
+        self.player = None         # the trace being replayed
         self.command_builder = {
             "--nofifo": lambda: "*",
             "-M": self.console,
@@ -179,9 +234,17 @@ class Netemu(Wire):
         d = bricks.Brick.poweron(self)
         self.currentState = self.startupState
         self.config = self.markov_manager.states[self.currentState]
+        # a new emulator knows nothing of the model
+        self._acked = None
         self.update()
         return d
 
+    def process_ended(self, proc, status):
+        self._acked = None
+        result = Wire.process_ended(self, proc, status)
+        self.stop_playback()
+        return result
+
     def args(self):
         res = [self.prog(), "-v", self.plugs[0].sock.path.rstrip('[]') + ":" +
                self.plugs[1].sock.path.rstrip('[]')]
@@ -224,39 +287,120 @@ class Netemu(Wire):
         return "vde-netemu"
 
     def set(self, attrs):
-        self._set(attrs, "chanbufsizesymm", "chanbufsize", "chanbufsizer")
-        self._set(attrs, "delaysymm", "delay", "delayr")
-        self._set(attrs, "bandwidthsymm", "bandwidth", "bandwidthr")
-        self._set(attrs, "losssymm", "loss", "lossr")
         Wire.set(self, attrs)
 
         # this is called while reading the save file which always reads at least 1 state 
         if self.markov_manager is None:
             self.init_markov()
 
-    def _set(self, attrs, symm, left_to_right, right_to_left):
+    def _apply(self, attrs, previous):
+        attrs = dict(attrs)
+        self._set(attrs, previous, "chanbufsizesymm", "chanbufsize",
+                  "chanbufsizer")
+        self._set(attrs, previous, "delaysymm", "delay", "delayr")
+        self._set(attrs, previous, "bandwidthsymm", "bandwidth", "bandwidthr")
+        self._set(attrs, previous, "losssymm", "loss", "lossr")
+        Wire._apply(self, attrs, previous)
+
+    def _set(self, attrs, previous, symm, left_to_right, right_to_left):
         if symm in attrs and attrs[symm] != self.config[symm]:
-            if left_to_right in attrs:
-                self.config[left_to_right] = attrs.pop(left_to_right)
-            if right_to_left in attrs:
-                self.config[right_to_left] = attrs.pop(right_to_left)
+            for name in left_to_right, right_to_left:
+                if name in attrs:
+                    previous.setdefault(name, self.config[name])
+                    self.config[name] = attrs.pop(name)
+
+    def play(self, filename, loop=False):
+        """
+        Replay a trace of delay, loss and bandwidth on the current state of
+        the running emulator. When the playback ends, the emulator goes
+        back to the configured model.
+
+        :return: a Deferred fired when the playback ends or is stopped.
+        :rtype: twisted.internet.defer.Deferred
+        :raises ValueError: if the trace is not valid.
+        """
+
+        if self.proc is None:
+            raise errors.BrickNotRunningError(self.name)
+        schedule = trace.Schedule.load(filename)
+        self.stop_playback()
+        self.player = player = trace.TracePlayer(self, schedule, loop)
+        return player.start().addCallback(self._playback_ended)
+
+    def stop_playback(self):
+        if self.player is not None:
+            self.player.stop()
+
+    def _playback_ended(self, player):
+        if self.player is player:
+            self.player = None
+        # the trace overwrote the values of the model
+        self._acked = None
+        return self.update()
 
     # the set functions in base.py and wires.py are not suitable anymore for communicating with the emulator  
     def update(self):
-        if self.proc is None:
-            return
-        
+        """
+        Send to the emulator the parts of the model changed since the last
+        update it acknowledged, the whole model after a restart. The model is
+        sent through the management socket to an emulator not started by
+        this instance and the change is notified even if the emulator is not
+        running.
+
+        :rtype: twisted.internet.defer.Deferred
+        """
+
+        if not self._is_managed():
+            self.notify_changed()
+            return defer.succeed(None)
+
+        snapshot = self._snapshot()
+        self._batch = commands = []
+        try:
+            self._update_model(self._acked)
+        finally:
+            self._batch = None
+        self.notify_changed()
+        deferred = self._write_batch(commands)
+        deferred.addCallback(self._update_acked, snapshot)
+        return deferred.addErrback(self._update_failed)
+
+    def _snapshot(self):
+        manager = self.markov_manager
+        return _MarkovSnapshot(
+            [dict(state.items()) for state in manager.states],
+            [list(row) for row in manager.weights],
+            self.transPeriod)
+
+    def _update_acked(self, ignore, snapshot):
+        self._acked = snapshot
+
+    def _update_failed(self, fail):
+        # what the emulator applied is unknown, resend everything next time
+        self._acked = None
+        if not fail.check(errors.BrickNotRunningError):
+            logger.failure(update_failed, fail, brick=self)
+
+    def _update_model(self, acked):
+        states = self.markov_manager.states
+        known = len(acked.states) if acked is not None else 0
+
         # state attributes
-        
-        self._update("numnodes", len(self.markov_manager.states))
+
+        if acked is None or known != len(states):
+            self._update("numnodes", len(states))
 
         currentState = self.currentState
         
-        for i, state in enumerate(self.markov_manager.states):
-            self.currentState = i
-            self.config = self.markov_manager.states[self.currentState]
-            for name, value in state.items():
-                self._update(name, value)
+        for i, state in enumerate(states):
+            old = acked.states[i] if i < known else {}
+            changed = [(name, value) for name, value in state.items()
+                       if name not in old or old[name] != value]
+            if changed:
+                self.currentState = i
+                self.config = state
+                for name, value in changed:
+                    self._update(name, value)
         
         self.currentState = currentState
         self.config = self.markov_manager.states[self.currentState]
@@ -265,13 +409,13 @@ class Netemu(Wire):
 
         for i, weight0 in enumerate(self.markov_manager.weights):
             for j, value in enumerate(weight0):
-                self._update("weight", value, i, j)
+                if i >= known or j >= known or acked.weights[i][j] != value:
+                    self._update("weight", value, i, j)
 
         # other attributes
 
-        self._update("time", self.transPeriod)
-
-        self.notify_changed()
+        if acked is None or acked.time != self.transPeriod:
+            self._update("time", self.transPeriod)
 
     # utility function with logging like in base.py
     def _update(self, name, value, *args):
@@ -398,96 +542,66 @@ class Netemu(Wire):
 
         # first state
 
-        done = False
-        curpos = section.fileobj.tell()
-        line = section.fileobj.readline()
+        lines = iter(section.lines)
         cfg = {}
-        while not done and line:
-            if line.startswith("#") or section.EMPTY.match(line):
-                curpos = section.fileobj.tell()
-                line = section.fileobj.readline()
-                continue # ...
+        for line in lines:
+            if is_blank(line):
+                continue
             match = section.CONFIG_LINE.match(line)
             if match:
                 name, value = match.groups()
-                if value is None:
-                    # value is None when the parameter is not set
-                    value = ""
                 if self.config.parameters.get(name):
                     cfg[name] = self._getvalue(name, value)
-                curpos = section.fileobj.tell()
-                line = section.fileobj.readline()
             else:
                 self.set(cfg)
                 if not line.startswith("-"):
-                    section.fileobj.seek(curpos)
                     return
-                
-                done = True
+                break
+        else:
+            self.set(cfg)
+            return
 
-        errorMsg = log.Event("Error parsing argument {arg}, {exception}.")            
-        cfg = {}
-        line = section.fileobj.readline()
-        curpos = section.fileobj.tell()
+        errorMsg = log.Event("Error parsing argument {arg}, {exception}.")
         STATE_LINE = re.compile(r"^state([0-9]+)\.(\w+)\s*=\s*(.*)$")
         DOUBLE_STATE_LINE = re.compile(r"^state([0-9]+)\.(\w+)\[([0-9]+)\]\s*=\s*(.*)$")
 
-        while line:
-            if line.startswith("#") or section.EMPTY.match(line):
-                curpos = section.fileobj.tell()
-                line = section.fileobj.readline()
-                continue # ...
+        for line in lines:
+            if is_blank(line):
+                continue
 
             match = DOUBLE_STATE_LINE.match(line)
             if match:
                 state, name, stateTo, value = match.groups()
                 if state.isnumeric() and stateTo.isnumeric():
-                    if value is None:
-                        # value is None when the parameter is not set
-                        value = ""
                     try:
                         if name == "probability" and max(int(state), int(stateTo)) < len(self.markov_manager.states) and int(state) != int(stateTo):
-                            self.markov_manager.weights[int(state)][int(stateTo)] = float(value)    
+                            self.markov_manager.weights[int(state)][int(stateTo)] = float(value)
                     except ValueError:
                         self.logger.error(errorMsg, arg="state" + state + "." + name, exception="Value Error")
-                curpos = section.fileobj.tell()
-                line = section.fileobj.readline()
 
             else:
                 match = STATE_LINE.match(line)
                 if match:
                     state, name, value = match.groups()
                     if state.isnumeric():
-                        if value is None:
-                            # value is None when the parameter is not set
-                            value = ""
                         try:
                             if int(state) < len(self.markov_manager.states) and self.config.parameters.get(name):
                                 self.markov_manager.states[int(state)][name] = self._getvalue(name, value)
                         except ValueError:
                             self.logger.error(errorMsg, arg="state" + state + "." + name, exception="Value Error")
-                    curpos = section.fileobj.tell()
-                    line = section.fileobj.readline()
 
                 else:
                     match = section.CONFIG_LINE.match(line)
                     if match:
                         name, value = match.groups()
-                        if value is None:
-                            # value is None when the parameter is not set
-                            value = ""
                         try:
                             if name.startswith("states") and value.isnumeric():
                                 for i in range(len(self.markov_manager.states), int(value)):
                                     self.markov_manager.add(i)
-                                
+
                             elif name.startswith("transperiod") and value.isnumeric():
                                 self.transPeriod = int(value)
                         except ValueError:
-                            self.logger.error(errorMsg, arg="state" + state + "." + name, exception="Value Error")
-                        
-                        curpos = section.fileobj.tell()
-                        line = section.fileobj.readline()
-                    else:   
-                        section.fileobj.seek(curpos)
+                            self.logger.error(errorMsg, arg=name, exception="Value Error")
+                    else:
                         return
\ No newline at end of file